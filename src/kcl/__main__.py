@@ -0,0 +1,63 @@
+import runpy
+import sys
+from pathlib import Path
+
+# Entry points are imported only once a command is chosen, so that
+# `kcl --help` and a mistyped command return immediately.
+COMMANDS = {
+    "infer": ("kcl.inference.infer", "Generate model outputs for a task"),
+    "eval": ("kcl.evaluation.eval", "Judge the outputs of an infer run"),
+    "sweep": ("kcl.inference.sweep", "Run several models and settings"),
+    "pipeline": ("kcl.pipeline", "Generate and judge in one run"),
+    "snapshot": ("kcl.tasks.snapshot", "Save the dataset for offline runs"),
+}
+
+USAGE = "usage: kcl <command> [CONFIG.yaml] [hydra overrides ...]"
+
+
+def print_help(file=sys.stdout):
+    print(USAGE, file=file)
+    print("\ncommands:", file=file)
+    for name, (_, description) in COMMANDS.items():
+        print(f"  {name:<10}{description}", file=file)
+    print(
+        "\nA config file path expands to --config-dir/--config-name; any "
+        "other arguments go to hydra unchanged.",
+        file=file,
+    )
+
+
+def hydra_args(args):
+    if args and args[0].endswith((".yaml", ".yml")):
+        config = Path(args[0])
+        args = [
+            "--config-dir",
+            str(config.parent.resolve()),
+            "--config-name",
+            config.stem,
+            *args[1:],
+        ]
+    return args
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] in ("-h", "--help"):
+        print_help()
+        return 0
+
+    command, *args = argv
+    if command not in COMMANDS:
+        print(f"kcl: unknown command {command!r}\n", file=sys.stderr)
+        print_help(sys.stderr)
+        return 2
+
+    # Same as `python -m <module>`: hydra reads sys.argv and resolves
+    # relative paths against a __main__ entry point.
+    sys.argv = [f"kcl {command}", *hydra_args(args)]
+    runpy.run_module(COMMANDS[command][0], run_name="__main__")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
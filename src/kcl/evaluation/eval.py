@@ -1,7 +1,6 @@
+import asyncio
 import json
 import logging
-import random
-import time
 from collections import defaultdict
 from pathlib import Path
 
@@ -11,10 +10,29 @@ from hydra.core.hydra_config import HydraConfig
 from joblib import Parallel, delayed
 from loguru import logger
 from omegaconf import DictConfig
-from tenacity import retry, stop_after_attempt, wait_fixed
+from tenacity import retry, stop_after_attempt, wait_random_exponential
 from tqdm.auto import tqdm
 
 from kcl.evaluation.judges import get_judge
+from kcl.evaluation.utils.bootstrap import CONFIDENCE, bootstrap_ci
+from kcl.inference.engine import AsyncEngine, aclose_model
+from kcl.inference.results import (
+    PRECEDENT_CUTS,
+    RESULT_FORMATS,
+    SAMPLE_ID,
+    iter_parquet,
+    write_parquet,
+)
+from kcl.models.clients import client_stats, set_pool_size
+from kcl.models.tokenizer import (
+    estimated_chars_per_token,
+    set_chars_per_token,
+    update_calibration,
+)
+from kcl.models.usage import usage_markdown, usage_scope, usage_summary
+from kcl.models.wrapper import wrapper_stats
+from kcl.tasks import get_loader
+from kcl.tasks.truncation import apply_cuts
 
 MAX_RETRY = 5
 RETRY_WAIT_SEC = 10
@@ -24,19 +42,170 @@ def retry_log(retry_state):
     logger.warning(
         f"[Retry {retry_state.attempt_number}/{MAX_RETRY}] {retry_state.outcome.exception()}",
     )
-    base = RETRY_WAIT_SEC * (2**retry_state.attempt_number)
-    jitter = random.uniform(0, RETRY_WAIT_SEC)
-    time.sleep(base + jitter)
 
 
-@retry(
+# Full jitter spreads out workers that were throttled at the same moment.
+retry_policy = retry(
     stop=stop_after_attempt(MAX_RETRY),
-    wait=wait_fixed(RETRY_WAIT_SEC),
+    wait=wait_random_exponential(
+        multiplier=RETRY_WAIT_SEC, max=RETRY_WAIT_SEC * 2**MAX_RETRY
+    ),
     before_sleep=retry_log,
     reraise=True,
 )
-def judge_sample(judge, sample):
-    return judge(sample)
+
+
+@retry_policy
+def judge_sample(judge, sample, task_name=None):
+    with usage_scope(task_name):
+        return judge(sample)
+
+
+@retry_policy
+async def ajudge_sample(judge, sample, task_name=None):
+    with usage_scope(task_name):
+        return await judge.ajudge(sample)
+
+
+async def run_async(engine, judge, samples):
+    judge_model = getattr(judge, "model", None)
+    try:
+        return await engine.amap(
+            ajudge_sample,
+            [(judge, sample, task_name) for task_name, sample in samples],
+            provider=getattr(judge_model, "provider", "local"),
+            desc="Evaluating",
+        )
+    finally:
+        if judge_model is not None:
+            await aclose_model(judge_model)
+
+
+def recorded_cuts(inference_results_dir):
+    # Precedent cuts of prompts that were fitted to the inference model,
+    # by sample_id.
+    cuts = {}
+    for path in inference_results_dir.glob("*/*.parquet"):
+        for record in iter_parquet(path):
+            if record.get(PRECEDENT_CUTS):
+                cuts[record[SAMPLE_ID]] = record[PRECEDENT_CUTS]
+    return cuts
+
+
+def load_task_dataset(inference_config, cuts=None):
+    # The rendered dataset that compact results refer to by sample_id,
+    # with prompts cut the way they were for the inference model.
+    loader = get_loader(
+        inference_config["tasks"],
+        **(inference_config.get("tasks_kwargs") or {}),
+    )
+    dataset = loader.load()
+    if cuts:
+        dataset = apply_cuts(loader, dataset, cuts)
+    return dataset
+
+
+def load_inference_results(sub_task_dir, dataset=None):
+    parquet_files = sorted(sub_task_dir.glob("*.parquet"))
+    if parquet_files:
+        for path in parquet_files:
+            yield from iter_parquet(path, dataset)
+        return
+    for result_json in sub_task_dir.glob("*.json"):
+        yield from json.loads(result_json.read_text())
+
+
+def format_ci(ci):
+    if ci is None:
+        return "-"
+    return f"{ci[0]:.2%} – {ci[1]:.2%}"
+
+
+def save_eval_results(
+    save_root_dir,
+    final_results,
+    usage=None,
+    result_format="json",
+    dataset=None,
+):
+    save_root_dir.mkdir(parents=True, exist_ok=True)
+
+    for sub_task_name, samples in final_results.items():
+        if result_format != "json":
+            write_parquet(
+                samples, save_root_dir / f"{sub_task_name}.parquet", dataset
+            )
+            logger.info(
+                f"Saved evaluation results for {sub_task_name} → {sub_task_name}.parquet"
+            )
+        if result_format == "parquet":
+            continue
+        with open(
+            save_root_dir / f"{sub_task_name}.json", "w", encoding="utf-8"
+        ) as f:
+            json.dump(samples, f, ensure_ascii=False, indent=4)
+
+        logger.info(
+            f"Saved evaluation results for {sub_task_name} → {sub_task_name}.json"
+        )
+
+    score_summation = {
+        k: {
+            "score_sum": sum(
+                [item["normalized_score_sum"] for item in final_results[k]]
+            ),
+            "full_score_sum": sum(
+                [item.get("score", 1) for item in final_results[k]]
+            ),
+        }
+        for k in sorted(final_results.keys())
+    }
+
+    # Multi-sample runs also report the mean of each per-sample metric.
+    metric_names = list(
+        dict.fromkeys(
+            name
+            for samples in final_results.values()
+            for item in samples
+            for name in item.get("metrics", {})
+        )
+    )
+    for k, score in score_summation.items():
+        scored = [item.get("metrics", {}) for item in final_results[k]]
+        score["metrics"] = {
+            name: sum(m.get(name, 0) for m in scored) / max(1, len(scored))
+            for name in metric_names
+        }
+
+    # With a sampled task the percentage is an estimate; the interval
+    # says how far the full benchmark could be from it.
+    for k, score in score_summation.items():
+        score["n_samples"] = len(final_results[k])
+        score["ci"] = bootstrap_ci(final_results[k])
+
+    score_md_table = ""
+    score_md_table += (
+        f"| Task Name | Score | Percentage | Samples | {CONFIDENCE:.0%} CI |"
+    )
+    score_md_table += "".join(f" {name} |" for name in metric_names)
+    score_md_table += "\n| --- | --- | --- | --- | --- |"
+    score_md_table += " --- |" * len(metric_names)
+    score_md_table += "\n"
+    score_md_table += "\n".join(
+        [
+            f"| {task_name} | {score['score_sum']:.2f} | {score['score_sum'] / score['full_score_sum']:.2%} |"
+            f" {score['n_samples']} | {format_ci(score['ci'])} |"
+            + "".join(
+                f" {score['metrics'][name]:.2%} |" for name in metric_names
+            )
+            for task_name, score in score_summation.items()
+        ]
+    )
+    (save_root_dir / "a_score_summary.md").write_text(score_md_table)
+    if usage:
+        (save_root_dir / "a_usage_summary.md").write_text(
+            usage_markdown(usage)
+        )
 
 
 @hydra.main(version_base=None, config_path=None, config_name=None)
@@ -76,23 +245,78 @@ def main(cfg: DictConfig):
 
     inference_results_dir = input_dir / "results"
 
+    result_format = cfg.get("result_format", "json")
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(
+            f"Unknown result_format: {result_format!r}. Available: {RESULT_FORMATS}"
+        )
+
     sub_task_dirs = [d for d in inference_results_dir.iterdir() if d.is_dir()]
+    dataset = None
+    if result_format != "json" or any(
+        inference_results_dir.glob("*/*.parquet")
+    ):
+        dataset = load_task_dataset(
+            inference_config, recorded_cuts(inference_results_dir)
+        )
+
     inference_results_flattened = []
     for sub_task_dir in sub_task_dirs:
         sub_task_name = sub_task_dir.name
-        results_jsons = list(sub_task_dir.glob("*.json"))
-        for result_json in results_jsons:
-            inference_result = json.loads(result_json.read_text())
-            for item in inference_result:
-                inference_results_flattened.append([sub_task_name, item])
+        for item in load_inference_results(sub_task_dir, dataset):
+            inference_results_flattened.append([sub_task_name, item])
 
-    judge = get_judge(tasks, **cfg["judge_model"])
-    eval_results = Parallel(n_jobs=cfg.get("n_jobs", 1), backend="threading")(
-        delayed(judge_sample)(judge, sample)
-        for _, sample in tqdm(inference_results_flattened, desc="Evaluating")
+    set_pool_size(
+        cfg.get("n_jobs", 1), *(cfg.get("concurrency") or {}).values()
     )
+    set_chars_per_token(cfg.get("chars_per_token"))
+    judge = get_judge(tasks, **cfg["judge_model"])
+    n_jobs = cfg.get("n_jobs", 1)
+    engine_name = cfg.get("engine", "threading")
+    if engine_name == "batch":
+        batch_cfg = {
+            k: v for k, v in cfg.get("batch", {}).items() if v is not None
+        }
+        eval_results = judge.judge_batch(
+            [sample for _, sample in inference_results_flattened],
+            **batch_cfg,
+        )
+    elif engine_name == "async":
+        engine = AsyncEngine(
+            concurrency=cfg.get("concurrency"),
+            default_concurrency=n_jobs,
+        )
+        eval_results = asyncio.run(
+            run_async(engine, judge, inference_results_flattened)
+        )
+    else:
+        eval_results = Parallel(n_jobs=n_jobs, backend="threading")(
+            delayed(judge_sample)(judge, sample, sub_task_name)
+            for sub_task_name, sample in tqdm(
+                inference_results_flattened, desc="Evaluating"
+            )
+        )
 
-    save_root_dir.mkdir(parents=True, exist_ok=True)
+    judge_model = getattr(judge, "model", None)
+    run_stats = wrapper_stats(judge_model)
+    clients = client_stats()
+    if clients:
+        run_stats["clients"] = clients
+    usage = usage_summary(judge_model)
+    update_calibration(judge_model)
+    if usage:
+        run_stats["usage"] = usage
+    if judge_model is not None:
+        chars_per_token = estimated_chars_per_token(judge_model)
+        if chars_per_token is not None:
+            run_stats["chars_per_token"] = chars_per_token
+    if run_stats:
+        logger.info(f"Run stats: {run_stats}")
+        (run_dir / "run_stats.json").write_text(
+            json.dumps(run_stats, ensure_ascii=False, indent=4)
+        )
+    if hasattr(judge_model, "cleanup"):
+        judge_model.cleanup()
 
     final_results: dict[str, list[dict]] = defaultdict(list)
     for (sub_task_name, _), eval_result in zip(
@@ -100,38 +324,9 @@ def main(cfg: DictConfig):
     ):
         final_results[sub_task_name].append(eval_result)
 
-    for sub_task_name, samples in final_results.items():
-        with open(
-            save_root_dir / f"{sub_task_name}.json", "w", encoding="utf-8"
-        ) as f:
-            json.dump(samples, f, ensure_ascii=False, indent=4)
-
-        logger.info(
-            f"Saved evaluation results for {sub_task_name} → {sub_task_name}.json"
-        )
-
-    score_summation = {
-        k: {
-            "score_sum": sum(
-                [item["normalized_score_sum"] for item in final_results[k]]
-            ),
-            "full_score_sum": sum(
-                [item.get("score", 1) for item in final_results[k]]
-            ),
-        }
-        for k in sorted(final_results.keys())
-    }
-
-    score_md_table = ""
-    score_md_table += "| Task Name | Score | Percentage |\n"
-    score_md_table += "| --- | --- | --- |\n"
-    score_md_table += "\n".join(
-        [
-            f"| {task_name} | {score['score_sum']:.2f} | {score['score_sum'] / score['full_score_sum']:.2%} |"
-            for task_name, score in score_summation.items()
-        ]
+    save_eval_results(
+        save_root_dir, final_results, usage, result_format, dataset
     )
-    (save_root_dir / "a_score_summary.md").write_text(score_md_table)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,19 @@
 from functools import partial
 
-from google.genai import types
 from tqdm.auto import tqdm
 
 from kcl.evaluation.utils.text_utils import parse_json_from_raw_string
 from kcl.models import get_model
+from kcl.models.batch import generate_batch
+from kcl.models.tokenizer import token_counter
 
 tqdm = partial(tqdm, dynamic_ncols=True)
 
+# Gemini rejects context caches below this size.
+MIN_CACHE_TOKENS = 1024
+# Estimated counts must clear the minimum by this factor.
+ESTIMATE_MARGIN = 1.25
+
 
 class KCLEssayEval:
 
@@ -15,87 +21,194 @@ class KCLEssayEval:
         self.model = get_model(cfg["model_name"], **cfg["kwargs"])
         self.score_per_rubric = cfg["score_per_rubric"]
         self.prompt_templates = cfg["prompt_templates"]
+        self.token_counter = token_counter(self.model)
+
+    def _answer_prefix(self, item):
+        instruction = f"{self.prompt_templates['instruction']}\n"
+        input_text_prefix = (
+            self.prompt_templates["model_answer_template"].format(
+                answer=item["model_output"],
+                score_per_rubric=self.score_per_rubric,
+            )
+            + "\n"
+        )
+        return instruction, input_text_prefix
+
+    def _cacheable(self, input_text_prefix):
+        # Counted locally instead of a count_tokens round-trip per item.
+        n_cache_toks = self.token_counter.count(input_text_prefix)
+        if not self.token_counter.exact:
+            n_cache_toks /= ESTIMATE_MARGIN
+        return n_cache_toks >= MIN_CACHE_TOKENS
+
+    def _cache_config(self, instruction, input_text_prefix):
+        from google.genai import types
+
+        return types.CreateCachedContentConfig(
+            display_name="judge_prompt_and_model_answer",
+            system_instruction=instruction,
+            contents=[input_text_prefix],
+        )
 
-    def judge(self, item):
+    def _rubric_input(self, instruction, input_text_prefix, criterion, cache):
+        rubric_text = (
+            self.prompt_templates["rubric_template"]
+            .format(rubrics_with_score=criterion)
+            .strip()
+        )
+        if cache is not None:
+            return rubric_text
+        return instruction + input_text_prefix + rubric_text
+
+    def _grade(self, item, judge_output, criterion, r_id):
+        grade, success = self._parse_answer_judge(
+            judge_output,
+            item["score"],
+            len(item["rubrics"]),
+            self.score_per_rubric,
+            criterion,
+            rubric_id=r_id,
+        )
+        return {
+            "grade": grade,
+            "success": success,
+        }
+
+    def _finalize(self, item, input_text, grades):
         _item = item.copy()
+        _item["judge_input"] = input_text
+        _item["grades"] = grades
+
+        _item["normalized_score_sum"] = sum(
+            v["grade"]["normalized_item_score"]
+            for v in grades.values()
+            if v["success"]
+        )
+
+        return _item
+
+    def judge(self, item):
         rubrics = item["rubrics"]
         grades = {}
 
-        input_text_prefix = ""
+        input_text = None
         for r_id, rubric in enumerate(rubrics):
             if r_id == 0:
-                instruction = f"{self.prompt_templates['instruction']}\n"
-
-                input_text_prefix += (
-                    self.prompt_templates["model_answer_template"].format(
-                        answer=item["model_output"],
-                        score_per_rubric=self.score_per_rubric,
-                    )
-                    + "\n"
-                )
+                instruction, input_text_prefix = self._answer_prefix(item)
 
-                n_cache_toks = self.model.count_tokens(input_text_prefix)
-                if n_cache_toks < 1024:
+                if not self._cacheable(input_text_prefix):
                     cache = None
 
                 else:
                     cache = self.model.client.caches.create(
                         model=self.model.model_name,
-                        config=types.CreateCachedContentConfig(
-                            display_name="judge_prompt_and_model_answer",
-                            system_instruction=instruction,
-                            contents=[input_text_prefix],
+                        config=self._cache_config(
+                            instruction, input_text_prefix
                         ),
                     )
 
             criterion = f"{rubric} (score: {self.score_per_rubric})"
+            input_text = self._rubric_input(
+                instruction, input_text_prefix, criterion, cache
+            )
 
             if cache is not None:
-                input_text = (
-                    self.prompt_templates["rubric_template"]
-                    .format(rubrics_with_score=criterion)
-                    .strip()
-                )
                 judge_output = self.model.generate(
                     prompt=input_text,
                     cache=cache,
                 )
 
             else:
-                input_text = (
-                    instruction
-                    + input_text_prefix
-                    + self.prompt_templates["rubric_template"]
-                    .format(rubrics_with_score=criterion)
-                    .strip()
-                )
                 judge_output = self.model.generate(
                     prompt=input_text,
                 )
 
-            grade, success = self._parse_answer_judge(
-                judge_output,
-                item["score"],
-                len(rubrics),
-                self.score_per_rubric,
-                criterion,
-                rubric_id=r_id,
+            grades[str(r_id)] = self._grade(
+                item, judge_output, criterion, r_id
             )
-            grades[str(r_id)] = {
-                "grade": grade,
-                "success": success,
-            }
 
-        _item["judge_input"] = input_text
-        _item["grades"] = grades
+        return self._finalize(item, input_text, grades)
 
-        _item["normalized_score_sum"] = sum(
-            v["grade"]["normalized_item_score"]
-            for v in grades.values()
-            if v["success"]
+    async def ajudge(self, item):
+        rubrics = item["rubrics"]
+        grades = {}
+
+        input_text = None
+        for r_id, rubric in enumerate(rubrics):
+            if r_id == 0:
+                instruction, input_text_prefix = self._answer_prefix(item)
+
+                if not self._cacheable(input_text_prefix):
+                    cache = None
+
+                else:
+                    cache = await self.model.client.aio.caches.create(
+                        model=self.model.model_name,
+                        config=self._cache_config(
+                            instruction, input_text_prefix
+                        ),
+                    )
+
+            criterion = f"{rubric} (score: {self.score_per_rubric})"
+            input_text = self._rubric_input(
+                instruction, input_text_prefix, criterion, cache
+            )
+
+            if cache is not None:
+                judge_output = await self.model.agenerate(
+                    prompt=input_text,
+                    cache=cache,
+                )
+
+            else:
+                judge_output = await self.model.agenerate(
+                    prompt=input_text,
+                )
+
+            grades[str(r_id)] = self._grade(
+                item, judge_output, criterion, r_id
+            )
+
+        return self._finalize(item, input_text, grades)
+
+    def judge_batch(self, items, **batch_settings):
+        # Batch requests cannot reference a context cache, so every rubric
+        # prompt carries the full answer.
+        prompts, keys = [], []
+        for i, item in enumerate(items):
+            instruction, input_text_prefix = self._answer_prefix(item)
+            for r_id, rubric in enumerate(item["rubrics"]):
+                criterion = f"{rubric} (score: {self.score_per_rubric})"
+                prompts.append(
+                    self._rubric_input(
+                        instruction, input_text_prefix, criterion, None
+                    )
+                )
+                keys.append((i, r_id, criterion))
+
+        outputs = generate_batch(
+            self.model,
+            prompts,
+            custom_ids=[f"{i}-{r_id}" for i, r_id, _ in keys],
+            **batch_settings,
         )
 
-        return _item
+        grades = [{} for _ in items]
+        inputs = [None] * len(items)
+        for (i, r_id, criterion), input_text, judge_output in zip(
+            keys, prompts, outputs
+        ):
+            if isinstance(judge_output, Exception):
+                judge_output = None
+            grades[i][str(r_id)] = self._grade(
+                items[i], judge_output, criterion, r_id
+            )
+            inputs[i] = input_text
+
+        return [
+            self._finalize(item, inputs[i], grades[i])
+            for i, item in enumerate(items)
+        ]
 
     def __call__(self, item):
         return self.judge(item)
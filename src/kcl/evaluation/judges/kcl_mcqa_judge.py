@@ -1,5 +1,7 @@
 import re
+from collections import Counter
 from functools import partial
+from math import comb
 from typing import Any, Dict, List, Optional
 
 from tqdm.auto import tqdm
@@ -7,6 +9,13 @@ from tqdm.auto import tqdm
 tqdm = partial(tqdm, dynamic_ncols=True)
 
 
+def pass_at_k(n: int, c: int, k: int) -> float:
+    # Unbiased estimator from n samples with c correct.
+    if n - c < k:
+        return 1.0
+    return 1.0 - comb(n - c, k) / comb(n, k)
+
+
 def _build_choice_re(choices: str) -> str:
 
     upper = "".join(sorted(set(c for c in choices.upper())))
@@ -20,10 +29,12 @@ class KCLMCQAEval:
         self,
         *,
         choices: str = "ABCDE",
+        pass_at_k: tuple = (1,),
         debug: bool = False,
     ):
 
         self.choices = choices
+        self.pass_at_k = tuple(pass_at_k)
         self.debug = debug
 
         choice_re = _build_choice_re(self.choices)
@@ -87,8 +98,33 @@ class KCLMCQAEval:
 
         item["right"] = right
         item["normalized_score_sum"] = int(right)
+
+        if item.get("model_outputs"):
+            self._judge_samples(item, gt)
         return item
 
+    def _judge_samples(self, item, gt):
+        preds = [self._extract_answer(str(o)) for o in item["model_outputs"]]
+        n = len(preds)
+        n_right = sum(p is not None and p == gt for p in preds)
+
+        # Counter keeps insertion order, so ties go to the earliest sample.
+        votes = Counter(p for p in preds if p is not None)
+        majority = votes.most_common(1)[0][0] if votes else None
+
+        metrics = {"majority_vote": int(majority == gt)}
+        for k in sorted({k for k in self.pass_at_k if k <= n} | {n}):
+            metrics[f"pass@{k}"] = round(pass_at_k(n, n_right, k), 6)
+
+        item["predictions"] = preds
+        item["metrics"] = metrics
+
+    async def ajudge(self, item):
+        return self.judge(item)
+
+    def judge_batch(self, items, **batch_settings):
+        return [self.judge(item) for item in items]
+
     def __call__(self, item):
         return self.judge(item)
 
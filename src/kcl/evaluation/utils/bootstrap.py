@@ -0,0 +1,29 @@
+import random
+import statistics
+
+N_RESAMPLES = 1000
+CONFIDENCE = 0.95
+
+
+def bootstrap_ci(
+    items, n_resamples=N_RESAMPLES, confidence=CONFIDENCE, seed=0
+):
+    # Percentile bootstrap of the score percentage. Questions are
+    # resampled as a whole, which is slightly conservative for stratified
+    # samples; strata with one question would otherwise add no variance.
+    if len(items) < 2:
+        return None
+    scores = [item["normalized_score_sum"] for item in items]
+    full = [item.get("score", 1) for item in items]
+
+    rng = random.Random(seed)
+    population = range(len(items))
+    estimates = []
+    for _ in range(n_resamples):
+        picks = rng.choices(population, k=len(items))
+        total = sum(full[i] for i in picks)
+        estimates.append(sum(scores[i] for i in picks) / total if total else 0)
+
+    cuts = statistics.quantiles(estimates, n=1000, method="inclusive")
+    tail = round((1 - confidence) / 2 * 1000)
+    return cuts[tail - 1], cuts[-tail]
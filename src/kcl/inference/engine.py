@@ -0,0 +1,60 @@
+import asyncio
+import weakref
+from functools import partial
+
+from tqdm.auto import tqdm
+
+tqdm = partial(tqdm, dynamic_ncols=True)
+
+DEFAULT_CONCURRENCY = 8
+
+
+class AsyncEngine:
+
+    def __init__(self, concurrency=None, default_concurrency=None):
+        self.concurrency = dict(concurrency or {})
+        self.default_concurrency = default_concurrency or DEFAULT_CONCURRENCY
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def limit_for(self, provider):
+        return self.concurrency.get(provider) or self.default_concurrency
+
+    def _semaphore(self, provider):
+        # Semaphores bind to the running loop, so they are kept per loop:
+        # concurrent amap calls on one loop share the provider limits, and
+        # a later asyncio.run gets fresh ones.
+        semaphores = self._semaphores.setdefault(
+            asyncio.get_running_loop(), {}
+        )
+        if provider not in semaphores:
+            semaphores[provider] = asyncio.Semaphore(self.limit_for(provider))
+        return semaphores[provider]
+
+    async def submit(self, provider, fn, *args):
+        async with self._semaphore(provider):
+            return await fn(*args)
+
+    async def amap(self, fn, items, provider, desc=None):
+        # provider is either one name for all items or a function of the
+        # item's arguments, for runs that mix several models.
+        items = list(items)
+        pbar = tqdm(total=len(items), desc=desc)
+
+        async def run_one(args):
+            name = provider(*args) if callable(provider) else provider
+            result = await self.submit(name, fn, *args)
+            pbar.update()
+            return result
+
+        try:
+            return await asyncio.gather(*(run_one(args) for args in items))
+        finally:
+            pbar.close()
+
+    def map(self, fn, items, provider, desc=None):
+        return asyncio.run(self.amap(fn, items, provider, desc=desc))
+
+
+async def aclose_model(model):
+    if hasattr(model, "aclose"):
+        await model.aclose()
@@ -1,7 +1,6 @@
+import asyncio
 import json
 import logging
-import random
-import time
 from collections import defaultdict
 from functools import partial
 from pathlib import Path
@@ -10,12 +9,47 @@ import hydra
 from hydra.core.hydra_config import HydraConfig
 from joblib import Parallel, delayed
 from loguru import logger
-from omegaconf import DictConfig
-from tenacity import retry, stop_after_attempt, wait_fixed
+from omegaconf import DictConfig, OmegaConf, open_dict
+from tenacity import retry, stop_after_attempt, wait_random_exponential
 from tqdm.auto import tqdm
 
+from kcl.inference.engine import AsyncEngine, aclose_model
+from kcl.inference.results import (
+    RESULT_FORMATS,
+    SAMPLE_ID,
+    JsonlWriter,
+    carry_over,
+    dataset_key,
+    enumerate_samples,
+    export_json,
+    export_parquet,
+    iter_jsonl,
+)
+from kcl.inference.scheduler import load_output_lengths, lpt_order
+from kcl.inference.workqueue import ROLES, WorkQueue, run_worker, wait_finished
 from kcl.models import get_model
+from kcl.models.batch import generate_batch
+from kcl.models.clients import client_stats, set_pool_size
+from kcl.models.prompt_cache import prompt_prefix
+from kcl.models.sampling import agenerate_n, generate_n
+from kcl.models.streaming import (
+    astream_n,
+    check_stream,
+    stream_n,
+    summarize_timings,
+)
+from kcl.models.tokenizer import (
+    add_token_counts,
+    estimated_chars_per_token,
+    prompt_budget,
+    set_chars_per_token,
+    token_counter,
+    update_calibration,
+)
+from kcl.models.usage import usage_markdown, usage_scope, usage_summary
+from kcl.models.wrapper import wrapper_stats
 from kcl.tasks import get_loader
+from kcl.tasks.truncation import fit_prompts
 
 MAX_RETRY = 5
 RETRY_WAIT_SEC = 10
@@ -27,37 +61,192 @@ def retry_log(retry_state):
     logger.warning(
         f"[Retry {retry_state.attempt_number}/{MAX_RETRY}] {retry_state.outcome.exception()}",
     )
-    base = RETRY_WAIT_SEC * (2**retry_state.attempt_number)
-    jitter = random.uniform(0, RETRY_WAIT_SEC)
-    time.sleep(base + jitter)
 
 
-def process(model, sample, task_name):
+# Full jitter spreads out workers that were throttled at the same moment.
+retry_policy = retry(
+    stop=stop_after_attempt(MAX_RETRY),
+    wait=wait_random_exponential(
+        multiplier=RETRY_WAIT_SEC, max=RETRY_WAIT_SEC * 2**MAX_RETRY
+    ),
+    before_sleep=retry_log,
+    reraise=True,
+)
+
+
+def make_record(sample, sample_id, out_text, error_msg=None, timings=None):
+    out = sample.copy()
+    out[SAMPLE_ID] = sample_id
+    if isinstance(out_text, list):
+        if len(out_text) > 1:
+            out["model_outputs"] = out_text
+        out_text = out_text[0]
+    out["model_output"] = out_text
+    if timings:
+        out["timing"] = timings[0]
+        if len(timings) > 1:
+            out["timings"] = timings
+    if error_msg is not None:
+        out["error"] = error_msg
+    return out
+
+
+def process(model, sample, task_name, sample_id, stream=False):
     try:
-        out_text = generate_sample(model, sample)
-        success = True
+        with (
+            usage_scope(task_name),
+            prompt_prefix(sample.get("prompt_prefix_len")),
+        ):
+            out_text, timings = generate_sample(model, sample, stream)
         error_msg = None
     except Exception as exc:
-        out_text = ""
-        success = False
+        out_text, timings = "", None
         error_msg = str(exc)
 
-    out = sample.copy()
-    out["model_output"] = out_text
-    if not success:
-        out["error"] = error_msg
+    return task_name, make_record(
+        sample, sample_id, out_text, error_msg, timings
+    )
 
-    return task_name, out
 
+async def aprocess(model, sample, task_name, sample_id, stream=False):
+    try:
+        with (
+            usage_scope(task_name),
+            prompt_prefix(sample.get("prompt_prefix_len")),
+        ):
+            out_text, timings = await agenerate_sample(model, sample, stream)
+        error_msg = None
+    except Exception as exc:
+        out_text, timings = "", None
+        error_msg = str(exc)
 
-@retry(
-    stop=stop_after_attempt(MAX_RETRY),
-    wait=wait_fixed(RETRY_WAIT_SEC),
-    before_sleep=retry_log,
-    reraise=True,
-)
-def generate_sample(model, sample):
-    return model.generate(sample["input_text"])
+    return task_name, make_record(
+        sample, sample_id, out_text, error_msg, timings
+    )
+
+
+def succeeded(record):
+    return "error" not in record and bool(record.get("model_output"))
+
+
+def process_and_save(
+    model, sample, task_name, sample_id, writers, stream=False
+):
+    task_name, out = process(model, sample, task_name, sample_id, stream)
+    writers[task_name].write(out)
+    return task_name, "error" not in out
+
+
+async def aprocess_and_save(
+    model, sample, task_name, sample_id, writers, stream=False
+):
+    task_name, out = await aprocess(
+        model, sample, task_name, sample_id, stream
+    )
+    writers[task_name].write(out)
+    return task_name, "error" not in out
+
+
+@retry_policy
+def generate_sample(model, sample, stream=False):
+    n = getattr(model, "num_samples", 1)
+    if stream:
+        results = stream_n(model, sample["input_text"], n)
+        return [text for text, _ in results], [t for _, t in results]
+    return generate_n(model, sample["input_text"], n), None
+
+
+@retry_policy
+async def agenerate_sample(model, sample, stream=False):
+    n = getattr(model, "num_samples", 1)
+    if stream:
+        results = await astream_n(model, sample["input_text"], n)
+        return [text for text, _ in results], [t for _, t in results]
+    return await agenerate_n(model, sample["input_text"], n), None
+
+
+def collect_timings(paths):
+    timings = []
+    for path in paths:
+        for record in iter_jsonl(path):
+            timings.extend(record.get("timings") or [record.get("timing")])
+    return [t for t in timings if t]
+
+
+async def run_async(engine, model, pending, writers, stream=False):
+    try:
+        return await engine.amap(
+            partial(aprocess_and_save, model, writers=writers, stream=stream),
+            [(s, t, i) for t, i, s in pending],
+            provider=model.provider,
+            desc="Processing samples",
+        )
+    finally:
+        await aclose_model(model)
+
+
+def run_batch(model, pending, writers, batch_cfg):
+    if not pending:
+        return
+
+    # Batch jobs have no n parameter, so each sample is submitted n times.
+    n = getattr(model, "num_samples", 1)
+    outputs = generate_batch(
+        model,
+        [s["input_text"] for _, _, s in pending for _ in range(n)],
+        custom_ids=[f"{t}-{i}-{k}" for t, i, _ in pending for k in range(n)],
+        **batch_cfg,
+    )
+    for j, (t, i, s) in enumerate(pending):
+        group = outputs[j * n : (j + 1) * n]
+        errors = [o for o in group if isinstance(o, Exception)]
+        if errors:
+            writers[t].write(make_record(s, i, "", str(errors[0])))
+        else:
+            writers[t].write(make_record(s, i, group))
+
+
+def run_queue(
+    queue,
+    role,
+    model,
+    pending,
+    writers,
+    n_jobs,
+    stream=False,
+    poll_interval=10,
+):
+    samples = {(t, i): s for t, i, s in pending}
+
+    if role in ("all", "producer"):
+        added = queue.enqueue([(t, i) for t, i, _ in pending])
+        logger.info(f"Queued {added} new samples: {queue.counts()}")
+
+    if role in ("all", "worker"):
+
+        def handle(task_name, sample_id):
+            _, record = process(
+                model,
+                samples[(task_name, sample_id)],
+                task_name,
+                sample_id,
+                stream,
+            )
+            return writers[task_name].compact(record)
+
+        run_worker(queue, handle, n_jobs, poll_interval)
+
+    if role in ("all", "merge"):
+        wait_finished(queue, poll_interval)
+        for task_name, sample_id, record in queue.results():
+            if record is None:
+                record = make_record(
+                    samples[(task_name, sample_id)],
+                    sample_id,
+                    "",
+                    f"Lease expired {queue.max_attempts} times",
+                )
+            writers[task_name].write(record)
 
 
 @hydra.main(version_base=None, config_path=None, config_name=None)
@@ -66,53 +255,212 @@ def main(cfg: DictConfig):
     logging.getLogger("httpx").propagate = cfg.verbose
     logging.getLogger("google_genai.models").propagate = cfg.verbose
 
-    model_kwargs = cfg.get("model_kwargs", {})
-    model = get_model(cfg.model_name, **model_kwargs)
+    set_pool_size(
+        cfg.get("n_jobs", 1), *(cfg.get("concurrency") or {}).values()
+    )
+    model_kwargs = {
+        "num_samples": cfg.get("num_samples", 1),
+        **cfg.get("model_kwargs", {}),
+    }
+    model = get_model(
+        cfg.model_name,
+        rate_limit=cfg.get("rate_limit"),
+        cache=cfg.get("cache"),
+        hedge=cfg.get("hedge"),
+        **model_kwargs,
+    )
+    if cfg.get("stream", False):
+        check_stream(model)
 
+    set_chars_per_token(cfg.get("chars_per_token"))
     loader = get_loader(cfg.tasks, **cfg.tasks_kwargs)
-    task = loader.load()
+    counter = token_counter(model)
+    task = add_token_counts(loader.load(), counter)
+    budget = prompt_budget(model, cfg.get("max_prompt_tokens"))
+    if budget is not None:
+        task = fit_prompts(loader, task, counter, budget)
 
-    flat_samples = [(task._info.config_name, sample) for sample in task]
+    flat_samples = [
+        (task._info.config_name, sample_id, sample)
+        for sample_id, sample in enumerate_samples(task)
+    ]
 
     run_dir = Path(HydraConfig.get().runtime.output_dir)
     save_root = run_dir / "results"
     cfg_name = HydraConfig.get().job.config_name
 
+    chars_per_token = estimated_chars_per_token(model)
+    if chars_per_token is not None:
+        # Saved with the run config, so that running it again counts and
+        # cuts the prompts the same way.
+        with open_dict(cfg):
+            cfg.chars_per_token = chars_per_token
+        OmegaConf.save(cfg, run_dir / ".hydra" / "config.yaml")
+
+    result_format = cfg.get("result_format", "json")
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(
+            f"Unknown result_format: {result_format!r}. Available: {RESULT_FORMATS}"
+        )
+    # Compact formats keep only what the dataset does not have; rows are
+    # joined back by sample_id when exported or evaluated.
+    exclude = task.column_names if result_format != "json" else ()
+
+    writers = {}
+    for task_name in dict.fromkeys(t for t, _, _ in flat_samples):
+        writers[task_name] = JsonlWriter(
+            save_root / task_name / f"{cfg_name}.jsonl", exclude=exclude
+        )
+
+    resume_from = cfg.get("resume_from")
+    retry_failed_from = cfg.get("retry_failed_from")
+    if resume_from and retry_failed_from:
+        raise ValueError(
+            "resume_from and retry_failed_from cannot be used together"
+        )
+
+    done = defaultdict(set)
+    if resume_from:
+        for task_name, writer in writers.items():
+            done[task_name] = carry_over(resume_from, task_name, writer)
+            logger.info(
+                f"Resuming {task_name}: {len(done[task_name])} samples already done in {resume_from}"
+            )
+    elif retry_failed_from:
+        for task_name, writer in writers.items():
+            done[task_name] = carry_over(
+                retry_failed_from, task_name, writer, keep=succeeded
+            )
+            logger.info(
+                f"Retrying {task_name}: keeping {len(done[task_name])} successful samples from {retry_failed_from}"
+            )
+
+    pending = [(t, i, s) for t, i, s in flat_samples if i not in done[t]]
+
+    # Results are exported in sample_id order whatever the schedule.
+    if cfg.get("schedule", "lpt") == "lpt":
+        history_from = cfg.get("cost_history_from")
+        output_lengths = (
+            load_output_lengths(history_from, writers) if history_from else {}
+        )
+        pending = lpt_order(pending, output_lengths)
+
     n_jobs = cfg.get("n_jobs", 1)
-    if n_jobs > 1:
-        results = Parallel(n_jobs=n_jobs, backend="threading")(
-            delayed(process)(model, s, t)
-            for t, s in tqdm(
-                flat_samples,
-                desc="Processing samples",
-                total=len(flat_samples),
+    engine_name = cfg.get("engine", "threading")
+    stream = cfg.get("stream", False)
+
+    queue_cfg = cfg.get("queue") or {}
+    queue = None
+    queue_role = queue_cfg.get("role", "all")
+    if queue_cfg.get("path"):
+        if queue_role not in ROLES:
+            raise ValueError(
+                f"Unknown queue role: {queue_role!r}. Available: {ROLES}"
             )
+        if resume_from or retry_failed_from:
+            raise ValueError(
+                "resume_from and retry_failed_from cannot be used with a "
+                "queue; start workers on the same queue to resume it"
+            )
+        if engine_name == "batch":
+            raise ValueError("engine=batch cannot be used with a queue")
+        queue = WorkQueue(
+            queue_cfg.path,
+            lease_seconds=queue_cfg.get("lease_seconds", 600),
+            max_attempts=queue_cfg.get("max_attempts", 3),
         )
-    else:
-        results = [
-            process(model, s, t)
-            for t, s in tqdm(
-                flat_samples,
-                desc="Processing samples",
-                total=len(flat_samples),
+        queue.check_meta(
+            {
+                "model_name": cfg.model_name,
+                "tasks": cfg.tasks,
+                "num_samples": cfg.get("num_samples", 1),
+                "result_format": result_format,
+                "dataset_key": dataset_key(task),
+            }
+        )
+
+    try:
+        if queue is not None:
+            run_queue(
+                queue,
+                queue_role,
+                model,
+                pending,
+                writers,
+                n_jobs,
+                stream,
+                queue_cfg.get("poll_interval", 10),
+            )
+        elif engine_name == "batch":
+            batch_cfg = {
+                k: v for k, v in cfg.get("batch", {}).items() if v is not None
+            }
+            run_batch(model, pending, writers, batch_cfg)
+        elif engine_name == "async":
+            engine = AsyncEngine(
+                concurrency=cfg.get("concurrency"),
+                default_concurrency=n_jobs,
+            )
+            asyncio.run(run_async(engine, model, pending, writers, stream))
+        elif n_jobs > 1:
+            Parallel(n_jobs=n_jobs, backend="threading")(
+                delayed(process_and_save)(model, s, t, i, writers, stream)
+                for t, i, s in tqdm(
+                    pending,
+                    desc="Processing samples",
+                    total=len(pending),
+                )
             )
-        ]
+        else:
+            for t, i, s in tqdm(
+                pending,
+                desc="Processing samples",
+                total=len(pending),
+            ):
+                process_and_save(model, s, t, i, writers, stream)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    run_stats = wrapper_stats(model)
+    clients = client_stats()
+    if clients:
+        run_stats["clients"] = clients
+    if stream and engine_name != "batch":
+        timings = collect_timings(w.path for w in writers.values())
+        if timings:
+            run_stats["streaming"] = summarize_timings(timings)
+    usage = usage_summary(model)
+    update_calibration(model)
+    if usage:
+        run_stats["usage"] = usage
+    if chars_per_token is not None:
+        run_stats["chars_per_token"] = chars_per_token
+        (save_root / "a_usage_summary.md").write_text(usage_markdown(usage))
+    if run_stats:
+        logger.info(f"Run stats: {run_stats}")
+        (run_dir / "run_stats.json").write_text(
+            json.dumps(run_stats, ensure_ascii=False, indent=4)
+        )
 
     if hasattr(model, "cleanup"):
         logger.info("Cleaning up model resources...")
         model.cleanup()
 
-    by_task = defaultdict(list)
-    for task_name, out in results:
-        by_task[task_name].append(out)
+    if queue is not None and queue_role not in ("all", "merge"):
+        return
 
-    for task_name, samples in by_task.items():
-        task_dir = save_root / task_name
-        task_dir.mkdir(parents=True, exist_ok=True)
-        out_file = task_dir / f"{cfg_name}.json"
-        out_file.write_text(json.dumps(samples, ensure_ascii=False, indent=4))
-
-        logger.info(f"Saved {task_name}: {len(samples)} → {out_file}")
+    for task_name, writer in writers.items():
+        if result_format != "json":
+            out_file = writer.path.with_suffix(".parquet")
+            n_samples = export_parquet(writer.path, out_file, task)
+            logger.info(f"Saved {task_name}: {n_samples} → {out_file}")
+        if result_format != "parquet":
+            out_file = writer.path.with_suffix(".json")
+            n_samples = export_json(
+                writer.path, out_file, task if exclude else None
+            )
+            logger.info(f"Saved {task_name}: {n_samples} → {out_file}")
 
 
 if __name__ == "__main__":
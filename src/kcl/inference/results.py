@@ -0,0 +1,272 @@
+import hashlib
+import json
+import threading
+from pathlib import Path
+
+from loguru import logger
+
+SAMPLE_ID = "sample_id"
+PRECEDENT_CUTS = "precedent_cuts"
+# Dataset columns compact records keep: the row they belong to, and how
+# its prompt was cut and counted for the model.
+RECORD_COLUMNS = {SAMPLE_ID, PRECEDENT_CUTS, "n_prompt_tokens"}
+# Parquet column listing the keys a record did not have, so that they are
+# told apart from keys that were None.
+MISSING_KEYS = "_kcl_missing_keys"
+RESULT_FORMATS = ("json", "parquet", "both")
+
+
+class JsonlWriter:
+
+    def __init__(self, path, exclude=()):
+        self.path = Path(path)
+        # Dataset columns left out when results are joined back later.
+        self.exclude = set(exclude) - RECORD_COLUMNS
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def compact(self, record):
+        if not self.exclude:
+            return record
+        return {k: v for k, v in record.items() if k not in self.exclude}
+
+    def write(self, record):
+        line = json.dumps(self.compact(record), ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write leaves a partial last line behind.
+                logger.warning(f"Skipping unreadable line {line_no} in {path}")
+
+
+def find_results_file(run_dir, task_name):
+    task_dir = Path(run_dir) / "results" / task_name
+    for pattern in ("*.jsonl", "*.json"):
+        found = sorted(task_dir.glob(pattern))
+        if found:
+            return found[0]
+    return None
+
+
+def iter_results(run_dir, task_name):
+    path = find_results_file(run_dir, task_name)
+    if path is None:
+        logger.warning(f"No previous results for {task_name} in {run_dir}")
+        return
+
+    if path.suffix == ".jsonl":
+        yield from iter_jsonl(path)
+        return
+
+    for idx, record in enumerate(json.loads(path.read_text())):
+        # Exports written before checkpointing are in dataset order.
+        record.setdefault(SAMPLE_ID, idx)
+        yield record
+
+
+def carry_over(run_dir, task_name, writer, keep=None):
+    prev = find_results_file(run_dir, task_name)
+    same_file = prev is not None and prev.resolve() == writer.path.resolve()
+
+    done = set()
+    for record in iter_results(run_dir, task_name):
+        if keep is not None and not keep(record):
+            continue
+        if not same_file:
+            writer.write(record)
+        done.add(record[SAMPLE_ID])
+    return done
+
+
+def _latest_offsets(jsonl_path):
+    # Byte offset of the last record of each sample_id.
+    offsets = {}
+    with open(jsonl_path, "rb") as f:
+        offset = f.tell()
+        for line in iter(f.readline, b""):
+            try:
+                sample_id = json.loads(line)[SAMPLE_ID]
+            except (json.JSONDecodeError, KeyError):
+                pass
+            else:
+                offsets[sample_id] = offset
+            offset = f.tell()
+    return offsets
+
+
+def enumerate_samples(dataset):
+    # (sample_id, sample) pairs; sample_id is the row of the full dataset.
+    if SAMPLE_ID in dataset.column_names:
+        return zip(dataset[SAMPLE_ID], dataset)
+    return enumerate(dataset)
+
+
+def row_index(dataset):
+    # Sampled datasets keep each row's sample_id in the full dataset.
+    if dataset is None or SAMPLE_ID not in dataset.column_names:
+        return None
+    return {sample_id: row for row, sample_id in enumerate(dataset[SAMPLE_ID])}
+
+
+def join_row(dataset, record, rows=None):
+    if dataset is None:
+        return record
+    row = record[SAMPLE_ID] if rows is None else rows[record[SAMPLE_ID]]
+    return {**dataset[row], **record}
+
+
+def export_json(jsonl_path, json_path, dataset=None):
+    # With dataset, compact records are joined back to their rows.
+    jsonl_path = Path(jsonl_path)
+    offsets = _latest_offsets(jsonl_path)
+    rows = row_index(dataset)
+
+    # Records are looked up one at a time so memory stays flat.
+    with (
+        open(jsonl_path, "rb") as src,
+        open(json_path, "w", encoding="utf-8") as dst,
+    ):
+        if not offsets:
+            dst.write("[]")
+            return 0
+
+        dst.write("[\n")
+        for n, sample_id in enumerate(sorted(offsets)):
+            src.seek(offsets[sample_id])
+            record = join_row(dataset, json.loads(src.readline()), rows)
+            text = json.dumps(record, ensure_ascii=False, indent=4)
+            if n:
+                dst.write(",\n")
+            dst.write("\n".join("    " + ln for ln in text.splitlines()))
+        dst.write("\n]")
+
+    return len(offsets)
+
+
+def dataset_key(dataset):
+    # Identifies the rendered prompts that sample_ids index into.
+    digest = hashlib.sha256()
+    for text in dataset["input_text"]:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def _arrow_column(values):
+    import pyarrow as pa
+
+    # Nested values (timings, grades, metrics) and columns of mixed types
+    # are kept as JSON text.
+    if not any(isinstance(v, (dict, list)) for v in values):
+        try:
+            return pa.array(values), False
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+    encoded = [
+        None if v is None else json.dumps(v, ensure_ascii=False)
+        for v in values
+    ]
+    return pa.array(encoded, type=pa.string()), True
+
+
+def write_parquet(records, path, dataset):
+    # Only what is not already in the dataset is stored: sample_id,
+    # precedent cuts, outputs, errors, timings and judge results. zstd
+    # keeps long model outputs small.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    exclude = set(dataset.column_names) - RECORD_COLUMNS
+    rows = [
+        {k: v for k, v in record.items() if k not in exclude}
+        for record in records
+    ]
+    names = list(dict.fromkeys(k for row in rows for k in row))
+
+    arrays, json_columns = [], []
+    for name in names:
+        array, as_json = _arrow_column([row.get(name) for row in rows])
+        arrays.append(array)
+        if as_json:
+            json_columns.append(name)
+    arrays.append(
+        pa.array(
+            [[k for k in names if k not in row] for row in rows],
+            type=pa.list_(pa.string()),
+        )
+    )
+
+    table = pa.Table.from_arrays(arrays, names=[*names, MISSING_KEYS])
+    table = table.replace_schema_metadata(
+        {
+            "kcl_json_columns": json.dumps(json_columns),
+            "kcl_dataset_key": dataset_key(dataset),
+        }
+    )
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, path, compression="zstd")
+    return len(rows)
+
+
+def export_parquet(jsonl_path, parquet_path, dataset):
+    jsonl_path = Path(jsonl_path)
+    offsets = _latest_offsets(jsonl_path)
+    records = []
+    with open(jsonl_path, "rb") as src:
+        for sample_id in sorted(offsets):
+            src.seek(offsets[sample_id])
+            records.append(json.loads(src.readline()))
+    return write_parquet(records, parquet_path, dataset)
+
+
+def iter_parquet(path, dataset=None):
+    # Records are joined to their dataset rows one at a time, as they are
+    # read.
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(path)
+    if MISSING_KEYS not in parquet.schema_arrow.names:
+        raise ValueError(
+            f"{path} has no {MISSING_KEYS} column; export it again from "
+            "its .jsonl file"
+        )
+    metadata = parquet.schema_arrow.metadata or {}
+    json_columns = json.loads(metadata.get(b"kcl_json_columns", b"[]"))
+    expected = metadata.get(b"kcl_dataset_key", b"").decode()
+    if dataset is not None and expected and expected != dataset_key(dataset):
+        raise ValueError(
+            f"{path} was written for a different rendering of the dataset; "
+            "load the task with the tasks_kwargs of the run"
+        )
+
+    rows = row_index(dataset)
+    for batch in parquet.iter_batches():
+        for record in batch.to_pylist():
+            for name in json_columns:
+                if record[name] is not None:
+                    record[name] = json.loads(record[name])
+            missing = set(record.pop(MISSING_KEYS))
+            record = {k: v for k, v in record.items() if k not in missing}
+            yield join_row(dataset, record, rows)
@@ -0,0 +1,53 @@
+from collections import defaultdict
+
+from loguru import logger
+
+from kcl.inference.results import SAMPLE_ID, iter_results
+from kcl.models.tokenizer import estimate_tokens
+
+# A prompt token costs far less than a generated one: the prompt is
+# prefilled in parallel while the output is decoded token by token.
+PROMPT_WEIGHT = 0.02
+
+
+def load_output_lengths(run_dir, task_names):
+    lengths = {}
+    for task_name in task_names:
+        for record in iter_results(run_dir, task_name):
+            if record.get("model_output"):
+                lengths[(task_name, record[SAMPLE_ID])] = estimate_tokens(
+                    record["model_output"]
+                )
+    logger.info(f"Loaded {len(lengths)} output lengths from {run_dir}")
+    return lengths
+
+
+def prompt_tokens(sample):
+    # n_prompt_tokens is precomputed per dataset by add_token_counts.
+    if sample.get("n_prompt_tokens") is not None:
+        return sample["n_prompt_tokens"]
+    return estimate_tokens(sample["input_text"])
+
+
+def estimate_costs(pending, output_lengths=None):
+    output_lengths = output_lengths or {}
+
+    # Samples missing from the history get their task's mean output length.
+    by_task = defaultdict(list)
+    for (task_name, _), length in output_lengths.items():
+        by_task[task_name].append(length)
+    task_means = {t: sum(v) / len(v) for t, v in by_task.items()}
+
+    return [
+        PROMPT_WEIGHT * prompt_tokens(sample)
+        + output_lengths.get((t, i), task_means.get(t, 0.0))
+        for t, i, sample in pending
+    ]
+
+
+def lpt_order(pending, output_lengths=None):
+    # Longest processing time first: the expensive samples start while
+    # the cheap ones fill in around them, instead of trailing at the end.
+    costs = estimate_costs(pending, output_lengths)
+    order = sorted(range(len(pending)), key=lambda j: costs[j], reverse=True)
+    return [pending[j] for j in order]
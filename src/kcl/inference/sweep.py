@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+
+import hydra
+import yaml
+from hydra.core.hydra_config import HydraConfig
+from loguru import logger
+from omegaconf import DictConfig, OmegaConf
+
+from kcl.inference.engine import AsyncEngine, aclose_model
+from kcl.inference.infer import aprocess_and_save
+from kcl.inference.results import (
+    JsonlWriter,
+    enumerate_samples,
+    export_json,
+)
+from kcl.inference.scheduler import estimate_costs
+from kcl.models import get_model
+from kcl.models.clients import client_stats, set_pool_size
+from kcl.models.streaming import check_stream
+from kcl.models.tokenizer import (
+    add_token_counts,
+    estimated_chars_per_token,
+    prompt_budget,
+    set_chars_per_token,
+    token_counter,
+    update_calibration,
+)
+from kcl.models.usage import usage_summary
+from kcl.models.wrapper import wrapper_stats
+from kcl.tasks import get_loader
+from kcl.tasks.truncation import fit_prompts
+
+
+def setting_name(tasks_kwargs):
+    return "_".join(f"{k}-{v}" for k, v in tasks_kwargs.items()) or "default"
+
+
+def write_run_config(run_dir, run_cfg):
+    # eval.py reads tasks and model_name from here, as for a single run.
+    hydra_dir = run_dir / ".hydra"
+    hydra_dir.mkdir(parents=True, exist_ok=True)
+    (hydra_dir / "config.yaml").write_text(
+        yaml.safe_dump(run_cfg, allow_unicode=True, sort_keys=False)
+    )
+
+
+async def run_sweep(engine, models, jobs, stream=False):
+    try:
+        return await engine.amap(
+            lambda model, s, t, i, writers: aprocess_and_save(
+                model, s, t, i, writers, stream
+            ),
+            jobs,
+            provider=lambda model, *_: model.provider,
+            desc="Sweeping",
+        )
+    finally:
+        for model in models.values():
+            await aclose_model(model)
+
+
+@hydra.main(version_base=None, config_path=None, config_name=None)
+def main(cfg: DictConfig):
+
+    logging.getLogger("httpx").propagate = cfg.verbose
+    logging.getLogger("google_genai.models").propagate = cfg.verbose
+
+    sweep_dir = Path(HydraConfig.get().runtime.output_dir)
+    output_root = Path(cfg.get("output_root", "outputs_infer"))
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+    num_samples = cfg.get("num_samples", 1)
+    stream = cfg.get("stream", False)
+    per_model_kwargs = {}
+    if cfg.get("model_kwargs"):
+        per_model_kwargs = OmegaConf.to_container(cfg.model_kwargs)
+
+    set_pool_size(
+        cfg.get("n_jobs", 1), *(cfg.get("concurrency") or {}).values()
+    )
+
+    set_chars_per_token(cfg.get("chars_per_token"))
+    # One client (and rate limiter) per model, shared by all its runs.
+    models = {}
+    for model_name in cfg.model_names:
+        model_kwargs = {
+            "num_samples": num_samples,
+            **per_model_kwargs.get(model_name, {}),
+        }
+        models[model_name] = get_model(
+            model_name,
+            rate_limit=cfg.get("rate_limit"),
+            cache=cfg.get("cache"),
+            hedge=cfg.get("hedge"),
+            **model_kwargs,
+        )
+        if stream:
+            check_stream(models[model_name])
+
+    writers = []
+    jobs = []
+    for tasks in cfg.tasks:
+        for tasks_kwargs in cfg.tasks_kwargs:
+            tasks_kwargs = OmegaConf.to_container(tasks_kwargs)
+
+            # Rendered once and shared by every model; only prompts over
+            # a model's budget are rendered again for it.
+            loader = get_loader(tasks, **tasks_kwargs)
+            task = loader.load()
+            task_name = task._info.config_name
+
+            for model_name, model in models.items():
+                counter = token_counter(model)
+                model_task = add_token_counts(task, counter)
+                budget = prompt_budget(model, cfg.get("max_prompt_tokens"))
+                if budget is not None:
+                    model_task = fit_prompts(
+                        loader, model_task, counter, budget
+                    )
+                samples = list(enumerate_samples(model_task))
+                run_dir = (
+                    output_root
+                    / tasks
+                    / model_name
+                    / f"{timestamp}_{setting_name(tasks_kwargs)}"
+                )
+                write_run_config(
+                    run_dir,
+                    {
+                        "model_name": model_name,
+                        "model_kwargs": per_model_kwargs.get(model_name, {}),
+                        "tasks": tasks,
+                        "tasks_kwargs": tasks_kwargs,
+                        "num_samples": num_samples,
+                        "max_prompt_tokens": cfg.get("max_prompt_tokens"),
+                        # So that a rerun counts and cuts prompts the same.
+                        "chars_per_token": estimated_chars_per_token(model),
+                        "stream": stream,
+                        "sweep_dir": str(sweep_dir),
+                    },
+                )
+                run_writers = {
+                    task_name: JsonlWriter(
+                        run_dir / "results" / task_name / f"{tasks}.jsonl"
+                    )
+                }
+                writers.extend(run_writers.values())
+                jobs.extend(
+                    (model, sample, task_name, sample_id, run_writers)
+                    for sample_id, sample in samples
+                )
+
+    logger.info(
+        f"Sweeping {len(models)} models over {len(writers) // len(models)} "
+        f"task settings: {len(jobs)} requests"
+    )
+
+    if cfg.get("schedule", "lpt") == "lpt":
+        costs = estimate_costs([(t, i, s) for _, s, t, i, _ in jobs])
+        order = sorted(range(len(jobs)), key=lambda j: costs[j], reverse=True)
+        jobs = [jobs[j] for j in order]
+
+    engine = AsyncEngine(
+        concurrency=cfg.get("concurrency"),
+        default_concurrency=cfg.get("n_jobs", 1),
+    )
+    try:
+        asyncio.run(run_sweep(engine, models, jobs, stream))
+    finally:
+        for writer in writers:
+            writer.close()
+
+    run_stats = {}
+    for model_name, model in models.items():
+        stats = wrapper_stats(model)
+        chars_per_token = estimated_chars_per_token(model)
+        if chars_per_token is not None:
+            stats["chars_per_token"] = chars_per_token
+        usage = usage_summary(model)
+        update_calibration(model)
+        if usage:
+            stats["usage"] = usage
+        if stats:
+            run_stats[model_name] = stats
+        if hasattr(model, "cleanup"):
+            model.cleanup()
+    clients = client_stats()
+    if clients:
+        run_stats["clients"] = clients
+    if run_stats:
+        (sweep_dir / "run_stats.json").write_text(
+            json.dumps(run_stats, ensure_ascii=False, indent=4)
+        )
+
+    for writer in writers:
+        out_file = writer.path.with_suffix(".json")
+        n_samples = export_json(writer.path, out_file)
+        logger.info(f"Saved {n_samples} → {out_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+from joblib import Parallel, delayed
+from loguru import logger
+from tqdm.auto import tqdm
+
+ROLES = ("all", "producer", "worker", "merge")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    task TEXT NOT NULL,
+    sample_id INTEGER NOT NULL,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    record TEXT,
+    finished_at REAL,
+    PRIMARY KEY (task, sample_id)
+);
+CREATE INDEX IF NOT EXISTS items_state ON items (state, priority);
+"""
+
+
+class WorkQueue:
+
+    # A queue of (task, sample_id) items in one SQLite file that any
+    # number of processes can pull from; processes on other hosts only if
+    # the shared filesystem's file locks are reliable (see _connect). A worker leases items for lease_seconds and keeps
+    # renewing the lease while it runs; once a lease lapses (the worker
+    # crashed or lost the file) the item goes back to the queue, and
+    # after max_attempts lapsed leases it is given up as failed.
+
+    def __init__(self, path, lease_seconds=600, max_attempts=3):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        # One connection per thread. WAL needs shared memory, which other
+        # hosts cannot see, so the default rollback journal is kept. It
+        # relies on POSIX file locks, which NFS and SMB often do not
+        # implement reliably; SQLite can then corrupt the file.
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def check_meta(self, meta):
+        # Every process joining a queue must render the same samples for
+        # the same model; the first one to arrive sets the values.
+        with self._transaction() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)",
+                [(k, json.dumps(v)) for k, v in meta.items()],
+            )
+            stored = dict(db.execute("SELECT key, value FROM meta"))
+        for key, value in meta.items():
+            if json.loads(stored[key]) != value:
+                raise ValueError(
+                    f"Queue {self.path} was created with {key}="
+                    f"{json.loads(stored[key])!r}, not {value!r}"
+                )
+
+    def enqueue(self, items):
+        # Items already in the queue (done or not) are left as they are.
+        with self._transaction() as db:
+            start = db.execute(
+                "SELECT COALESCE(MAX(priority) + 1, 0) FROM items"
+            ).fetchone()[0]
+            before = db.total_changes
+            db.executemany(
+                "INSERT OR IGNORE INTO items (task, sample_id, priority) "
+                "VALUES (?, ?, ?)",
+                [
+                    (task, sample_id, start + n)
+                    for n, (task, sample_id) in enumerate(items)
+                ],
+            )
+            return db.total_changes - before
+
+    def lease(self, worker, n=1):
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE items SET state = 'failed', worker = NULL, "
+                "finished_at = ? WHERE state = 'leased' AND lease_until < ? "
+                "AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            items = db.execute(
+                "SELECT task, sample_id FROM items WHERE state = 'pending' "
+                "OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY priority LIMIT ?",
+                (now, n),
+            ).fetchall()
+            db.executemany(
+                "UPDATE items SET state = 'leased', worker = ?, "
+                "lease_until = ?, attempts = attempts + 1 "
+                "WHERE task = ? AND sample_id = ?",
+                [
+                    (worker, now + self.lease_seconds, task, sample_id)
+                    for task, sample_id in items
+                ],
+            )
+        return items
+
+    def renew(self, worker):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE items SET lease_until = ? "
+                "WHERE state = 'leased' AND worker = ?",
+                (time.time() + self.lease_seconds, worker),
+            )
+
+    def complete(self, task, sample_id, record, worker):
+        # A late duplicate (after a lapsed lease) does not overwrite the
+        # first record.
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE items SET state = 'done', record = ?, worker = ?, "
+                "lease_until = NULL, finished_at = ? "
+                "WHERE task = ? AND sample_id = ? AND state != 'done'",
+                (
+                    json.dumps(record, ensure_ascii=False),
+                    worker,
+                    time.time(),
+                    task,
+                    sample_id,
+                ),
+            )
+
+    def release(self, worker):
+        # Items of a worker that stops early go straight back to the
+        # queue, without counting as an attempt.
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE items SET state = 'pending', worker = NULL, "
+                "lease_until = NULL, attempts = attempts - 1 "
+                "WHERE state = 'leased' AND worker = ?",
+                (worker,),
+            )
+
+    def counts(self):
+        rows = self._connect().execute(
+            "SELECT state, COUNT(*) FROM items GROUP BY state"
+        )
+        return dict(rows)
+
+    def finished(self):
+        counts = self.counts()
+        return not counts.get("pending") and not counts.get("leased")
+
+    def results(self):
+        # (task, sample_id, record); record is None for failed items.
+        rows = self._connect().execute(
+            "SELECT task, sample_id, record FROM items "
+            "WHERE state IN ('done', 'failed') ORDER BY task, sample_id"
+        )
+        for task, sample_id, record in rows:
+            yield task, sample_id, (
+                None if record is None else json.loads(record)
+            )
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def run_worker(queue, handle, n_jobs=1, poll_interval=10):
+    # handle(task, sample_id) returns the record of one item. Each of the
+    # n_jobs threads leases one item at a time, so a slow sample never
+    # holds back others, and stops once every item is done.
+    worker = worker_id()
+    counts = queue.counts()
+    progress = tqdm(
+        total=counts.get("pending", 0) + counts.get("leased", 0),
+        desc=f"Processing samples ({worker})",
+    )
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(queue.lease_seconds / 3):
+            queue.renew(worker)
+
+    def loop():
+        while True:
+            items = queue.lease(worker)
+            if not items:
+                if queue.finished():
+                    return
+                # The rest is leased by others; a lapsed lease comes back.
+                time.sleep(poll_interval)
+                continue
+            for task, sample_id in items:
+                queue.complete(
+                    task, sample_id, handle(task, sample_id), worker
+                )
+                progress.update()
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        Parallel(n_jobs=n_jobs, backend="threading")(
+            delayed(loop)() for _ in range(n_jobs)
+        )
+    finally:
+        stop.set()
+        queue.release(worker)
+        progress.close()
+    logger.info(f"Worker {worker} finished {progress.n} samples")
+
+
+def wait_finished(queue, poll_interval=10):
+    while not queue.finished():
+        logger.info(f"Waiting for workers: {queue.counts()}")
+        time.sleep(poll_interval)
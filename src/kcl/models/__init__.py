@@ -1,66 +1,92 @@
-from loguru import logger
+import importlib
+
+from .cache import CachedModel, get_cache
+from .hedging import HedgedModel
+from .ratelimit import RateLimitedModel, get_limiter
+
+# Backends are imported when first selected, so that a run only pays for
+# the SDK it talks to and a missing SDK only matters to its own models.
+_BACKENDS = {
+    "ClaudeModel": ".claude",
+    "GeminiModel": ".gemini",
+    "OAIModel": ".oai",
+    "LocalModel": ".localmodel",
+    "InProcessModel": ".inprocess",
+}
 
-try:
-    from .claude import ClaudeModel
+API_MODEL_REGISTRY = {
+    "us.anthropic.claude-3-7-sonnet-20250219-v1:0": "ClaudeModel",
+    "us.anthropic.claude-sonnet-4-20250514-v1:0": "ClaudeModel",
+    "us.anthropic.claude-opus-4-20250514-v1:0": "ClaudeModel",
+    "gemini-2.5-flash": "GeminiModel",
+    "gemini-2.5-pro": "GeminiModel",
+    "gpt-4.1-2025-04-14": "OAIModel",
+    "o3-2025-04-16": "OAIModel",
+    "o4-mini-2025-04-16": "OAIModel",
+    "gpt-5-2025-08-07": "OAIModel",
+    "gpt-5-mini-2025-08-07": "OAIModel",
+}
 
-    _err_claude = None
-except Exception as e:
-    ClaudeModel = None
-    _err_claude = e
-    logger.warning(f"Failed to import ClaudeModel: {e}")
 
-try:
-    from .gemini import GeminiModel
+def _load_backend(name):
+    module = importlib.import_module(_BACKENDS[name], __name__)
+    return getattr(module, name)
 
-    _err_gemini = None
-except Exception as e:
-    GeminiModel = None
-    _err_gemini = e
-    logger.warning(f"Failed to import GeminiModel: {e}")
 
-try:
-    from .oai import OAIModel
+def __getattr__(name):
+    if name in _BACKENDS:
+        return _load_backend(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    _err_oai = None
-except Exception as e:
-    OAIModel = None
-    _err_oai = e
-    logger.warning(f"Failed to import OAIModel: {e}")
 
-try:
-    from .localmodel import LocalModel
+def _build_model(model_name, **kwargs):
 
-    _err_localmodel = None
-except Exception as e:
-    LocalModel = None
-    _err_localmodel = e
-    logger.warning(f"Failed to import LocalModel: {e}")
+    key = model_name.lower()
 
-API_MODEL_REGISTRY = {
-    "us.anthropic.claude-3-7-sonnet-20250219-v1:0": ClaudeModel,
-    "us.anthropic.claude-sonnet-4-20250514-v1:0": ClaudeModel,
-    "us.anthropic.claude-opus-4-20250514-v1:0": ClaudeModel,
-    "gemini-2.5-flash": GeminiModel,
-    "gemini-2.5-pro": GeminiModel,
-    "gpt-4.1-2025-04-14": OAIModel,
-    "o3-2025-04-16": OAIModel,
-    "o4-mini-2025-04-16": OAIModel,
-    "gpt-5-2025-08-07": OAIModel,
-    "gpt-5-mini-2025-08-07": OAIModel,
-}
+    # A local checkpoint loaded into this process instead of served.
+    if kwargs.pop("backend", None) == "inprocess":
+        return _load_backend("InProcessModel")(model_name, **kwargs)
 
+    if key not in API_MODEL_REGISTRY:
+        if "port" in kwargs or "url" in kwargs:
+            return _load_backend("LocalModel")(model_name, **kwargs)
 
-def get_model(model_name, **kwargs):
+        raise ValueError(f"Unsupported model name: {model_name}")
 
-    key = model_name.lower()
+    return _load_backend(API_MODEL_REGISTRY[key])(model_name, **kwargs)
 
-    if key not in API_MODEL_REGISTRY:
-        if "port" in kwargs:
-            return LocalModel(model_name, **kwargs)
 
-        raise ValueError(f"Unsupported model name: {model_name}")
+def _with_rate_limit(model, rate_limit):
+    if not rate_limit:
+        return model
+    limiter = get_limiter(model.provider, model.model_name, **rate_limit)
+    return RateLimitedModel(model, limiter)
+
+
+def get_model(model_name, rate_limit=None, cache=None, hedge=None, **kwargs):
+
+    model = _build_model(model_name, **kwargs)
+
+    rate_limit = {k: v for k, v in (rate_limit or {}).items() if v is not None}
+    model = _with_rate_limit(model, rate_limit)
+
+    # Outside the rate limiter, so that duplicate requests are charged too.
+    hedge = {k: v for k, v in (hedge or {}).items() if v is not None}
+    if hedge.get("percentile"):
+        alternate = None
+        region = hedge.pop("region", None)
+        if region is not None:
+            backend = _build_model(model_name, **{**kwargs, "region": region})
+            backend.usage_history = model.usage_history
+            alternate = _with_rate_limit(backend, rate_limit)
+        model = HedgedModel(model, alternate=alternate, **hedge)
+
+    # Outermost, so that cache hits never wait for the rate limiter.
+    cache = {k: v for k, v in (cache or {}).items() if v is not None}
+    if cache.get("path"):
+        model = CachedModel(model, get_cache(**cache))
 
-    return API_MODEL_REGISTRY[key](model_name, **kwargs)
+    return model
 
 
 __all__ = ["get_model"]
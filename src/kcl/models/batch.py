@@ -0,0 +1,319 @@
+import io
+import json
+import time
+import uuid
+
+from loguru import logger
+
+from .wrapper import ModelWrapper
+
+DEFAULT_POLL_SEC = 30
+
+
+def _jsonl(lines):
+    return "".join(json.dumps(x, ensure_ascii=False) + "\n" for x in lines)
+
+
+def _split_uri(uri, scheme):
+    bucket, _, prefix = uri[len(f"{scheme}://") :].partition("/")
+    return bucket, prefix.rstrip("/")
+
+
+class OpenAIBatchTransport:
+
+    def __init__(
+        self,
+        model,
+        base_url=None,
+        api_key=None,
+        completion_window="24h",
+    ):
+        self.model = model
+        self.completion_window = completion_window
+        if base_url is not None:
+            # e.g. a local stand-in server that speaks the Batch API
+            from openai import OpenAI
+
+            self.client = OpenAI(base_url=base_url, api_key=api_key)
+        else:
+            self.client = model.client
+
+    def submit(self, requests):
+        lines = [
+            {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/responses",
+                "body": body,
+            }
+            for custom_id, body in requests
+        ]
+        batch_file = self.client.files.create(
+            file=("batch.jsonl", _jsonl(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        job = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/responses",
+            completion_window=self.completion_window,
+        )
+        return job.id
+
+    def status(self, job_id):
+        state = self.client.batches.retrieve(job_id).status
+        if state == "completed":
+            return "completed"
+        if state in ("failed", "expired", "cancelled"):
+            return "failed"
+        return "running"
+
+    def results(self, job_id):
+        job = self.client.batches.retrieve(job_id)
+        outputs = {}
+        for file_id in (job.output_file_id, job.error_file_id):
+            if not file_id:
+                continue
+            text = self.client.files.content(file_id).text
+            for line in text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    outputs[record["custom_id"]] = RuntimeError(
+                        str(record.get("error") or response.get("body"))
+                    )
+                else:
+                    outputs[record["custom_id"]] = response["body"]
+        return outputs
+
+
+class BedrockBatchTransport:
+
+    def __init__(self, model, s3_uri, role_arn, region_name=None):
+        import boto3
+
+        region_name = region_name or model.client.meta.region_name
+        self.model = model
+        self.role_arn = role_arn
+        self.bucket, self.prefix = _split_uri(s3_uri, "s3")
+        self.bedrock = boto3.client("bedrock", region_name=region_name)
+        self.s3 = boto3.client("s3", region_name=region_name)
+
+    def submit(self, requests):
+        job_name = f"kcl-{uuid.uuid4().hex[:12]}"
+        key = f"{self.prefix}/{job_name}/input.jsonl"
+        lines = [
+            {"recordId": custom_id, "modelInput": body}
+            for custom_id, body in requests
+        ]
+        self.s3.put_object(
+            Bucket=self.bucket, Key=key, Body=_jsonl(lines).encode("utf-8")
+        )
+        job = self.bedrock.create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self.role_arn,
+            modelId=self.model.model_name,
+            inputDataConfig={
+                "s3InputDataConfig": {"s3Uri": f"s3://{self.bucket}/{key}"}
+            },
+            outputDataConfig={
+                "s3OutputDataConfig": {
+                    "s3Uri": f"s3://{self.bucket}/{self.prefix}/{job_name}/output/"
+                }
+            },
+        )
+        return job["jobArn"]
+
+    def status(self, job_id):
+        state = self.bedrock.get_model_invocation_job(jobIdentifier=job_id)[
+            "status"
+        ]
+        if state in ("Completed", "PartiallyCompleted"):
+            return "completed"
+        if state in ("Failed", "Stopped", "Expired"):
+            return "failed"
+        return "running"
+
+    def results(self, job_id):
+        job = self.bedrock.get_model_invocation_job(jobIdentifier=job_id)
+        uri = job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"]
+        bucket, prefix = _split_uri(uri, "s3")
+
+        outputs = {}
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if not obj["Key"].endswith(".jsonl.out"):
+                    continue
+                body = self.s3.get_object(Bucket=bucket, Key=obj["Key"])
+                for line in body["Body"].iter_lines():
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if record.get("error"):
+                        outputs[record["recordId"]] = RuntimeError(
+                            str(record["error"])
+                        )
+                    else:
+                        outputs[record["recordId"]] = record["modelOutput"]
+        return outputs
+
+
+class VertexBatchTransport:
+
+    def __init__(self, model, gcs_uri):
+        try:
+            from google.cloud import storage
+        except ImportError as e:
+            raise ImportError(
+                "Vertex batch prediction needs google-cloud-storage to stage "
+                "its input file."
+            ) from e
+
+        self.model = model
+        self.bucket_name, self.prefix = _split_uri(gcs_uri, "gs")
+        self.storage = storage.Client(
+            project=model.project, credentials=model.service_account
+        )
+
+    def submit(self, requests):
+        from google.genai import types
+
+        job_name = f"kcl-{uuid.uuid4().hex[:12]}"
+        blob_name = f"{self.prefix}/{job_name}/input.jsonl"
+        lines = [
+            {
+                "request": {
+                    **body,
+                    # Echoed back in the output, which has no id of its own.
+                    "labels": {"kcl_id": custom_id},
+                }
+            }
+            for custom_id, body in requests
+        ]
+        bucket = self.storage.bucket(self.bucket_name)
+        bucket.blob(blob_name).upload_from_file(
+            io.BytesIO(_jsonl(lines).encode("utf-8")),
+            content_type="application/jsonl",
+        )
+        job = self.model.client.batches.create(
+            model=self.model.model_name,
+            src=f"gs://{self.bucket_name}/{blob_name}",
+            config=types.CreateBatchJobConfig(
+                dest=f"gs://{self.bucket_name}/{self.prefix}/{job_name}/output"
+            ),
+        )
+        return job.name
+
+    def status(self, job_id):
+        state = str(self.model.client.batches.get(name=job_id).state)
+        if state.endswith("SUCCEEDED"):
+            return "completed"
+        if state.endswith(("FAILED", "CANCELLED", "EXPIRED")):
+            return "failed"
+        return "running"
+
+    def results(self, job_id):
+        job = self.model.client.batches.get(name=job_id)
+        bucket_name, prefix = _split_uri(job.dest.gcs_uri, "gs")
+
+        outputs = {}
+        for blob in self.storage.list_blobs(bucket_name, prefix=prefix):
+            if not blob.name.endswith(".jsonl"):
+                continue
+            for line in blob.download_as_text().splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                custom_id = record["request"]["labels"]["kcl_id"]
+                if record.get("status"):
+                    outputs[custom_id] = RuntimeError(record["status"])
+                else:
+                    outputs[custom_id] = record["response"]
+        return outputs
+
+
+TRANSPORTS = {
+    "openai": OpenAIBatchTransport,
+    "bedrock": BedrockBatchTransport,
+    "vertex": VertexBatchTransport,
+}
+
+
+class BatchRunner:
+
+    def __init__(
+        self,
+        model,
+        transport=None,
+        poll_interval=DEFAULT_POLL_SEC,
+        timeout=None,
+        job_id=None,
+        **transport_kwargs,
+    ):
+        if isinstance(model, ModelWrapper):
+            model = model.unwrap()
+        if transport is None:
+            if model.provider not in TRANSPORTS:
+                raise ValueError(
+                    f"{type(model).__name__} does not support batch jobs"
+                )
+            transport = TRANSPORTS[model.provider](model, **transport_kwargs)
+
+        self.model = model
+        self.transport = transport
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.job_id = job_id
+
+    def submit(self, prompts, custom_ids=None):
+        if custom_ids is None:
+            custom_ids = [str(i) for i in range(len(prompts))]
+        requests = [
+            (custom_id, self.model.batch_request(prompt))
+            for custom_id, prompt in zip(custom_ids, prompts)
+        ]
+        self.job_id = self.transport.submit(requests)
+        logger.info(f"Submitted batch job {self.job_id} ({len(requests)})")
+        return self.job_id
+
+    def wait(self):
+        start = time.monotonic()
+        while (state := self.transport.status(self.job_id)) == "running":
+            if self.timeout and time.monotonic() - start > self.timeout:
+                raise TimeoutError(f"Batch job {self.job_id} timed out")
+            time.sleep(self.poll_interval)
+        if state == "failed":
+            raise RuntimeError(f"Batch job {self.job_id} failed")
+        logger.info(f"Batch job {self.job_id} finished")
+
+    def run(self, prompts, custom_ids=None):
+        if custom_ids is None:
+            custom_ids = [str(i) for i in range(len(prompts))]
+        if self.job_id is None:
+            self.submit(prompts, custom_ids)
+        else:
+            logger.info(f"Attaching to batch job {self.job_id}")
+        self.wait()
+
+        raw = self.transport.results(self.job_id)
+        outputs = []
+        for custom_id in custom_ids:
+            result = raw.get(custom_id)
+            if result is None:
+                result = RuntimeError("missing from batch output")
+            elif not isinstance(result, Exception):
+                try:
+                    result = self.model.parse_batch_output(result)
+                except Exception as e:
+                    result = e
+            outputs.append(result)
+        return outputs
+
+
+def generate_batch(model, prompts, custom_ids=None, **settings):
+    # Backends that batch natively skip the provider job machinery.
+    if hasattr(model, "generate_batch"):
+        return model.generate_batch(prompts)
+    return BatchRunner(model, **settings).run(prompts, custom_ids=custom_ids)
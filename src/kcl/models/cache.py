@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .sampling import agenerate_n, generate_n
+from .wrapper import ModelWrapper
+
+DEFAULT_MAX_SIZE_MB = 1024
+# Hits only refresh an entry's access time once it is this many seconds
+# old, so that repeated hits do not each write; eviction order is only as
+# fine as this.
+ACCESS_RESOLUTION = 3600
+
+
+def cache_key(backend, model_name, params, prompt):
+    payload = json.dumps(
+        [backend, model_name, params, prompt],
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+
+    def __init__(self, path, max_size_mb: float = DEFAULT_MAX_SIZE_MB):
+        path = Path(path)
+        if path.suffix != ".sqlite":
+            path = path / "responses.sqlite"
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed "
+            "ON responses (accessed)"
+        )
+        (self.size,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, accessed FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] > ACCESS_RESOLUTION:
+                self._conn.execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?",
+                    (now, key),
+                )
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        value = json.dumps(value, ensure_ascii=False)
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            old = self._conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self.size += size - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries down to 90% of the budget so
+        # that eviction does not run again on the very next insert.
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        )
+        evicted = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()[0]
+
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_cache(path, max_size_mb: float = DEFAULT_MAX_SIZE_MB):
+    key = str(Path(path).resolve())
+    with _CACHES_LOCK:
+        if key not in _CACHES:
+            _CACHES[key] = ResponseCache(path, max_size_mb=max_size_mb)
+        return _CACHES[key]
+
+
+class CachedModel(ModelWrapper):
+
+    def __init__(self, inner, cache: ResponseCache):
+        super().__init__(inner)
+        self.cache = cache
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, prompt, n=1):
+        backend = self.unwrap()
+        params = getattr(backend, "generation_params", {})
+        if n > 1:
+            params = {**params, "n": n}
+        return cache_key(
+            type(backend).__name__, backend.model_name, params, prompt
+        )
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def generate(self, prompt: str, **kwargs):
+        # Extra arguments (e.g. a Gemini context cache) change the request
+        # in ways the key does not capture.
+        if kwargs:
+            return self.inner.generate(prompt, **kwargs)
+
+        key = self._key(prompt)
+        cached = self.cache.get(key)
+        self._count(cached is not None)
+        if cached is not None:
+            return cached
+
+        output = self.inner.generate(prompt)
+        if output:
+            self.cache.put(key, output)
+        return output
+
+    async def agenerate(self, prompt: str, **kwargs):
+        if kwargs:
+            return await self.inner.agenerate(prompt, **kwargs)
+
+        key = self._key(prompt)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        self._count(cached is not None)
+        if cached is not None:
+            return cached
+
+        output = await self.inner.agenerate(prompt)
+        if output:
+            await asyncio.to_thread(self.cache.put, key, output)
+        return output
+
+    def generate_n(self, prompt: str, n: int):
+        key = self._key(prompt, n)
+        cached = self.cache.get(key)
+        self._count(cached is not None)
+        if cached is not None:
+            return cached
+
+        outputs = generate_n(self.inner, prompt, n)
+        if all(outputs):
+            self.cache.put(key, outputs)
+        return outputs
+
+    async def agenerate_n(self, prompt: str, n: int):
+        key = self._key(prompt, n)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        self._count(cached is not None)
+        if cached is not None:
+            return cached
+
+        outputs = await agenerate_n(self.inner, prompt, n)
+        if all(outputs):
+            await asyncio.to_thread(self.cache.put, key, outputs)
+        return outputs
+
+    def generate_stream(self, prompt: str):
+        key = self._key(prompt)
+        cached = self.cache.get(key)
+        self._count(cached is not None)
+        if cached is not None:
+            yield {"cached": True}
+            yield cached
+            return
+
+        chunks = []
+        for chunk in self.inner.generate_stream(prompt):
+            if isinstance(chunk, str):
+                chunks.append(chunk)
+            yield chunk
+        if output := "".join(chunks):
+            self.cache.put(key, output)
+
+    async def agenerate_stream(self, prompt: str):
+        key = self._key(prompt)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        self._count(cached is not None)
+        if cached is not None:
+            yield {"cached": True}
+            yield cached
+            return
+
+        chunks = []
+        async for chunk in self.inner.agenerate_stream(prompt):
+            if isinstance(chunk, str):
+                chunks.append(chunk)
+            yield chunk
+        if output := "".join(chunks):
+            await asyncio.to_thread(self.cache.put, key, output)
+
+    def stats_summary(self):
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "response_cache": {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / max(1, hits + misses), 4),
+                "entries": len(self.cache),
+                "size_mb": round(self.cache.size / 1024 / 1024, 2),
+            }
+        }
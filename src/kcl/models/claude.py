@@ -1,15 +1,26 @@
-import boto3
-from botocore.config import Config
+import asyncio
+import time
+
 from botocore.exceptions import ClientError
 
+from .clients import bedrock_client
+from .prompt_cache import split_prompt
+from .streaming import aiter_sync
+from .usage import UsageHistory
+
 
 class ClaudeModel:
 
+    provider = "bedrock"
+
     def __init__(
         self,
         model_name: str,
         thinking_budget: int = 8192,
+        num_samples: int = 1,
+        region: str = "us-east-2",
     ):
+        self.region = region
         self.__set_client()
 
         if not model_name:
@@ -17,57 +28,141 @@ class ClaudeModel:
 
         self.model_name = model_name
         self.thinking_budget = thinking_budget
+        self.num_samples = num_samples
 
-        self.usage_history = []
+        self.usage_history = UsageHistory(model_name)
+
+    @property
+    def generation_params(self):
+        return {"thinking_budget": self.thinking_budget}
+
+    @property
+    def max_tokens(self):
+        return 128_000 if self.thinking_budget > 0 else 8_192
 
     def __set_client(self):
+        self.client = bedrock_client(self.region)
 
-        self.client = boto3.client(
-            "bedrock-runtime",
-            region_name="us-east-2",
-            config=Config(
-                read_timeout=3600,
-                connect_timeout=900,
-            ),
-        )
+    def _converse_kwargs(self, prompt: str):
 
-    def generate(self, prompt: str):
+        content = [{"text": prompt}]
+        parts = split_prompt(prompt)
+        if parts is not None:
+            # Everything before the cache point is cached for reuse.
+            content = [
+                {"text": parts[0]},
+                {"cachePoint": {"type": "default"}},
+                {"text": parts[1]},
+            ]
 
         conversation = [
             {
                 "role": "user",
-                "content": [{"text": prompt}],
+                "content": content,
             }
         ]
 
-        reasoning_config = None
+        kwargs = {"modelId": self.model_name, "messages": conversation}
         if self.thinking_budget > 0:
-            reasoning_config = {
+            kwargs["inferenceConfig"] = {"maxTokens": self.max_tokens}
+            kwargs["additionalModelRequestFields"] = {
                 "thinking": {
                     "type": "enabled",
                     "budget_tokens": self.thinking_budget,
                 }
             }
-        if reasoning_config is None:
-            response = self.client.converse(
-                modelId=self.model_name,
-                messages=conversation,
-            )
-
-        else:
-            response = self.client.converse(
-                modelId=self.model_name,
-                messages=conversation,
-                inferenceConfig={"maxTokens": 128_000},
-                additionalModelRequestFields=reasoning_config,
-            )
-
-        if self.thinking_budget:
-            response_text = response["output"]["message"]["content"][1]["text"]
-        else:
-            response_text = response["output"]["message"]["content"][0]["text"]
-
-        return response_text
+        return kwargs
+
+    def _record_usage(self, usage, latency=None, prompt=None):
+        # Converse reports cache reads and writes outside inputTokens.
+        cached = usage.get("cacheReadInputTokens", 0)
+        self.usage_history.record(
+            input_tokens=usage.get("inputTokens", 0)
+            + cached
+            + usage.get("cacheWriteInputTokens", 0),
+            output_tokens=usage.get("outputTokens", 0),
+            cached_tokens=cached,
+            latency=latency,
+            prompt_chars=None if prompt is None else len(prompt),
+        )
+        return {"output_tokens": usage.get("outputTokens")}
+
+    def generate(self, prompt: str):
+
+        start = time.monotonic()
+        response = self.client.converse(**self._converse_kwargs(prompt))
+        self._record_usage(response["usage"], time.monotonic() - start, prompt)
+
+        # Reasoning blocks carry no "text" key, so join the text blocks
+        # instead of relying on their position.
+        return "".join(
+            block["text"]
+            for block in response["output"]["message"]["content"]
+            if "text" in block
+        )
+
+    def generate_stream(self, prompt: str):
+
+        start = time.monotonic()
+        response = self.client.converse_stream(**self._converse_kwargs(prompt))
+
+        for event in response["stream"]:
+            if "contentBlockDelta" in event:
+                yield event["contentBlockDelta"]["delta"].get("text", "")
+            elif "metadata" in event:
+                yield self._record_usage(
+                    event["metadata"].get("usage", {}),
+                    time.monotonic() - start,
+                    prompt,
+                )
+
+    async def agenerate_stream(self, prompt: str):
+        async for chunk in aiter_sync(self.generate_stream(prompt)):
+            yield chunk
+
+    def batch_request(self, prompt: str):
+        # Bedrock batch jobs take the native Anthropic request body rather
+        # than the Converse format.
+        body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": self.max_tokens,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [{"type": "text", "text": prompt}],
+                }
+            ],
+        }
+        if self.thinking_budget > 0:
+            body["thinking"] = {
+                "type": "enabled",
+                "budget_tokens": self.thinking_budget,
+            }
+        return body
+
+    def parse_batch_output(self, output):
+        usage = output.get("usage", {})
+        self._record_usage(
+            {
+                "inputTokens": usage.get("input_tokens", 0),
+                "outputTokens": usage.get("output_tokens", 0),
+                "cacheReadInputTokens": usage.get(
+                    "cache_read_input_tokens", 0
+                ),
+                "cacheWriteInputTokens": usage.get(
+                    "cache_creation_input_tokens", 0
+                ),
+            }
+        )
+        return "".join(
+            block["text"]
+            for block in output["content"]
+            if block["type"] == "text"
+        )
+
+    async def agenerate(self, prompt: str):
+        # boto3 has no asyncio transport; keep the blocking call off the loop.
+        return await asyncio.to_thread(self.generate, prompt)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,305 @@
+import hashlib
+import json
+import os
+import threading
+import weakref
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+
+from loguru import logger
+
+# botocore opens at most 10 connections per client by default, far below
+# the usual n_jobs; pools are sized to the largest configured concurrency.
+MIN_POOL_SIZE = 10
+DEFAULT_POOL_SIZE = 64
+
+
+class ClientStats:
+
+    # Fed by client hooks: a request hook counts requests and how many were
+    # already waiting for or holding a connection, the per-request httpx
+    # trace counts new TCP connections and TLS handshakes and ends the
+    # request when its response is closed. pool_exhausted is the number of
+    # requests that found every connection of the pool busy. Requests in
+    # flight are held weakly, so one that fails before it is traced (e.g.
+    # a pool timeout or a cancellation) is gone once it is freed.
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._in_flight = weakref.WeakSet()
+        self._sending = threading.local()
+        self.counts = Counter()
+        # Connections are only seen per client through httpx's trace.
+        self.traced = True
+
+    def start_request(self, request):
+        with self._lock:
+            self.counts["requests"] += 1
+            if len(self._in_flight) >= self.pool_size:
+                self.counts["pool_exhausted"] += 1
+            self._in_flight.add(request)
+            self.counts["peak_in_flight"] = max(
+                self.counts["peak_in_flight"], len(self._in_flight)
+            )
+
+    def end_request(self, request):
+        with self._lock:
+            self._in_flight.discard(request)
+
+    def tracer(self, request):
+        # The request holds its tracer, so the tracer holds it weakly.
+        ref = weakref.ref(request)
+
+        def trace(name, info):
+            if name == "connection.connect_tcp.started":
+                with self._lock:
+                    self.counts["new_connections"] += 1
+            elif name == "connection.start_tls.started":
+                with self._lock:
+                    self.counts["tls_handshakes"] += 1
+            elif name.endswith(("response_closed.complete", ".failed")):
+                request = ref()
+                if request is not None:
+                    self.end_request(request)
+
+        return trace
+
+    def atracer(self, request):
+        trace = self.tracer(request)
+
+        async def atrace(name, info):
+            trace(name, info)
+
+        return atrace
+
+    # botocore runs each request on the calling thread, from before-send
+    # to response-received, which has no reference to the request. Streamed
+    # bodies are read after response-received and are not counted.
+
+    def before_send(self, request, **kwargs):
+        self.start_request(request)
+        self._sending.request = request
+
+    def response_received(self, **kwargs):
+        request = getattr(self._sending, "request", None)
+        self._sending.request = None
+        if request is not None:
+            self.end_request(request)
+
+    def summary(self):
+        with self._lock:
+            counts = dict(self.counts)
+        requests = counts.get("requests", 0)
+        summary = {"pool_size": self.pool_size, **counts}
+        if requests and self.traced:
+            summary["connection_reuse"] = round(
+                1 - counts.get("new_connections", 0) / requests, 4
+            )
+        return summary
+
+
+class ClientRegistry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._refs = Counter()
+        self._stats = {}
+        self.pool_size = DEFAULT_POOL_SIZE
+
+    def set_pool_size(self, *concurrency):
+        sizes = [size for size in concurrency if size]
+        if sizes:
+            self.pool_size = max(MIN_POOL_SIZE, *sizes)
+
+    def get(self, key, factory):
+        # key is (provider, kind, region, credentials); factory builds the
+        # client from the pool size and the stats to attach to it.
+        with self._lock:
+            if key not in self._clients:
+                # Counts carry over if a released client is built again.
+                stats = self._stats.setdefault(
+                    key, ClientStats(self.pool_size)
+                )
+                self._clients[key] = factory(self.pool_size, stats)
+                logger.debug(
+                    f"Created {key[0]} {key[1]} client for {key[2]} "
+                    f"(pool size {self.pool_size})"
+                )
+            self._refs[key] += 1
+            return self._clients[key]
+
+    def release(self, key):
+        # Returns the client once its last user let go, for closing.
+        with self._lock:
+            self._refs[key] -= 1
+            if self._refs[key] > 0:
+                return None
+            del self._refs[key]
+            return self._clients.pop(key, None)
+
+    def summary(self):
+        with self._lock:
+            stats = {
+                f"{provider}/{kind}/{region}": s.summary()
+                for (provider, kind, region, _), s in self._stats.items()
+            }
+            for (provider, kind, region, _), refs in self._refs.items():
+                stats.setdefault(f"{provider}/{kind}/{region}", {})
+                stats[f"{provider}/{kind}/{region}"]["users"] = refs
+        # Clients without HTTP traffic (e.g. unused async ones) are noise.
+        return {name: s for name, s in stats.items() if s.get("requests")}
+
+
+CLIENTS = ClientRegistry()
+
+
+def set_pool_size(*concurrency):
+    CLIENTS.set_pool_size(*concurrency)
+
+
+def client_stats():
+    return CLIENTS.summary()
+
+
+def _secret_key(value):
+    # Keys are kept in memory only, but there is no need to hold secrets.
+    if value is None:
+        return None
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+
+
+@lru_cache(maxsize=None)
+def service_account_credentials(path):
+    from google.oauth2 import service_account
+
+    project = json.loads(Path(path).read_text())["project_id"]
+    credentials = service_account.Credentials.from_service_account_file(
+        path,
+        scopes=["https://www.googleapis.com/auth/cloud-platform"],
+    )
+    return credentials, project
+
+
+def _httpx_limits(pool_size):
+    import httpx
+
+    return httpx.Limits(
+        max_connections=pool_size, max_keepalive_connections=pool_size
+    )
+
+
+def _trace_hook(stats):
+    def hook(request):
+        stats.start_request(request)
+        request.extensions["trace"] = stats.tracer(request)
+
+    return hook
+
+
+def _atrace_hook(stats):
+    async def hook(request):
+        stats.start_request(request)
+        request.extensions["trace"] = stats.atracer(request)
+
+    return hook
+
+
+def openai_clients():
+    from openai import (
+        AsyncOpenAI,
+        DefaultAsyncHttpxClient,
+        DefaultHttpxClient,
+        OpenAI,
+    )
+
+    credentials = _secret_key(os.getenv("OPENAI_API_KEY"))
+    base_url = os.getenv("OPENAI_BASE_URL")
+
+    def sync_client(pool_size, stats):
+        return OpenAI(
+            http_client=DefaultHttpxClient(
+                limits=_httpx_limits(pool_size),
+                event_hooks={"request": [_trace_hook(stats)]},
+            )
+        )
+
+    def async_client(pool_size, stats):
+        return AsyncOpenAI(
+            http_client=DefaultAsyncHttpxClient(
+                limits=_httpx_limits(pool_size),
+                event_hooks={"request": [_atrace_hook(stats)]},
+            )
+        )
+
+    # Both clients are shared; models release their keys when done.
+    sync_key = ("openai", "sync", base_url or "default", credentials)
+    async_key = ("openai", "async", base_url or "default", credentials)
+    return (
+        CLIENTS.get(sync_key, sync_client),
+        CLIENTS.get(async_key, async_client),
+        sync_key,
+        async_key,
+    )
+
+
+def bedrock_client(region):
+    import boto3
+    from botocore.config import Config
+
+    # Resolving the credential chain here could hit the network, so the
+    # key only tells apart profiles and explicit keys.
+    credentials = _secret_key(
+        f"{os.getenv('AWS_PROFILE')}:{os.getenv('AWS_ACCESS_KEY_ID')}"
+    )
+
+    def build(pool_size, stats):
+        client = boto3.client(
+            "bedrock-runtime",
+            region_name=region,
+            config=Config(
+                read_timeout=3600,
+                connect_timeout=900,
+                max_pool_connections=pool_size,
+            ),
+        )
+        # urllib3 reports no connection events, only botocore's requests.
+        stats.traced = False
+        client.meta.events.register("before-send", stats.before_send)
+        client.meta.events.register(
+            "response-received", stats.response_received
+        )
+        return client
+
+    return CLIENTS.get(("bedrock", "runtime", region, credentials), build)
+
+
+def genai_client(credentials_path, region):
+    from google import genai
+    from google.genai import types
+
+    credentials, project = service_account_credentials(credentials_path)
+
+    def build(pool_size, stats):
+        limits = _httpx_limits(pool_size)
+        return genai.Client(
+            vertexai=True,
+            credentials=credentials,
+            project=project,
+            location=region,
+            http_options=types.HttpOptions(
+                client_args={
+                    "limits": limits,
+                    "event_hooks": {"request": [_trace_hook(stats)]},
+                },
+                async_client_args={
+                    "limits": limits,
+                    "event_hooks": {"request": [_atrace_hook(stats)]},
+                },
+            ),
+        )
+
+    key = ("vertex", "genai", region, str(Path(credentials_path).resolve()))
+    return CLIENTS.get(key, build), credentials, project
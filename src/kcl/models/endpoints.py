@@ -0,0 +1,104 @@
+import threading
+import time
+
+from loguru import logger
+
+CHAT_PATH = "/v1/chat/completions"
+
+
+def endpoint_urls(port=None, url=None):
+    if url is not None:
+        urls = [url] if isinstance(url, str) else list(url)
+    else:
+        ports = [port] if isinstance(port, (int, str)) else list(port)
+        urls = [f"http://localhost:{p}" for p in ports]
+
+    urls = [u.rstrip("/") for u in urls]
+    return [u if u.endswith(CHAT_PATH) else u + CHAT_PATH for u in urls]
+
+
+def is_endpoint_failure(exc) -> bool:
+    # Transport errors and 5xx mean the replica is unhealthy; a 4xx is a
+    # problem with the request itself and would fail on any replica.
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        return status >= 500
+    return True
+
+
+class EndpointPool:
+
+    def __init__(
+        self,
+        urls,
+        max_failures: int = 3,
+        cooldown: float = 10.0,
+        max_cooldown: float = 300.0,
+    ):
+        if not urls:
+            raise ValueError("At least one endpoint is required.")
+
+        self.urls = list(urls)
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self._lock = threading.Lock()
+        self.outstanding = {u: 0 for u in self.urls}
+        self.failures = {u: 0 for u in self.urls}
+        self.ejections = {u: 0 for u in self.urls}
+        self.ejected_until = {u: 0.0 for u in self.urls}
+        self.requests = {u: 0 for u in self.urls}
+
+    def acquire(self, exclude=()):
+        with self._lock:
+            now = time.monotonic()
+            candidates = [u for u in self.urls if u not in exclude] or list(
+                self.urls
+            )
+            healthy = [u for u in candidates if self.ejected_until[u] <= now]
+            if healthy:
+                # Ties go to the replica listed first.
+                url = min(healthy, key=lambda u: self.outstanding[u])
+            else:
+                # Everything is ejected: probe the one that recovers first.
+                url = min(candidates, key=lambda u: self.ejected_until[u])
+
+            self.outstanding[url] += 1
+            self.requests[url] += 1
+            return url
+
+    def release(self, url, failed: bool = False):
+        with self._lock:
+            self.outstanding[url] -= 1
+            if not failed:
+                self.failures[url] = 0
+                return
+
+            now = time.monotonic()
+            if self.ejected_until[url] > now:
+                # Requests that were already in flight when it was ejected.
+                return
+            self.failures[url] += 1
+            if self.failures[url] < self.max_failures:
+                return
+
+            # Each consecutive ejection doubles the time out of rotation.
+            self.ejections[url] += 1
+            duration = min(
+                self.max_cooldown,
+                self.cooldown * 2 ** (self.failures[url] - self.max_failures),
+            )
+            self.ejected_until[url] = now + duration
+            logger.warning(f"Ejected {url} for {duration:.1f}s")
+
+    def summary(self):
+        with self._lock:
+            return {
+                url: {
+                    "requests": self.requests[url],
+                    "ejections": self.ejections[url],
+                }
+                for url in self.urls
+            }
@@ -1,19 +1,24 @@
-import json
 import os
-from pathlib import Path
+import time
 
-from google import genai
 from google.genai import types
-from google.oauth2 import service_account
+
+from .clients import genai_client
+from .usage import UsageHistory
 
 
 class GeminiModel:
 
+    provider = "vertex"
+
     def __init__(
         self,
         model_name: str,
         thinking_budget: int = -1,
+        num_samples: int = 1,
+        region: str = "us-central1",
     ):
+        self.region = region
         self.__set_client()
 
         if not model_name:
@@ -21,8 +26,13 @@ class GeminiModel:
 
         self.model_name = model_name
         self.thinking_budget = thinking_budget
+        self.num_samples = num_samples
+
+        self.usage_history = UsageHistory(model_name)
 
-        self.usage_history = []
+    @property
+    def generation_params(self):
+        return {"thinking_budget": self.thinking_budget}
 
     def __set_client(self):
         self.credentials = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", None)
@@ -30,21 +40,49 @@ class GeminiModel:
             raise ValueError(
                 "GOOGLE_APPLICATION_CREDENTIALS environment variable is not set."
             )
-        credentials = Path(self.credentials)
-        json_credential = json.loads(credentials.read_text())
-        credentials = service_account.Credentials.from_service_account_file(
-            credentials,
-            scopes=["https://www.googleapis.com/auth/cloud-platform"],
+        self.client, self.service_account, self.project = genai_client(
+            self.credentials, self.region
         )
 
-        self.client = genai.Client(
-            vertexai=True,
-            credentials=credentials,
-            project=json_credential["project_id"],
-            location="us-central1",
+    @staticmethod
+    def _candidate_texts(response, n):
+        # A candidate stopped for SAFETY or RECITATION has no content, and
+        # a blocked prompt has no candidates; both give empty texts.
+        texts = [
+            "".join(
+                part.text
+                for part in (candidate.content and candidate.content.parts)
+                or []
+                if part.text and not part.thought
+            )
+            for candidate in response.candidates or []
+        ]
+        return texts + [""] * (n - len(texts))
+
+    @staticmethod
+    def _stream_texts(chunk):
+        for candidate in chunk.candidates or []:
+            parts = candidate.content.parts if candidate.content else None
+            for part in parts or []:
+                yield "" if part.thought else part.text or ""
+
+    def _record_usage(self, usage, latency=None, prompt=None):
+        if usage is None:
+            return {}
+        # Vertex counts thoughts separately from the candidates.
+        reasoning = usage.thoughts_token_count or 0
+        output_tokens = (usage.candidates_token_count or 0) + reasoning
+        self.usage_history.record(
+            input_tokens=usage.prompt_token_count,
+            output_tokens=output_tokens,
+            cached_tokens=usage.cached_content_token_count,
+            reasoning_tokens=reasoning,
+            latency=latency,
+            prompt_chars=None if prompt is None else len(prompt),
         )
+        return {"output_tokens": output_tokens}
 
-    def generate(self, prompt: str, cache=None):
+    def _config(self, cache=None):
         config = types.GenerateContentConfig(
             thinking_config=types.ThinkingConfig(
                 thinking_budget=self.thinking_budget
@@ -74,21 +112,137 @@ class GeminiModel:
         )
         if cache is not None:
             config.cached_content = cache.name
+        return config
 
+    def generate(self, prompt: str, cache=None):
+        start = time.monotonic()
         response = self.client.models.generate_content(
             model=self.model_name,
             contents=[prompt],
-            config=config,
+            config=self._config(cache),
+        )
+        self._record_usage(
+            response.usage_metadata,
+            time.monotonic() - start,
+            # Cached content counts as input but is not in the prompt.
+            prompt if cache is None else None,
         )
 
         return response.text
 
+    async def agenerate(self, prompt: str, cache=None):
+        start = time.monotonic()
+        response = await self.client.aio.models.generate_content(
+            model=self.model_name,
+            contents=[prompt],
+            config=self._config(cache),
+        )
+        self._record_usage(
+            response.usage_metadata,
+            time.monotonic() - start,
+            # Cached content counts as input but is not in the prompt.
+            prompt if cache is None else None,
+        )
+
+        return response.text
+
+    def generate_stream(self, prompt: str):
+        start = time.monotonic()
+        usage = None
+        for chunk in self.client.models.generate_content_stream(
+            model=self.model_name,
+            contents=[prompt],
+            config=self._config(),
+        ):
+            usage = chunk.usage_metadata or usage
+            yield from self._stream_texts(chunk)
+        yield self._record_usage(usage, time.monotonic() - start, prompt)
+
+    async def agenerate_stream(self, prompt: str):
+        start = time.monotonic()
+        usage = None
+        stream = await self.client.aio.models.generate_content_stream(
+            model=self.model_name,
+            contents=[prompt],
+            config=self._config(),
+        )
+        async for chunk in stream:
+            usage = chunk.usage_metadata or usage
+            for text in self._stream_texts(chunk):
+                yield text
+        yield self._record_usage(usage, time.monotonic() - start, prompt)
+
+    def generate_n(self, prompt: str, n: int):
+        config = self._config()
+        config.candidate_count = n
+        start = time.monotonic()
+        response = self.client.models.generate_content(
+            model=self.model_name,
+            contents=[prompt],
+            config=config,
+        )
+        self._record_usage(
+            response.usage_metadata, time.monotonic() - start, prompt
+        )
+
+        return self._candidate_texts(response, n)
+
+    async def agenerate_n(self, prompt: str, n: int):
+        config = self._config()
+        config.candidate_count = n
+        start = time.monotonic()
+        response = await self.client.aio.models.generate_content(
+            model=self.model_name,
+            contents=[prompt],
+            config=config,
+        )
+        self._record_usage(
+            response.usage_metadata, time.monotonic() - start, prompt
+        )
+
+        return self._candidate_texts(response, n)
+
+    def batch_request(self, prompt: str):
+        config = self._config()
+        return {
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "generationConfig": {
+                "thinkingConfig": {"thinkingBudget": self.thinking_budget}
+            },
+            "safetySettings": [
+                {
+                    "category": setting.category.value,
+                    "threshold": setting.threshold.value,
+                }
+                for setting in config.safety_settings
+            ],
+        }
+
+    def parse_batch_output(self, response):
+        if "usageMetadata" in response:
+            self._record_usage(
+                types.GenerateContentResponseUsageMetadata.model_validate(
+                    response["usageMetadata"]
+                )
+            )
+        candidates = response.get("candidates") or [{}]
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        return "".join(
+            part.get("text", "") for part in parts if not part.get("thought")
+        )
+
     def count_tokens(self, text: str) -> int | None:
         response = self.client.models.count_tokens(
             model=self.model_name, contents=[text]
         )
         return response.total_tokens
 
+    async def acount_tokens(self, text: str) -> int | None:
+        response = await self.client.aio.models.count_tokens(
+            model=self.model_name, contents=[text]
+        )
+        return response.total_tokens
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,177 @@
+import asyncio
+import contextvars
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .sampling import afan_out, fan_out
+from .wrapper import ModelWrapper
+
+LATENCY_WINDOW = 1000
+MAX_HEDGE_THREADS = 256
+
+
+class HedgedModel(ModelWrapper):
+
+    # If a call is still running after the given percentile of the latencies
+    # seen so far, a duplicate goes to the alternate model (another region)
+    # or, without one, back through the same chain; for a LocalModel with
+    # several replicas the duplicate lands on a less busy replica. The first
+    # answer wins. Hedges are capped at budget * calls.
+
+    def __init__(
+        self,
+        inner,
+        percentile: float = 95,
+        budget: float = 0.05,
+        min_samples: int = 20,
+        alternate=None,
+    ):
+        super().__init__(inner)
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.alternate = alternate if alternate is not None else inner
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._pool = None
+        self.stats = {
+            "calls": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "over_budget": 0,
+        }
+
+    def _delay(self):
+        with self._lock:
+            self.stats["calls"] += 1
+            if len(self._latencies) < self.min_samples:
+                return None
+            cuts = statistics.quantiles(self._latencies, n=100)
+            return cuts[min(98, max(0, round(self.percentile) - 1))]
+
+    def _take_budget(self):
+        with self._lock:
+            if self.stats["hedged"] + 1 > self.budget * self.stats["calls"]:
+                self.stats["over_budget"] += 1
+                return False
+            self.stats["hedged"] += 1
+            return True
+
+    def _finish(self, start, hedge_won=False):
+        with self._lock:
+            self._latencies.append(time.monotonic() - start)
+            if hedge_won:
+                self.stats["hedge_wins"] += 1
+
+    def _submit(self, fn, target):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=MAX_HEDGE_THREADS)
+        ctx = contextvars.copy_context()
+        return self._pool.submit(ctx.run, fn, target)
+
+    def _hedged(self, fn, alternate):
+        start = time.monotonic()
+        delay = self._delay()
+        if delay is None:
+            result = fn(self.inner)
+            self._finish(start)
+            return result
+
+        primary = self._submit(fn, self.inner)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_budget():
+            result = primary.result()
+            self._finish(start)
+            return result
+
+        # The loser keeps running in its thread; its result is dropped.
+        hedge = self._submit(fn, alternate)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    result = future.result()
+                    self._finish(start, hedge_won=future is hedge)
+                    return result
+
+    async def _ahedged(self, fn, alternate):
+        start = time.monotonic()
+        delay = self._delay()
+        if delay is None:
+            result = await fn(self.inner)
+            self._finish(start)
+            return result
+
+        primary = asyncio.ensure_future(fn(self.inner))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not self._take_budget():
+            result = await primary
+            self._finish(start)
+            return result
+
+        hedge = asyncio.ensure_future(fn(alternate))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None or not pending:
+                        result = task.result()
+                        self._finish(start, hedge_won=task is hedge)
+                        return result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _alternate_for(self, kwargs):
+        # Extra arguments such as a Gemini context cache are tied to the
+        # primary's region.
+        return self.inner if kwargs else self.alternate
+
+    def generate(self, prompt: str, **kwargs):
+        return self._hedged(
+            lambda m: m.generate(prompt, **kwargs),
+            self._alternate_for(kwargs),
+        )
+
+    async def agenerate(self, prompt: str, **kwargs):
+        return await self._ahedged(
+            lambda m: m.agenerate(prompt, **kwargs),
+            self._alternate_for(kwargs),
+        )
+
+    def generate_n(self, prompt: str, n: int):
+        if not self.native_n():
+            return fan_out(self, prompt, n)
+        return self._hedged(lambda m: m.generate_n(prompt, n), self.alternate)
+
+    async def agenerate_n(self, prompt: str, n: int):
+        if not self.native_n():
+            return await afan_out(self, prompt, n)
+        return await self._ahedged(
+            lambda m: m.agenerate_n(prompt, n), self.alternate
+        )
+
+    async def aclose(self):
+        models = [self.inner]
+        if self.alternate is not self.inner:
+            models.append(self.alternate)
+        for model in models:
+            if hasattr(model, "aclose"):
+                await model.aclose()
+
+    def stats_summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+            latencies = list(self._latencies)
+        if len(latencies) >= 2:
+            stats["p50_latency"] = round(statistics.median(latencies), 3)
+        return {"hedging": stats}
@@ -0,0 +1,281 @@
+import asyncio
+import importlib.util
+import threading
+import time
+
+from loguru import logger
+
+from .streaming import aiter_sync
+from .usage import UsageHistory
+
+ENGINES = ("vllm", "transformers")
+
+
+class InProcessModel:
+
+    # Runs a local checkpoint inside the process instead of behind an
+    # OpenAI-compatible server. vLLM is used when it is installed;
+    # otherwise transformers, which also runs on CPU for small models.
+    # With engine=batch the whole task goes through generate_batch.
+
+    provider = "local"
+
+    def __init__(
+        self,
+        model_name: str,
+        num_samples: int = 1,
+        engine: str | None = None,
+        batch_size: int = 8,
+        max_tokens: int = 16_384,
+        device: str | None = None,
+        dtype: str = "auto",
+        **engine_kwargs,
+    ):
+        if not model_name:
+            raise ValueError("Model name must be provided.")
+
+        if engine is None:
+            engine = (
+                "vllm" if importlib.util.find_spec("vllm") else "transformers"
+            )
+        if engine not in ENGINES:
+            raise ValueError(
+                f"Unknown engine: {engine!r}. Available: {ENGINES}"
+            )
+
+        self.model_name = model_name
+        self.num_samples = num_samples
+        self.engine = engine
+        self.batch_size = batch_size
+
+        self.max_tokens = max_tokens
+        self.top_p = 0.95
+        self.temperature = 0.6
+
+        # One batch at a time on the device.
+        self._lock = threading.Lock()
+        self.usage_history = UsageHistory(model_name)
+
+        logger.info(f"Loading {model_name} in process with {engine}")
+        if engine == "vllm":
+            self.__set_vllm(dtype, **engine_kwargs)
+        else:
+            self.__set_transformers(device, dtype, **engine_kwargs)
+
+    @property
+    def generation_params(self):
+        return {"top_p": self.top_p, "temperature": self.temperature}
+
+    @property
+    def can_stream(self):
+        # vLLM's offline LLM only returns finished outputs.
+        return self.engine == "transformers"
+
+    @property
+    def context_window(self):
+        if self.engine == "vllm":
+            return self.llm.llm_engine.model_config.max_model_len
+        return getattr(self.model.config, "max_position_embeddings", None)
+
+    def __set_vllm(self, dtype, **engine_kwargs):
+        from vllm import LLM
+
+        self.llm = LLM(model=self.model_name, dtype=dtype, **engine_kwargs)
+
+    def __set_transformers(self, device, dtype, **engine_kwargs):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+
+        # Left padding keeps every prompt flush against its generation.
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            self.model_name, padding_side="left"
+        )
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self.model = AutoModelForCausalLM.from_pretrained(
+            self.model_name, torch_dtype=dtype, **engine_kwargs
+        ).to(device)
+        self.model.eval()
+
+    def _chat_text(self, prompt: str):
+        if not self.tokenizer.chat_template:
+            return prompt
+        return self.tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+
+    def _generate_vllm(self, prompts, n):
+        from vllm import SamplingParams
+
+        params = SamplingParams(
+            n=n,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            max_tokens=self.max_tokens,
+        )
+        results = self.llm.chat(
+            [[{"role": "user", "content": p}] for p in prompts],
+            params,
+            use_tqdm=len(prompts) > 1,
+        )
+
+        outputs = []
+        for result in results:
+            self.usage_history.record(
+                input_tokens=len(result.prompt_token_ids),
+                output_tokens=sum(len(o.token_ids) for o in result.outputs),
+                cached_tokens=result.num_cached_tokens,
+            )
+            outputs.append([o.text.strip() for o in result.outputs])
+        return outputs
+
+    def _generate_transformers(self, prompts, n):
+        import torch
+
+        texts = [self._chat_text(p) for p in prompts]
+        lengths = [len(ids) for ids in self.tokenizer(texts)["input_ids"]]
+
+        # Prompts of similar length share a batch to limit padding.
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        outputs = [None] * len(texts)
+        pad_id = self.tokenizer.pad_token_id
+        for start in range(0, len(order), self.batch_size):
+            chunk = order[start : start + self.batch_size]
+            inputs = self.tokenizer(
+                [texts[i] for i in chunk],
+                return_tensors="pt",
+                padding=True,
+                add_special_tokens=False,
+            ).to(self.device)
+            with torch.inference_mode():
+                generated = self.model.generate(
+                    **inputs,
+                    do_sample=self.temperature > 0,
+                    temperature=self.temperature,
+                    top_p=self.top_p,
+                    max_new_tokens=self.max_tokens,
+                    num_return_sequences=n,
+                    pad_token_id=pad_id,
+                )
+            # Sequences come back grouped by prompt, n at a time.
+            completions = generated[:, inputs["input_ids"].shape[1] :]
+            for j, i in enumerate(chunk):
+                group = completions[j * n : (j + 1) * n]
+                self.usage_history.record(
+                    input_tokens=lengths[i],
+                    output_tokens=int((group != pad_id).sum()),
+                )
+                outputs[i] = [
+                    text.strip()
+                    for text in self.tokenizer.batch_decode(
+                        group, skip_special_tokens=True
+                    )
+                ]
+        return outputs
+
+    def _generate(self, prompts, n=1):
+        start = time.monotonic()
+        with self._lock:
+            if self.engine == "vllm":
+                outputs = self._generate_vllm(prompts, n)
+            else:
+                outputs = self._generate_transformers(prompts, n)
+        if len(prompts) > 1:
+            logger.info(
+                f"Generated {len(prompts)} prompts in "
+                f"{time.monotonic() - start:.1f}s"
+            )
+        return outputs
+
+    def generate(self, prompt: str):
+        return self._generate([prompt])[0][0]
+
+    def generate_n(self, prompt: str, n: int):
+        return self._generate([prompt], n)[0]
+
+    def generate_batch(self, prompts):
+        return [outputs[0] for outputs in self._generate(list(prompts))]
+
+    def generate_stream(self, prompt: str):
+        if not self.can_stream:
+            raise ValueError(
+                f"engine={self.engine} cannot stream; use the transformers "
+                "engine or stream=false"
+            )
+        import torch
+        from transformers import TextIteratorStreamer
+
+        inputs = self.tokenizer(
+            self._chat_text(prompt),
+            return_tensors="pt",
+            add_special_tokens=False,
+        ).to(self.device)
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        pad_id = self.tokenizer.pad_token_id
+        done = {}
+
+        def run():
+            # generate feeds the streamer from this thread; on failure the
+            # streamer is ended here so the loop below does not wait.
+            try:
+                with self._lock, torch.inference_mode():
+                    generated = self.model.generate(
+                        **inputs,
+                        do_sample=self.temperature > 0,
+                        temperature=self.temperature,
+                        top_p=self.top_p,
+                        max_new_tokens=self.max_tokens,
+                        pad_token_id=pad_id,
+                        streamer=streamer,
+                    )
+                completion = generated[0, inputs["input_ids"].shape[1] :]
+                done["output_tokens"] = int((completion != pad_id).sum())
+            except BaseException as e:
+                done["error"] = e
+                streamer.end()
+
+        start = time.monotonic()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        yield from streamer
+        thread.join()
+        if "error" in done:
+            raise done["error"]
+
+        self.usage_history.record(
+            input_tokens=inputs["input_ids"].shape[1],
+            output_tokens=done["output_tokens"],
+            latency=time.monotonic() - start,
+        )
+        yield {"output_tokens": done["output_tokens"]}
+
+    async def agenerate(self, prompt: str):
+        return await asyncio.to_thread(self.generate, prompt)
+
+    async def agenerate_stream(self, prompt: str):
+        async for chunk in aiter_sync(self.generate_stream(prompt)):
+            yield chunk
+
+    async def agenerate_n(self, prompt: str, n: int):
+        return await asyncio.to_thread(self.generate_n, prompt, n)
+
+    def cleanup(self):
+        for attr in ("llm", "model"):
+            if hasattr(self, attr):
+                delattr(self, attr)
+        try:
+            import torch
+
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
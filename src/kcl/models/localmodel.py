@@ -1,53 +1,270 @@
+import json
+import time
+
+import httpx
 import requests
 from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from .endpoints import (
+    CHAT_PATH,
+    EndpointPool,
+    endpoint_urls,
+    is_endpoint_failure,
+)
+from .usage import UsageHistory
 
 
 class LocalModel:
 
+    provider = "local"
+
     def __init__(
         self,
         model_name: str,
-        port: int = 8000,
+        port: int | list[int] = 8000,
+        url: str | list[str] | None = None,
+        num_samples: int = 1,
+        pool_size: int = 64,
+        context_window: int | None = None,
     ):
         self.model_name = model_name
         self.port = port
+        self.num_samples = num_samples
+        self.pool_size = pool_size
+        self.endpoints = EndpointPool(endpoint_urls(port=port, url=url))
         self.__set_client()
 
         if not model_name:
             raise ValueError("Model name must be provided.")
 
         self.max_tokens = 16_384
+        self.top_p = 0.95
+        self.temperature = 0.6
+        self._context_window = context_window
+
+        self.usage_history = UsageHistory(model_name)
+
+    @property
+    def context_window(self):
+        # vLLM reports the max_model_len it serves on /v1/models.
+        if self._context_window is None:
+            self._context_window = self._served_context_window()
+        return self._context_window
+
+    def _served_context_window(self):
+        url = self.url.removesuffix(CHAT_PATH) + "/v1/models"
+        try:
+            response = self.session.get(url, timeout=10)
+            response.raise_for_status()
+            for model in response.json().get("data", []):
+                if model.get("id") == self.model_name:
+                    return model.get("max_model_len")
+        except Exception as e:
+            logger.warning(
+                f"Could not read the context window from {url}: {e}"
+            )
+        return None
+
+    @property
+    def generation_params(self):
+        return {"top_p": self.top_p, "temperature": self.temperature}
 
     def __set_client(self):
-        self.url = f"http://localhost:{self.port}/v1/chat/completions"
+        self.headers = {"Content-Type": "application/json"}
 
-    def generate(self, prompt: str):
+        # One keep-alive session shared by all worker threads.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=len(self.endpoints.urls),
+            pool_maxsize=self.pool_size,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._aclient = None
+
+    @property
+    def url(self):
+        return self.endpoints.urls[0]
+
+    def _payload(self, prompt: str, n: int = 1, stream: bool = False):
 
         message = [
             {"role": "user", "content": prompt},
         ]
 
-        headers = {"Content-Type": "application/json"}
-
         payload = {
             "model": self.model_name,
             "messages": message,
-            "stream": False,
-            "top_p": 0.95,
-            "temperature": 0.6,
+            "stream": stream,
+            "top_p": self.top_p,
+            "temperature": self.temperature,
         }
+        if n > 1:
+            payload["n"] = n
+        if stream:
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def _record_usage(self, usage, latency=None, prompt=None):
+        if not usage:
+            return {}
+        output_tokens = usage.get("completion_tokens", 0)
+        self.usage_history.record(
+            input_tokens=usage.get("prompt_tokens", 0),
+            output_tokens=output_tokens,
+            cached_tokens=(usage.get("prompt_tokens_details") or {}).get(
+                "cached_tokens"
+            ),
+            reasoning_tokens=(
+                usage.get("completion_tokens_details") or {}
+            ).get("reasoning_tokens"),
+            latency=latency,
+            prompt_chars=None if prompt is None else len(prompt),
+        )
+        return {"output_tokens": output_tokens}
+
+    def _parse(self, response, start, prompt):
+        # Failures are raised rather than returned as "" so that the caller
+        # retries them and records the error on the sample.
+        response.raise_for_status()
+        body = response.json()
+        self._record_usage(body.get("usage"), time.monotonic() - start, prompt)
+        return [
+            choice["message"]["content"].strip() for choice in body["choices"]
+        ]
+
+    def _stream_chunks(self, line, start, prompt):
+        # Server-sent events: "data: {...}" lines, ending with "data: [DONE]".
+        if not line.startswith("data:"):
+            return
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            return
+
+        chunk = json.loads(data)
+        for choice in chunk.get("choices", []):
+            delta = choice.get("delta", {})
+            # vLLM's reasoning parser streams thoughts separately.
+            yield delta.get("content") or ""
+        if chunk.get("usage"):
+            yield self._record_usage(
+                chunk["usage"], time.monotonic() - start, prompt
+            )
+
+    def generate(self, prompt: str):
+        return self.generate_n(prompt, 1)[0]
 
+    def generate_stream(self, prompt: str):
+
+        url = self.endpoints.acquire()
+        start = time.monotonic()
+        failed = False
+        try:
+            with self.session.post(
+                url,
+                headers=self.headers,
+                json=self._payload(prompt, stream=True),
+                stream=True,
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    yield from self._stream_chunks(line, start, prompt)
+
+        except Exception as e:
+            failed = is_endpoint_failure(e)
+            logger.error(f"Error in streaming response from {url}: {e}")
+            raise
+        finally:
+            self.endpoints.release(url, failed=failed)
+
+    async def agenerate_stream(self, prompt: str):
+
+        client = self._get_aclient()
+        url = self.endpoints.acquire()
+        start = time.monotonic()
+        failed = False
         try:
-            response = requests.post(self.url, headers=headers, json=payload)
-            response = response.json()
+            async with client.stream(
+                "POST",
+                url,
+                headers=self.headers,
+                json=self._payload(prompt, stream=True),
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    for chunk in self._stream_chunks(line, start, prompt):
+                        yield chunk
+
+        except Exception as e:
+            failed = is_endpoint_failure(e)
+            logger.error(f"Error in streaming response from {url}: {e}")
+            raise
+        finally:
+            self.endpoints.release(url, failed=failed)
 
-            response = response["choices"][0]["message"]["content"].strip()
+    def generate_n(self, prompt: str, n: int):
+
+        url = self.endpoints.acquire()
+        start = time.monotonic()
+        failed = False
+        try:
+            response = self.session.post(
+                url, headers=self.headers, json=self._payload(prompt, n)
+            )
+            return self._parse(response, start, prompt)
 
         except Exception as e:
-            logger.error(f"Error in generating response: {e}")
-            response = ""
+            failed = is_endpoint_failure(e)
+            logger.error(f"Error in generating response from {url}: {e}")
+            raise
+        finally:
+            self.endpoints.release(url, failed=failed)
+
+    async def agenerate(self, prompt: str):
+        return (await self.agenerate_n(prompt, 1))[0]
+
+    def _get_aclient(self):
+        if self._aclient is None:
+            # Created lazily so it binds to the running loop; no timeout,
+            # same as requests.post.
+            self._aclient = httpx.AsyncClient(
+                timeout=None,
+                limits=httpx.Limits(max_connections=None),
+            )
+        return self._aclient
+
+    async def agenerate_n(self, prompt: str, n: int):
+
+        client = self._get_aclient()
+        url = self.endpoints.acquire()
+        start = time.monotonic()
+        failed = False
+        try:
+            response = await client.post(
+                url, headers=self.headers, json=self._payload(prompt, n)
+            )
+            return self._parse(response, start, prompt)
+
+        except Exception as e:
+            failed = is_endpoint_failure(e)
+            logger.error(f"Error in generating response from {url}: {e}")
+            raise
+        finally:
+            self.endpoints.release(url, failed=failed)
+
+    def stats_summary(self):
+        if len(self.endpoints.urls) == 1:
+            return {}
+        return {"endpoints": self.endpoints.summary()}
+
+    def cleanup(self):
+        self.session.close()
 
-        return response
+    async def aclose(self):
+        if self._aclient is not None:
+            await self._aclient.aclose()
+            self._aclient = None
 
 
 if __name__ == "__main__":
@@ -1,12 +1,19 @@
-from openai import OpenAI
+import time
+
+from .clients import CLIENTS, openai_clients
+from .prompt_cache import prefix_key
+from .usage import UsageHistory
 
 
 class OAIModel:
 
+    provider = "openai"
+
     def __init__(
         self,
         model_name: str,
         thinking_budget: str = "medium",
+        num_samples: int = 1,
     ):
         self.__set_client()
 
@@ -14,29 +21,137 @@ class OAIModel:
             raise ValueError("Model name must be provided.")
 
         self.model_name = model_name
+        self.num_samples = num_samples
 
         self.reasoning = None
         if thinking_budget != "None":
             self.reasoning = {"effort": thinking_budget}
 
-        self.usage_history = []
-
-    def __set_client(self):
+        self.usage_history = UsageHistory(model_name)
 
-        self.client = OpenAI()
+    @property
+    def generation_params(self):
+        return {"reasoning": self.reasoning}
 
-    def generate(self, prompt: str):
+    def __set_client(self):
+        (
+            self.client,
+            self.aclient,
+            self._client_key,
+            self._aclient_key,
+        ) = openai_clients()
 
-        response = self.client.responses.create(
-            model=self.model_name,
-            input=[
+    def _request(self, prompt: str):
+        request = {
+            "model": self.model_name,
+            "input": [
                 {"role": "user", "content": prompt},
             ],
-            reasoning=self.reasoning,
+            "reasoning": self.reasoning,
+        }
+        # Routes prompts sharing a prefix to the same prompt cache.
+        cache_key = prefix_key(prompt)
+        if cache_key is not None:
+            request["prompt_cache_key"] = cache_key
+        return request
+
+    def _record_usage(self, usage, latency=None, prompt=None):
+        # Accepts the SDK object or the raw JSON of a batch output line.
+        if usage is None:
+            return {}
+        if not isinstance(usage, dict):
+            usage = usage.model_dump()
+        output_tokens = usage.get("output_tokens", 0)
+        self.usage_history.record(
+            input_tokens=usage.get("input_tokens", 0),
+            output_tokens=output_tokens,
+            cached_tokens=(usage.get("input_tokens_details") or {}).get(
+                "cached_tokens"
+            ),
+            reasoning_tokens=(usage.get("output_tokens_details") or {}).get(
+                "reasoning_tokens"
+            ),
+            latency=latency,
+            prompt_chars=None if prompt is None else len(prompt),
+        )
+        return {"output_tokens": output_tokens}
+
+    def batch_request(self, prompt: str):
+        return self._request(prompt)
+
+    def parse_batch_output(self, body):
+        self._record_usage(body.get("usage"))
+        # Raw Responses API JSON has no output_text convenience property.
+        return "".join(
+            content["text"]
+            for item in body["output"]
+            if item["type"] == "message"
+            for content in item["content"]
+            if content["type"] == "output_text"
+        )
+
+    def _stream_chunk(self, event, start, prompt):
+        if event.type == "response.output_text.delta":
+            return event.delta
+        if event.type == "response.reasoning_summary_text.delta":
+            return ""
+        if event.type == "response.completed":
+            return self._record_usage(
+                event.response.usage, time.monotonic() - start, prompt
+            )
+        return None
+
+    def generate_stream(self, prompt: str):
+
+        start = time.monotonic()
+        events = self.client.responses.create(
+            **self._request(prompt), stream=True
+        )
+        for event in events:
+            if (chunk := self._stream_chunk(event, start, prompt)) is not None:
+                yield chunk
+
+    async def agenerate_stream(self, prompt: str):
+
+        start = time.monotonic()
+        events = await self.aclient.responses.create(
+            **self._request(prompt), stream=True
         )
+        async for event in events:
+            if (chunk := self._stream_chunk(event, start, prompt)) is not None:
+                yield chunk
+
+    def generate(self, prompt: str):
+
+        start = time.monotonic()
+        response = self.client.responses.create(**self._request(prompt))
+        self._record_usage(response.usage, time.monotonic() - start, prompt)
 
         return response.output_text
 
+    async def agenerate(self, prompt: str):
+
+        start = time.monotonic()
+        response = await self.aclient.responses.create(**self._request(prompt))
+        self._record_usage(response.usage, time.monotonic() - start, prompt)
+
+        return response.output_text
+
+    def cleanup(self):
+        # The sync client is shared too, and closed the same way.
+        if self._client_key is None:
+            return
+        client = CLIENTS.release(self._client_key)
+        self._client_key = None
+        if client is not None:
+            client.close()
+
+    async def aclose(self):
+        # The async client is shared; the last model to finish closes it.
+        aclient = CLIENTS.release(self._aclient_key)
+        if aclient is not None:
+            await aclient.close()
+
 
 if __name__ == "__main__":
 
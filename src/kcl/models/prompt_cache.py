@@ -0,0 +1,39 @@
+import contextvars
+import hashlib
+from contextlib import contextmanager
+
+from .tokenizer import estimate_tokens
+
+# Providers do not cache shorter prefixes (1024 tokens for Claude Sonnet
+# and OpenAI), so no marker is sent for them.
+MIN_PREFIX_TOKENS = 1024
+
+_PREFIX_LEN = contextvars.ContextVar("kcl_prompt_prefix_len", default=None)
+
+
+@contextmanager
+def prompt_prefix(prefix_len):
+    # prefix_len characters at the start of prompts sent inside the block
+    # are shared with other prompts of the task (see prompt_layout), so
+    # backends can mark them for the provider's prompt cache.
+    token = _PREFIX_LEN.set(prefix_len)
+    try:
+        yield
+    finally:
+        _PREFIX_LEN.reset(token)
+
+
+def split_prompt(prompt: str):
+    prefix_len = _PREFIX_LEN.get()
+    if not prefix_len or not 0 < prefix_len < len(prompt):
+        return None
+    if estimate_tokens(prompt[:prefix_len]) < MIN_PREFIX_TOKENS:
+        return None
+    return prompt[:prefix_len], prompt[prefix_len:]
+
+
+def prefix_key(prompt: str):
+    parts = split_prompt(prompt)
+    if parts is None:
+        return None
+    return hashlib.sha256(parts[0].encode("utf-8")).hexdigest()[:32]
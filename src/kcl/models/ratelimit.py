@@ -0,0 +1,350 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+
+from .sampling import afan_out, fan_out
+from .tokenizer import token_counter
+from .usage import collect_usage
+from .wrapper import ModelWrapper
+
+MAX_POLL_SEC = 1.0
+
+THROTTLE_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+}
+THROTTLE_MARKERS = (
+    "429",
+    "rate limit",
+    "ratelimit",
+    "resource_exhausted",
+    "resource exhausted",
+    "too many requests",
+    "throttl",
+)
+
+
+def is_rate_limit_error(exc) -> bool:
+    # Duck-typed so that no provider SDK has to be imported here.
+    for attr in ("status_code", "code", "status"):
+        if getattr(exc, attr, None) == 429:
+            return True
+
+    response = getattr(exc, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code")
+        if code in THROTTLE_ERROR_CODES:
+            return True
+    elif getattr(response, "status_code", None) == 429:
+        return True
+
+    text = str(exc).lower()
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+
+class TokenBucket:
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(
+            self.capacity, self.level + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        # A negative amount charges tokens used beyond the reservation.
+        self.level = min(self.capacity, self.level + amount)
+
+
+class AdaptiveLimiter:
+
+    def __init__(
+        self,
+        rpm: float | None = None,
+        tpm: float | None = None,
+        max_concurrency: int = 64,
+        min_concurrency: int = 1,
+        initial_concurrency: int | None = None,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_slack: float | None = None,
+    ):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or max_concurrency)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_slack = latency_slack
+
+        self.in_flight = 0
+        self.baseline_latency = None
+        self._output_tokens = 0
+        self._outputs = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+        self.stats = {
+            "requests": 0,
+            "throttled": 0,
+            "decreases": 0,
+            "wait_sec": 0.0,
+        }
+
+    def _try_acquire(self, n_tokens):
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                return MAX_POLL_SEC / 10
+
+            now = time.monotonic()
+            wait = 0.0
+            if self.requests is not None:
+                wait = max(wait, self.requests.wait_time(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.wait_time(n_tokens, now))
+            if wait > 0:
+                return wait
+
+            if self.requests is not None:
+                self.requests.consume(1)
+            if self.tokens is not None:
+                self.tokens.consume(n_tokens)
+            self.in_flight += 1
+            self.stats["requests"] += 1
+            return 0.0
+
+    def acquire(self, n_tokens: int = 1):
+        start = time.monotonic()
+        while (wait := self._try_acquire(n_tokens)) > 0:
+            time.sleep(min(wait, MAX_POLL_SEC))
+        self._add_wait(time.monotonic() - start)
+
+    async def aacquire(self, n_tokens: int = 1):
+        start = time.monotonic()
+        while (wait := self._try_acquire(n_tokens)) > 0:
+            await asyncio.sleep(min(wait, MAX_POLL_SEC))
+        self._add_wait(time.monotonic() - start)
+
+    def output_reserve(self, max_tokens=None, n=1):
+        # Output tokens held against the token budget until the call
+        # reports its usage: the model's max_tokens, as Bedrock reserves,
+        # or else the mean output of the calls so far.
+        if max_tokens:
+            return n * max_tokens
+        with self._lock:
+            if not self._outputs:
+                return 0
+            return round(n * self._output_tokens / self._outputs)
+
+    def _add_wait(self, waited):
+        with self._lock:
+            self.stats["wait_sec"] += waited
+
+    def _decrease(self, now, reason):
+        # One decrease per round trip, otherwise a burst of 429s from the
+        # same window would collapse the limit to the minimum.
+        cooldown = self.baseline_latency or 1.0
+        if now - self._last_decrease < cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_concurrency, self.limit * self.decrease)
+        self.stats["decreases"] += 1
+        logger.debug(
+            f"Concurrency limit lowered to {self.limit:.1f} ({reason})"
+        )
+
+    def release(
+        self,
+        latency: float,
+        throttled: bool = False,
+        failed: bool = False,
+        charged: int = 0,
+        usage: dict | None = None,
+        n: int = 1,
+    ):
+        # usage, the input and output tokens the call reported, settles
+        # the charge; without it the reservation is kept.
+        with self._lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if usage is not None:
+                used = usage["input_tokens"] + usage["output_tokens"]
+                if self.tokens is not None:
+                    self.tokens.refund(charged - used)
+                self._output_tokens += usage["output_tokens"]
+                self._outputs += n
+
+            if throttled:
+                self.stats["throttled"] += 1
+                self._decrease(now, "throttled")
+                return
+            if failed:
+                return
+
+            if self.baseline_latency is None:
+                self.baseline_latency = latency
+            else:
+                # Follows improvements at once and regressions slowly.
+                self.baseline_latency = min(
+                    latency,
+                    self.baseline_latency
+                    + 0.05 * (latency - self.baseline_latency),
+                )
+
+            if (
+                self.latency_slack is not None
+                and latency > self.latency_slack * self.baseline_latency
+            ):
+                self._decrease(now, f"latency {latency:.1f}s")
+            else:
+                self.limit = min(
+                    self.max_concurrency,
+                    self.limit + self.increase / self.limit,
+                )
+
+    def summary(self):
+        with self._lock:
+            return {
+                **self.stats,
+                "concurrency_limit": round(self.limit, 2),
+            }
+
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_limiter(provider: str, model_name: str, **settings):
+    key = (provider, model_name)
+    with _LIMITERS_LOCK:
+        if key not in _LIMITERS:
+            _LIMITERS[key] = AdaptiveLimiter(**settings)
+        return _LIMITERS[key]
+
+
+class RateLimitedModel(ModelWrapper):
+
+    def __init__(self, inner, limiter: AdaptiveLimiter):
+        super().__init__(inner)
+        self.limiter = limiter
+
+    def stats_summary(self):
+        return {"rate_limit": self.limiter.summary()}
+
+    @contextmanager
+    def _call(self, n_input, charged, n=1):
+        # Releases the slot however the call ends. A cancelled call (e.g.
+        # the losing request of a hedge) counts as failed, so that its
+        # latency is not taken for the baseline. The caller fills the
+        # yielded dict with the usage the call reports.
+        start = time.monotonic()
+        throttled = failed = False
+        usage = {}
+        try:
+            yield usage
+        except BaseException as exc:
+            throttled = isinstance(exc, Exception) and is_rate_limit_error(exc)
+            failed = True
+            raise
+        finally:
+            if "output_tokens" in usage:
+                # Streams report only their output.
+                usage = {
+                    "input_tokens": usage.get("input_tokens") or n_input,
+                    "output_tokens": usage["output_tokens"],
+                }
+            else:
+                usage = None
+            self.limiter.release(
+                time.monotonic() - start,
+                throttled=throttled,
+                failed=failed,
+                charged=charged,
+                usage=usage,
+                n=n,
+            )
+
+    def _charge(self, prompt, n=1):
+        # The prompt's tokens, usually known from the dataset's token
+        # counts, and the tokens charged for the call, which also reserve
+        # its output. Async callers keep any tokenizing off the loop.
+        n_input = token_counter(self.inner).count(prompt)
+        max_tokens = getattr(self.unwrap(), "max_tokens", None)
+        return n_input, n_input + self.limiter.output_reserve(max_tokens, n)
+
+    async def _acharge(self, prompt, n=1):
+        return await asyncio.to_thread(self._charge, prompt, n)
+
+    @staticmethod
+    def _observe(usage, chunk):
+        if isinstance(chunk, dict) and chunk.get("output_tokens") is not None:
+            usage["output_tokens"] = chunk["output_tokens"]
+
+    def generate(self, prompt: str, **kwargs):
+        n_input, charged = self._charge(prompt)
+        self.limiter.acquire(charged)
+        with self._call(n_input, charged) as usage, collect_usage(usage):
+            return self.inner.generate(prompt, **kwargs)
+
+    def generate_n(self, prompt: str, n: int):
+        # Fanned-out samples are separate requests and are charged as such.
+        if not self.native_n():
+            return fan_out(self, prompt, n)
+
+        n_input, charged = self._charge(prompt, n)
+        self.limiter.acquire(charged)
+        with self._call(n_input, charged, n) as usage, collect_usage(usage):
+            return self.inner.generate_n(prompt, n)
+
+    async def agenerate_n(self, prompt: str, n: int):
+        if not self.native_n():
+            return await afan_out(self, prompt, n)
+
+        n_input, charged = await self._acharge(prompt, n)
+        await self.limiter.aacquire(charged)
+        with self._call(n_input, charged, n) as usage, collect_usage(usage):
+            return await self.inner.agenerate_n(prompt, n)
+
+    def generate_stream(self, prompt: str):
+        # The slot is held until the stream is exhausted.
+        n_input, charged = self._charge(prompt)
+        self.limiter.acquire(charged)
+        with self._call(n_input, charged) as usage:
+            for chunk in self.inner.generate_stream(prompt):
+                self._observe(usage, chunk)
+                yield chunk
+
+    async def agenerate_stream(self, prompt: str):
+        n_input, charged = await self._acharge(prompt)
+        await self.limiter.aacquire(charged)
+        with self._call(n_input, charged) as usage:
+            async for chunk in self.inner.agenerate_stream(prompt):
+                self._observe(usage, chunk)
+                yield chunk
+
+    async def agenerate(self, prompt: str, **kwargs):
+        n_input, charged = await self._acharge(prompt)
+        await self.limiter.aacquire(charged)
+        with self._call(n_input, charged) as usage, collect_usage(usage):
+            return await self.inner.agenerate(prompt, **kwargs)
@@ -0,0 +1,39 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_threads(fn, n: int):
+    # Each thread runs in a copy of the caller's context so that context
+    # variables (e.g. the usage task scope) carry over.
+    contexts = [contextvars.copy_context() for _ in range(n)]
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        return list(pool.map(lambda ctx: ctx.run(fn), contexts))
+
+
+def fan_out(model, prompt: str, n: int):
+    return run_threads(lambda: model.generate(prompt), n)
+
+
+async def afan_out(model, prompt: str, n: int):
+    return list(
+        await asyncio.gather(*(model.agenerate(prompt) for _ in range(n)))
+    )
+
+
+def generate_n(model, prompt: str, n: int):
+    if n == 1:
+        return [model.generate(prompt)]
+    # Backends that can return n candidates from one request (and the
+    # wrappers around any backend) implement generate_n themselves.
+    if hasattr(model, "generate_n"):
+        return model.generate_n(prompt, n)
+    return fan_out(model, prompt, n)
+
+
+async def agenerate_n(model, prompt: str, n: int):
+    if n == 1:
+        return [await model.agenerate(prompt)]
+    if hasattr(model, "agenerate_n"):
+        return await model.agenerate_n(prompt, n)
+    return await afan_out(model, prompt, n)
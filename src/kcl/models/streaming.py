@@ -0,0 +1,120 @@
+import asyncio
+import statistics
+import time
+
+from .sampling import run_threads
+from .tokenizer import estimate_tokens
+
+TIMING_KEYS = ("ttft", "latency", "tokens_per_sec")
+
+
+async def aiter_sync(iterator):
+    # Drives a blocking iterator from the event loop one item at a time.
+    done = object()
+    while (item := await asyncio.to_thread(next, iterator, done)) is not done:
+        yield item
+
+
+class StreamCollector:
+
+    # Streams yield text chunks ("" for reasoning deltas, which count for
+    # time to first token but are not part of the answer) and optionally
+    # dicts carrying provider usage such as {"output_tokens": n}.
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.first = None
+        self.chunks = []
+        self.usage = {}
+
+    def add(self, chunk):
+        if isinstance(chunk, dict):
+            self.usage.update(chunk)
+            return
+        if self.first is None:
+            self.first = time.monotonic()
+        self.chunks.append(chunk)
+
+    def result(self):
+        end = time.monotonic()
+        text = "".join(self.chunks)
+        if self.usage.get("cached"):
+            return text, {"cached": True}
+
+        latency = end - self.start
+        ttft = latency if self.first is None else self.first - self.start
+        output_tokens = self.usage.get("output_tokens")
+        if output_tokens is None:
+            output_tokens = estimate_tokens(text) if text else 0
+        decode = latency - ttft
+
+        return text, {
+            "ttft": round(ttft, 4),
+            "latency": round(latency, 4),
+            "output_tokens": output_tokens,
+            "tokens_per_sec": (
+                round(output_tokens / decode, 2) if decode > 0 else None
+            ),
+        }
+
+
+def check_stream(model):
+    # Fails before a run rather than on every sample.
+    backend = model.unwrap() if hasattr(model, "unwrap") else model
+    if not hasattr(backend, "generate_stream") or not getattr(
+        backend, "can_stream", True
+    ):
+        raise ValueError(
+            f"{type(backend).__name__} ({backend.model_name}) cannot "
+            "stream; run it with stream=false"
+        )
+
+
+def collect_stream(model, prompt: str):
+    collector = StreamCollector()
+    for chunk in model.generate_stream(prompt):
+        collector.add(chunk)
+    return collector.result()
+
+
+async def acollect_stream(model, prompt: str):
+    collector = StreamCollector()
+    async for chunk in model.agenerate_stream(prompt):
+        collector.add(chunk)
+    return collector.result()
+
+
+def stream_n(model, prompt: str, n: int):
+    if n == 1:
+        return [collect_stream(model, prompt)]
+    return run_threads(lambda: collect_stream(model, prompt), n)
+
+
+async def astream_n(model, prompt: str, n: int):
+    return list(
+        await asyncio.gather(
+            *(acollect_stream(model, prompt) for _ in range(n))
+        )
+    )
+
+
+def _percentile(values, q):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def summarize_timings(timings):
+    timings = [t for t in timings if not t.get("cached")]
+    summary = {"samples": len(timings)}
+    for key in TIMING_KEYS:
+        values = sorted(t[key] for t in timings if t.get(key) is not None)
+        if not values:
+            continue
+        summary[key] = {
+            "mean": round(statistics.fmean(values), 4),
+            "p50": round(_percentile(values, 50), 4),
+            "p90": round(_percentile(values, 90), 4),
+        }
+    summary["output_tokens"] = sum(t.get("output_tokens", 0) for t in timings)
+    return summary
@@ -0,0 +1,278 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+from loguru import logger
+
+# Approximate characters per token on Korean legal text, for providers
+# without a local tokenizer (Claude) or when the optional tokenizer
+# packages are missing, until enough calls are recorded to fit the ratio
+# (see CALIBRATION_PATH). Hangul splits into more tokens than Latin text.
+CHARS_PER_TOKEN = {
+    "bedrock": 1.5,
+    "vertex": 2.0,
+    "openai": 1.8,
+    "local": 1.5,
+}
+DEFAULT_CHARS_PER_TOKEN = 1.5
+
+# With chars_per_token=calibrated, the ratio is fitted per model to the
+# characters and input tokens of past calls, kept in this file. This is
+# opt-in, since the ratio then depends on the machine's history; runs
+# record the ratio they used.
+CALIBRATED = "calibrated"
+CALIBRATION_PATH = Path(
+    os.getenv(
+        "KCL_CALIBRATION_PATH",
+        Path.home() / ".cache" / "kcl" / "chars_per_token.json",
+    )
+)
+# Input tokens recorded before a fitted ratio is trusted.
+MIN_CALIBRATION_TOKENS = 50_000
+
+# Input limits of API models whose output has a separate allowance.
+PROMPT_LIMITS = {
+    "gemini-2.5-flash": 1_048_576,
+    "gemini-2.5-pro": 1_048_576,
+    "gpt-5-2025-08-07": 272_000,
+    "gpt-5-mini-2025-08-07": 272_000,
+}
+# Context windows that the prompt shares with the output, as do those
+# local models report. The prompt gets what is left after the model's
+# max_tokens, or else the most output the model can give.
+CONTEXT_WINDOWS = {
+    "us.anthropic.claude-3-7-sonnet-20250219-v1:0": 200_000,
+    "us.anthropic.claude-sonnet-4-20250514-v1:0": 200_000,
+    "us.anthropic.claude-opus-4-20250514-v1:0": 200_000,
+    "gpt-4.1-2025-04-14": 1_047_576,
+    "o3-2025-04-16": 200_000,
+    "o4-mini-2025-04-16": 200_000,
+}
+MAX_OUTPUT_TOKENS = {
+    "gpt-4.1-2025-04-14": 32_768,
+    "o3-2025-04-16": 100_000,
+    "o4-mini-2025-04-16": 100_000,
+}
+# Room for the chat template and for error in the local counts.
+PROMPT_MARGIN = 256
+# Exact counts kept by text digest, so that the prompts counted for a
+# dataset are not tokenized again when they are sent.
+MAX_KNOWN_COUNTS = 200_000
+
+
+_chars_per_token = None
+
+
+def set_chars_per_token(value):
+    # None for the ratios above, CALIBRATED, or a fixed ratio, e.g. the one
+    # recorded by an earlier run.
+    global _chars_per_token
+    if value is not None and value != CALIBRATED:
+        value = float(value)
+    _chars_per_token = value
+
+
+def estimate_tokens(text: str, chars_per_token=DEFAULT_CHARS_PER_TOKEN):
+    return max(1, round(len(text) / chars_per_token))
+
+
+def _read_calibration():
+    try:
+        return json.loads(CALIBRATION_PATH.read_text())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring calibration in {CALIBRATION_PATH}: {e}")
+        return {}
+
+
+def calibrated_chars_per_token(model_name):
+    totals = _read_calibration().get(model_name or "")
+    if not totals or totals["tokens"] < MIN_CALIBRATION_TOKENS:
+        return None
+    return totals["chars"] / totals["tokens"]
+
+
+def update_calibration(model):
+    # Adds the prompt lengths and input tokens the model's calls reported
+    # this run to the totals on disk, when calibrating.
+    if _chars_per_token != CALIBRATED:
+        return
+    if hasattr(model, "unwrap"):
+        model = model.unwrap()
+    history = getattr(model, "usage_history", None)
+    if history is None or not hasattr(history, "calibration"):
+        return
+    chars, tokens = history.calibration()
+    if not tokens:
+        return
+    CALIBRATION_PATH.parent.mkdir(parents=True, exist_ok=True)
+    # Queue workers and sweeps may finish at once; each adds its totals
+    # under an exclusive lock.
+    with open(CALIBRATION_PATH.with_suffix(".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        calibration = _read_calibration()
+        totals = calibration.setdefault(
+            model.model_name, {"chars": 0, "tokens": 0}
+        )
+        totals["chars"] += chars
+        totals["tokens"] += tokens
+        tmp = CALIBRATION_PATH.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(calibration, indent=2, sort_keys=True))
+        os.replace(tmp, CALIBRATION_PATH)
+
+
+class TokenCounter:
+
+    def __init__(self, count_batch=None, chars_per_token=None):
+        self._count_batch = count_batch
+        self.chars_per_token = chars_per_token or DEFAULT_CHARS_PER_TOKEN
+        self._lock = threading.Lock()
+        self._known = {}
+
+    @property
+    def exact(self):
+        return self._count_batch is not None
+
+    def count_batch(self, texts):
+        texts = list(texts)
+        if self._count_batch is None:
+            return [estimate_tokens(t, self.chars_per_token) for t in texts]
+
+        keys = [
+            hashlib.blake2b(t.encode("utf-8"), digest_size=16).digest()
+            for t in texts
+        ]
+        counts = [self._known.get(key) for key in keys]
+        missing = [i for i, n in enumerate(counts) if n is None]
+        if missing:
+            # Not every tokenizer backend is safe to call from several
+            # threads.
+            with self._lock:
+                new = self._count_batch([texts[i] for i in missing])
+                if len(self._known) + len(missing) > MAX_KNOWN_COUNTS:
+                    self._known.clear()
+                for i, n in zip(missing, new):
+                    counts[i] = self._known[keys[i]] = n
+        return counts
+
+    def count(self, text: str) -> int:
+        return self.count_batch([text])[0]
+
+
+def _tiktoken_counter(model_name):
+    import tiktoken
+
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return lambda texts: [
+        len(ids) for ids in encoding.encode_ordinary_batch(texts)
+    ]
+
+
+def _gemini_counter(model_name):
+    from google.genai.local_tokenizer import LocalTokenizer
+
+    tokenizer = LocalTokenizer(model_name)
+    return lambda texts: [
+        tokenizer.count_tokens(text).total_tokens for text in texts
+    ]
+
+
+def _hf_counter(model_name):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    return lambda texts: [
+        len(ids)
+        for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]
+    ]
+
+
+_LOADERS = {
+    "openai": _tiktoken_counter,
+    "vertex": _gemini_counter,
+    "local": _hf_counter,
+}
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(provider, model_name, chars_per_token=None):
+    # Tokenizer files are downloaded once and cached locally by each
+    # library; afterwards counting never leaves the process.
+    count_batch = None
+    loader = _LOADERS.get(provider)
+    if loader is not None:
+        try:
+            count_batch = loader(model_name)
+        except Exception as e:
+            logger.warning(
+                f"No local tokenizer for {model_name} ({e}); "
+                "estimating token counts from text length"
+            )
+    if count_batch is not None:
+        return TokenCounter(count_batch)
+    if chars_per_token == CALIBRATED:
+        chars_per_token = calibrated_chars_per_token(model_name)
+        if chars_per_token:
+            logger.info(
+                f"Estimating tokens of {model_name} at "
+                f"{chars_per_token:.2f} characters per token, fitted to "
+                "past calls"
+            )
+    return TokenCounter(None, chars_per_token or CHARS_PER_TOKEN.get(provider))
+
+
+def token_counter(model):
+    if hasattr(model, "unwrap"):
+        model = model.unwrap()
+    return get_token_counter(
+        getattr(model, "provider", None),
+        getattr(model, "model_name", None),
+        _chars_per_token,
+    )
+
+
+def estimated_chars_per_token(model):
+    # The ratio behind the model's token counts, or None if they are exact.
+    counter = token_counter(model)
+    return None if counter.exact else counter.chars_per_token
+
+
+def prompt_budget(model, max_prompt_tokens=None):
+    # Prompt tokens a model can take, capped by max_prompt_tokens; None
+    # when neither is known.
+    if hasattr(model, "unwrap"):
+        model = model.unwrap()
+    name = (getattr(model, "model_name", "") or "").lower()
+    budget = PROMPT_LIMITS.get(name)
+    window = getattr(model, "context_window", None) or CONTEXT_WINDOWS.get(
+        name
+    )
+    if window:
+        max_tokens = getattr(model, "max_tokens", None)
+        if max_tokens is None:
+            max_tokens = MAX_OUTPUT_TOKENS.get(name, 0)
+        budget = window - max_tokens - PROMPT_MARGIN
+    if max_prompt_tokens is not None:
+        budget = (
+            max_prompt_tokens
+            if budget is None
+            else min(budget, max_prompt_tokens)
+        )
+    return budget
+
+
+def add_token_counts(ds, counter, column="input_text"):
+    # Counted once per rendered dataset; records carry the column along.
+    return ds.map(
+        lambda batch: {"n_prompt_tokens": counter.count_batch(batch[column])},
+        batched=True,
+        load_from_cache_file=False,
+    )
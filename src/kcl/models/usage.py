@@ -0,0 +1,180 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+
+# USD per million tokens: (input, cached input, output). Reasoning tokens
+# are billed as output and are already included in output_tokens.
+PRICING = {
+    "us.anthropic.claude-3-7-sonnet-20250219-v1:0": (3.0, 0.3, 15.0),
+    "us.anthropic.claude-sonnet-4-20250514-v1:0": (3.0, 0.3, 15.0),
+    "us.anthropic.claude-opus-4-20250514-v1:0": (15.0, 1.5, 75.0),
+    "gemini-2.5-flash": (0.3, 0.075, 2.5),
+    "gemini-2.5-pro": (1.25, 0.31, 10.0),
+    "gpt-4.1-2025-04-14": (2.0, 0.5, 8.0),
+    "o3-2025-04-16": (2.0, 0.5, 8.0),
+    "o4-mini-2025-04-16": (1.1, 0.275, 4.4),
+    "gpt-5-2025-08-07": (1.25, 0.125, 10.0),
+    "gpt-5-mini-2025-08-07": (0.25, 0.025, 2.0),
+}
+
+TOKEN_KEYS = (
+    "input_tokens",
+    "cached_tokens",
+    "output_tokens",
+    "reasoning_tokens",
+)
+
+_TASK = contextvars.ContextVar("kcl_usage_task", default=None)
+_SINK = contextvars.ContextVar("kcl_usage_sink", default=None)
+
+
+@contextmanager
+def usage_scope(task_name):
+    # Calls made inside the block are attributed to task_name.
+    token = _TASK.set(task_name)
+    try:
+        yield
+    finally:
+        _TASK.reset(token)
+
+
+@contextmanager
+def collect_usage(sink):
+    # Adds the input and output tokens of calls recorded inside the block
+    # to the sink dict.
+    token = _SINK.set(sink)
+    try:
+        yield sink
+    finally:
+        _SINK.reset(token)
+
+
+def call_cost(model_name, usage):
+    price = PRICING.get(model_name.lower())
+    if price is None:
+        return None
+    input_price, cached_price, output_price = price
+    uncached = usage["input_tokens"] - usage["cached_tokens"]
+    return (
+        uncached * input_price
+        + usage["cached_tokens"] * cached_price
+        + usage["output_tokens"] * output_price
+    ) / 1e6
+
+
+class UsageHistory:
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._calls = []
+
+    def record(
+        self,
+        input_tokens=0,
+        output_tokens=0,
+        cached_tokens=0,
+        reasoning_tokens=0,
+        latency=None,
+        prompt_chars=None,
+    ):
+        # input_tokens includes cached_tokens and output_tokens includes
+        # reasoning_tokens, whatever the provider's own convention.
+        # prompt_chars, the length of the prompt sent, calibrates token
+        # estimates; it is left out where the input is not the prompt
+        # alone (batch outputs, explicit context caches).
+        usage = {
+            "task": _TASK.get(),
+            "input_tokens": input_tokens or 0,
+            "cached_tokens": cached_tokens or 0,
+            "output_tokens": output_tokens or 0,
+            "reasoning_tokens": reasoning_tokens or 0,
+            "latency": latency,
+            "prompt_chars": prompt_chars,
+        }
+        usage["cost"] = call_cost(self.model_name, usage)
+        with self._lock:
+            self._calls.append(usage)
+            sink = _SINK.get()
+            if sink is not None:
+                for key in ("input_tokens", "output_tokens"):
+                    sink[key] = sink.get(key, 0) + usage[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._calls)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._calls))
+
+    def calibration(self):
+        # Prompt characters and input tokens of the calls that know both.
+        chars = tokens = 0
+        for usage in self:
+            if usage["prompt_chars"] and usage["input_tokens"]:
+                chars += usage["prompt_chars"]
+                tokens += usage["input_tokens"]
+        return chars, tokens
+
+    def summary(self):
+        tasks = {}
+        for usage in self:
+            task = tasks.setdefault(
+                usage["task"] or "-",
+                {"calls": 0, **{k: 0 for k in TOKEN_KEYS}, "cost": None},
+            )
+            task["calls"] += 1
+            for key in TOKEN_KEYS:
+                task[key] += usage[key]
+            if usage["latency"] is not None:
+                task["latency_sum"] = (
+                    task.get("latency_sum", 0.0) + usage["latency"]
+                )
+            if usage["cost"] is not None:
+                task["cost"] = (task["cost"] or 0.0) + usage["cost"]
+
+        for task in tasks.values():
+            latency_sum = task.pop("latency_sum", None)
+            task["mean_latency"] = (
+                round(latency_sum / task["calls"], 3)
+                if latency_sum is not None
+                else None
+            )
+            task["cache_hit_rate"] = (
+                round(task["cached_tokens"] / task["input_tokens"], 4)
+                if task["input_tokens"]
+                else None
+            )
+            if task["cost"] is not None:
+                task["cost"] = round(task["cost"], 4)
+        return dict(sorted(tasks.items()))
+
+
+def usage_summary(model):
+    history = getattr(model, "usage_history", None)
+    if not isinstance(history, UsageHistory) or not len(history):
+        return {}
+    return history.summary()
+
+
+def usage_markdown(summary):
+    lines = [
+        "| Task Name | Calls | Input Tokens | Cached Tokens | Cache Hit "
+        "| Output Tokens | Reasoning Tokens | Mean Latency (s) | Cost (USD) |",
+        "| --- | --- | --- | --- | --- | --- | --- | --- | --- |",
+    ]
+    for task_name, usage in summary.items():
+        latency = usage["mean_latency"]
+        cost = usage["cost"]
+        hit_rate = usage.get("cache_hit_rate")
+        lines.append(
+            f"| {task_name} | {usage['calls']} | {usage['input_tokens']} "
+            f"| {usage['cached_tokens']} "
+            f"| {'-' if hit_rate is None else f'{hit_rate:.1%}'} "
+            f"| {usage['output_tokens']} "
+            f"| {usage['reasoning_tokens']} "
+            f"| {'-' if latency is None else f'{latency:.2f}'} "
+            f"| {'-' if cost is None else f'{cost:.4f}'} |"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,52 @@
+from .sampling import agenerate_n, generate_n
+
+
+class ModelWrapper:
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def __getattr__(self, name):
+        # Only reached for attributes the wrapper does not define itself.
+        return getattr(self.inner, name)
+
+    def generate(self, prompt: str, **kwargs):
+        return self.inner.generate(prompt, **kwargs)
+
+    async def agenerate(self, prompt: str, **kwargs):
+        return await self.inner.agenerate(prompt, **kwargs)
+
+    def generate_n(self, prompt: str, n: int):
+        return generate_n(self.inner, prompt, n)
+
+    async def agenerate_n(self, prompt: str, n: int):
+        return await agenerate_n(self.inner, prompt, n)
+
+    def generate_stream(self, prompt: str):
+        yield from self.inner.generate_stream(prompt)
+
+    async def agenerate_stream(self, prompt: str):
+        async for chunk in self.inner.agenerate_stream(prompt):
+            yield chunk
+
+    def native_n(self):
+        return hasattr(self.unwrap(), "generate_n")
+
+    def unwrap(self):
+        model = self.inner
+        while isinstance(model, ModelWrapper):
+            model = model.inner
+        return model
+
+    def stats_summary(self):
+        return {}
+
+
+def wrapper_stats(model):
+    stats = {}
+    while isinstance(model, ModelWrapper):
+        stats.update(model.stats_summary())
+        model = model.inner
+    if hasattr(model, "stats_summary"):
+        stats.update(model.stats_summary())
+    return stats
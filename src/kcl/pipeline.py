@@ -0,0 +1,362 @@
+import asyncio
+import json
+import logging
+import math
+from collections import defaultdict
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+
+import hydra
+import yaml
+from hydra.core.hydra_config import HydraConfig
+from loguru import logger
+from omegaconf import DictConfig, OmegaConf, open_dict
+
+from kcl.evaluation.eval import ajudge_sample, format_ci, save_eval_results
+from kcl.evaluation.judges import get_judge
+from kcl.evaluation.utils.bootstrap import CONFIDENCE, bootstrap_ci
+from kcl.inference.engine import AsyncEngine, aclose_model
+from kcl.inference.infer import aprocess, collect_timings
+from kcl.inference.results import (
+    SAMPLE_ID,
+    JsonlWriter,
+    enumerate_samples,
+    export_json,
+)
+from kcl.inference.scheduler import load_output_lengths, lpt_order
+from kcl.models import get_model
+from kcl.models.clients import client_stats, set_pool_size
+from kcl.models.streaming import check_stream, summarize_timings
+from kcl.models.tokenizer import (
+    add_token_counts,
+    estimated_chars_per_token,
+    prompt_budget,
+    set_chars_per_token,
+    token_counter,
+    update_calibration,
+)
+from kcl.models.usage import usage_markdown, usage_summary
+from kcl.models.wrapper import wrapper_stats
+from kcl.tasks import get_loader
+from kcl.tasks.sampling import sample_size, stratified_order
+from kcl.tasks.truncation import fit_prompts
+
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_START_FRACTION = 0.1
+
+
+class AdaptiveSample:
+
+    # Grows a stratified sample of the task, growth times larger each
+    # round, until the confidence interval of the score is at most
+    # target_width wide or max_samples are done.
+
+    def __init__(
+        self,
+        pending,
+        target_width,
+        growth=2.0,
+        fraction=None,
+        max_samples=None,
+        seed=0,
+        schedule=None,
+    ):
+        # pending is in dataset order, so the order (and each sample) is
+        # the same as get_loader's with sample_fraction.
+        metas = [sample["meta"] for _, _, sample in pending]
+        self.order = [pending[i] for i in stratified_order(metas, seed)]
+        self.limit = sample_size(len(pending), None, max_samples)
+        self.size = min(
+            self.limit,
+            sample_size(len(pending), fraction or DEFAULT_START_FRACTION),
+        )
+        self.target_width = target_width
+        self.growth = growth
+        self.schedule = schedule or (lambda batch: batch)
+        self.rounds = []
+
+    def first(self):
+        return self.schedule(self.order[: self.size])
+
+    def grow(self, judged):
+        # In sample_id order, as in the saved summary.
+        items = sorted(
+            (result for results in judged.values() for result in results),
+            key=lambda r: r[SAMPLE_ID],
+        )
+        ci = bootstrap_ci(items)
+        width = ci[1] - ci[0] if ci else float("inf")
+        self.rounds.append(
+            {"n_samples": len(items), "ci": ci, "ci_width": width}
+        )
+        logger.info(
+            f"{len(items)}/{len(self.order)} samples: {CONFIDENCE:.0%} CI "
+            f"{format_ci(ci)} (width {width:.2%}, target {self.target_width:.2%})"
+        )
+        if width <= self.target_width or self.size >= self.limit:
+            return []
+        start = self.size
+        self.size = min(self.limit, math.ceil(self.size * self.growth))
+        return self.schedule(self.order[start : self.size])
+
+
+def model_stats(model):
+    stats = wrapper_stats(model)
+    usage = usage_summary(model)
+    update_calibration(model)
+    if usage:
+        stats["usage"] = usage
+    return stats
+
+
+async def judge_worker(judge, queue, judged):
+    while (item := await queue.get()) is not None:
+        task_name, record = item
+        try:
+            result = await ajudge_sample(judge, record, task_name)
+        except Exception as exc:
+            logger.warning(
+                f"Judging {task_name}/{record[SAMPLE_ID]} failed: {exc}"
+            )
+            result = {
+                **record,
+                "judge_error": str(exc),
+                "normalized_score_sum": 0,
+            }
+        judged[task_name].append(result)
+        queue.task_done()
+
+
+async def run_pipeline(
+    engine,
+    model,
+    judge,
+    pending,
+    writers,
+    judge_concurrency,
+    queue_size,
+    stream=False,
+    grow=None,
+):
+    # Each finished generation is handed to the judges right away; the
+    # bounded queue holds generation back if judging falls behind.
+    # grow(judged), if given, returns more samples once everything so
+    # far is judged, or nothing to stop.
+    queue = asyncio.Queue(maxsize=queue_size)
+    judged = defaultdict(list)
+    workers = [
+        asyncio.create_task(judge_worker(judge, queue, judged))
+        for _ in range(judge_concurrency)
+    ]
+
+    async def produce(sample, task_name, sample_id):
+        task_name, record = await aprocess(
+            model, sample, task_name, sample_id, stream
+        )
+        writers[task_name].write(record)
+        await queue.put((task_name, record))
+
+    judge_model = getattr(judge, "model", None)
+    try:
+        while pending:
+            await engine.amap(
+                produce,
+                [(s, t, i) for t, i, s in pending],
+                provider=model.provider,
+                desc="Generating and judging",
+            )
+            await queue.join()
+            pending = grow(judged) if grow is not None else []
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await aclose_model(model)
+        if judge_model is not None:
+            await aclose_model(judge_model)
+    return judged
+
+
+@hydra.main(version_base=None, config_path=None, config_name=None)
+def main(cfg: DictConfig):
+
+    logging.getLogger("httpx").propagate = cfg.verbose
+    logging.getLogger("google_genai.models").propagate = cfg.verbose
+
+    set_pool_size(
+        cfg.get("n_jobs", 1),
+        cfg.get("judge_concurrency"),
+        *(cfg.get("concurrency") or {}).values(),
+    )
+    model_kwargs = {
+        "num_samples": cfg.get("num_samples", 1),
+        **cfg.get("model_kwargs", {}),
+    }
+    model = get_model(
+        cfg.model_name,
+        rate_limit=cfg.get("rate_limit"),
+        cache=cfg.get("cache"),
+        hedge=cfg.get("hedge"),
+        **model_kwargs,
+    )
+    if cfg.get("stream", False):
+        check_stream(model)
+    judge = get_judge(cfg.tasks, **cfg["judge_model"])
+
+    tasks_kwargs = OmegaConf.to_container(cfg.tasks_kwargs)
+    target_ci_width = cfg.get("target_ci_width")
+    if target_ci_width:
+        # The sample grows from sample_fraction up to max_samples, so the
+        # whole task is loaded.
+        sample_fraction = tasks_kwargs.pop("sample_fraction", None)
+        max_samples = tasks_kwargs.pop("max_samples", None)
+
+    set_chars_per_token(cfg.get("chars_per_token"))
+    loader = get_loader(cfg.tasks, **tasks_kwargs)
+    counter = token_counter(model)
+    task = add_token_counts(loader.load(), counter)
+    budget = prompt_budget(model, cfg.get("max_prompt_tokens"))
+    if budget is not None:
+        task = fit_prompts(loader, task, counter, budget)
+    pending = [
+        (task._info.config_name, sample_id, sample)
+        for sample_id, sample in enumerate_samples(task)
+    ]
+
+    # The inference half is laid out exactly like an infer.py run, so
+    # eval.py can still re-judge it later.
+    run_dir = Path(HydraConfig.get().runtime.output_dir)
+    save_root = run_dir / "results"
+    cfg_name = HydraConfig.get().job.config_name
+    chars_per_token = estimated_chars_per_token(model)
+    if chars_per_token is not None:
+        # Saved with the run config, so that running it again counts and
+        # cuts the prompts the same way.
+        with open_dict(cfg):
+            cfg.chars_per_token = chars_per_token
+        OmegaConf.save(cfg, run_dir / ".hydra" / "config.yaml")
+    writers = {
+        task_name: JsonlWriter(save_root / task_name / f"{cfg_name}.jsonl")
+        for task_name in dict.fromkeys(t for t, _, _ in pending)
+    }
+
+    schedule = None
+    if cfg.get("schedule", "lpt") == "lpt":
+        history_from = cfg.get("cost_history_from")
+        output_lengths = (
+            load_output_lengths(history_from, writers) if history_from else {}
+        )
+        schedule = partial(lpt_order, output_lengths=output_lengths)
+
+    adaptive = None
+    if target_ci_width:
+        adaptive = AdaptiveSample(
+            pending,
+            target_ci_width,
+            growth=cfg.get("growth_factor") or 2.0,
+            fraction=sample_fraction,
+            max_samples=max_samples,
+            seed=tasks_kwargs.get("sample_seed", 0),
+            schedule=schedule,
+        )
+        pending = adaptive.first()
+    elif schedule is not None:
+        pending = schedule(pending)
+
+    n_jobs = cfg.get("n_jobs", 1)
+    stream = cfg.get("stream", False)
+    engine = AsyncEngine(
+        concurrency=cfg.get("concurrency"),
+        default_concurrency=n_jobs,
+    )
+    try:
+        judged = asyncio.run(
+            run_pipeline(
+                engine,
+                model,
+                judge,
+                pending,
+                writers,
+                judge_concurrency=cfg.get("judge_concurrency") or n_jobs,
+                queue_size=cfg.get("queue_size") or DEFAULT_QUEUE_SIZE,
+                stream=stream,
+                grow=adaptive.grow if adaptive is not None else None,
+            )
+        )
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    run_stats = model_stats(model)
+    if chars_per_token is not None:
+        run_stats["chars_per_token"] = chars_per_token
+    if adaptive is not None:
+        run_stats["adaptive_sample"] = adaptive.rounds
+    # Inference and judge clients are shared, so they are reported once.
+    clients = client_stats()
+    if clients:
+        run_stats["clients"] = clients
+    if stream:
+        timings = collect_timings(w.path for w in writers.values())
+        if timings:
+            run_stats["streaming"] = summarize_timings(timings)
+    if run_stats.get("usage"):
+        (save_root / "a_usage_summary.md").write_text(
+            usage_markdown(run_stats["usage"])
+        )
+    if run_stats:
+        logger.info(f"Inference run stats: {run_stats}")
+        (run_dir / "run_stats.json").write_text(
+            json.dumps(run_stats, ensure_ascii=False, indent=4)
+        )
+
+    if hasattr(model, "cleanup"):
+        model.cleanup()
+    judge_model = getattr(judge, "model", None)
+    if hasattr(judge_model, "cleanup"):
+        judge_model.cleanup()
+
+    for task_name, writer in writers.items():
+        out_file = writer.path.with_suffix(".json")
+        n_samples = export_json(writer.path, out_file)
+        logger.info(f"Saved {task_name}: {n_samples} → {out_file}")
+
+    # Same layout as scripts/eval/run_eval.sh on this inference run.
+    eval_dir = (
+        Path(cfg.get("eval_root", "outputs_eval"))
+        / cfg.tasks
+        / run_dir.parent.name
+        / run_dir.name
+        / datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    )
+    eval_dir.mkdir(parents=True, exist_ok=True)
+    (eval_dir / "inference_configs.yaml").write_text(
+        yaml.safe_dump(
+            OmegaConf.to_container(cfg, resolve=True), allow_unicode=True
+        )
+    )
+
+    judge_stats = model_stats(getattr(judge, "model", None))
+    if judge_stats:
+        logger.info(f"Judge run stats: {judge_stats}")
+        (eval_dir / "run_stats.json").write_text(
+            json.dumps(judge_stats, ensure_ascii=False, indent=4)
+        )
+
+    final_results = {
+        task_name: sorted(results, key=lambda r: r[SAMPLE_ID])
+        for task_name, results in judged.items()
+    }
+    save_eval_results(
+        eval_dir / cfg.model_name / cfg.tasks / "results",
+        final_results,
+        judge_stats.get("usage"),
+    )
+    logger.info(f"Saved evaluation results → {eval_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,115 @@
-import json
+import os
 
-from datasets import load_dataset
+from .rendering import load_rendered
+from .sampling import stratified_sample
+
+PROMPT_LAYOUTS = ("default", "cache_optimized")
 
 
 class KCLEssay:
+
+    config_name = "kcl_essay"
+    template_version = 2
+
     def __init__(
         self,
         with_precedents=False,
+        prompt_layout="default",
+        revision=None,
+        snapshot=None,
+        num_proc=None,
+        use_cache=True,
+        sample_fraction=None,
+        max_samples=None,
+        sample_seed=0,
     ) -> None:
+        if prompt_layout not in PROMPT_LAYOUTS:
+            raise ValueError(
+                f"Unknown prompt_layout: {prompt_layout!r}. Available: {PROMPT_LAYOUTS}"
+            )
         self.with_precedents = with_precedents
-        self.long_precedents = [
-            "변호사시험 08회 공법 제1문의 1",
-            "변호사시험 10회 형사법 제2문 1.",
-            "변호사시험 11회 형사법 제1문 3. (나)",
-            "변호사시험 11회 형사법 제2문 1. (가)",
-            "변호사시험 12회 민사법 제3문의 1 1. 가.",
-            "변호사시험 12회 민사법 제3문의 1 1. 나.",
-            "변호사시험 12회 형사법 제2문 1. 가.",
-            "변호사시험 13회 민사법 제1문의 5 1.",
-            "변호사시험 13회 민사법 제3문 5.",
-            "변호사시험 14회 형사법 제1문 2.",
-            "변호사시험 14회 형사법 제2문 1.",
-        ]
-
-    def _concat_columns(self, example):
+        self.prompt_layout = prompt_layout
+        self.revision = revision
+        self.snapshot = snapshot or os.getenv("KCL_DATASET_SNAPSHOT")
+        self.num_proc = num_proc
+        self.use_cache = use_cache
+        self.sample_fraction = sample_fraction
+        self.max_samples = max_samples
+        self.sample_seed = sample_seed
+        # Set by load(); maps precedent_ids to case names and texts.
+        self.precedents = None
+
+    def _cases(self, ids, cuts=None):
+        # cuts maps precedent ids to the number of characters kept.
+        cases = self.precedents.get_many(ids)
+        if cuts:
+            cases = [
+                (case_name, case_content[: cuts.get(pid)])
+                for pid, (case_name, case_content) in zip(ids, cases)
+            ]
+        return cases
+
+    def _concat_columns(self, example, cuts=None):
         input_text = "다음은 변호사 시험 사례형 문제입니다.\n\n"
         input_text += f'문제: "{example["question"]}"\n\n'
         if self.with_precedents:
 
             input_text += "[참고판례]:\n"
 
-            for content in example["supporting_precedents"]:
-                content_dict = json.loads(content)
-                for case_name, case_content in content_dict.items():
-                    if example["meta"] in self.long_precedents:
-                        input_text += "\n".join(
-                            [case_name, case_content.split("\n\n사건")[0]]
-                        )
-                    else:
-                        input_text += "\n".join([case_name, case_content])
+            for ids in example["precedent_ids"]:
+                for case_name, case_content in self._cases(ids, cuts):
+                    input_text += "\n".join([case_name, case_content])
 
                 input_text += "\n\n"
 
         return {"input_text": input_text.strip()}
 
-    def load(self):
+    def _precedent_block(self, example, cuts=None):
+        # Sorted by case name so that questions citing the same cases
+        # share the same prompt prefix.
+        cases = {}
+        for ids in example["precedent_ids"]:
+            cases.update(self._cases(ids, cuts))
 
-        ds = load_dataset("lbox/kcl", "kcl_essay", split="test")
-        ds = ds.map(self._concat_columns, load_from_cache_file=False)
+        input_text = "[참고판례]:\n"
+        for case_name in sorted(cases):
+            input_text += "\n".join([case_name, cases[case_name]])
+            input_text += "\n\n"
+        return input_text
+
+    def _concat_columns_cache_optimized(self, example, cuts=None):
+        # Precedents before the question: the part before the question is
+        # reusable by provider prompt caches.
+        prefix = "다음은 변호사 시험 사례형 문제입니다.\n\n"
+        if self.with_precedents:
+            prefix += self._precedent_block(example, cuts)
+
+        input_text = prefix + f'문제: "{example["question"]}"'
+        return {"input_text": input_text, "prompt_prefix_len": len(prefix)}
+
+    def render(self, example, cuts=None):
+        if self.prompt_layout == "cache_optimized":
+            return self._concat_columns_cache_optimized(example, cuts)
+        return self._concat_columns(example, cuts)
+
+    def load(self):
 
-        return ds
+        ds = load_rendered(
+            self,
+            self.render,
+            {
+                "with_precedents": self.with_precedents,
+                "prompt_layout": self.prompt_layout,
+            },
+            revision=self.revision,
+            snapshot=self.snapshot,
+            num_proc=self.num_proc,
+            use_cache=self.use_cache,
+        )
+        # Sampled after rendering, so the cached rendering is shared.
+        return stratified_sample(
+            ds, self.sample_fraction, self.max_samples, self.sample_seed
+        )
 
     def __call__(self):
         return self.load()
@@ -1,17 +1,57 @@
-import json
+import os
 
-from datasets import load_dataset
+from .rendering import load_rendered
+from .sampling import stratified_sample
+
+PROMPT_LAYOUTS = ("default", "cache_optimized")
 
 
 class KCLMCQA:
 
+    config_name = "kcl_mcqa"
+    # Bump when the rendered prompt text changes, so that cached
+    # renderings are not reused.
+    template_version = 1
+
     def __init__(
         self,
         with_precedents=False,
+        prompt_layout="default",
+        revision=None,
+        snapshot=None,
+        num_proc=None,
+        use_cache=True,
+        sample_fraction=None,
+        max_samples=None,
+        sample_seed=0,
     ) -> None:
+        if prompt_layout not in PROMPT_LAYOUTS:
+            raise ValueError(
+                f"Unknown prompt_layout: {prompt_layout!r}. Available: {PROMPT_LAYOUTS}"
+            )
         self.with_precedents = with_precedents
-
-    def _concat_columns(self, example):
+        self.prompt_layout = prompt_layout
+        self.revision = revision
+        self.snapshot = snapshot or os.getenv("KCL_DATASET_SNAPSHOT")
+        self.num_proc = num_proc
+        self.use_cache = use_cache
+        self.sample_fraction = sample_fraction
+        self.max_samples = max_samples
+        self.sample_seed = sample_seed
+        # Set by load(); maps precedent_ids to case names and texts.
+        self.precedents = None
+
+    def _cases(self, ids, cuts=None):
+        # cuts maps precedent ids to the number of characters kept.
+        cases = self.precedents.get_many(ids)
+        if cuts:
+            cases = [
+                (case_name, case_content[: cuts.get(pid)])
+                for pid, (case_name, case_content) in zip(ids, cases)
+            ]
+        return cases
+
+    def _concat_columns(self, example, cuts=None):
 
         input_text = "다음은 변호사 시험 선택형 문제입니다.\n\n"
         input_text += f'문제: "{example["question"]}"\n\n'
@@ -27,26 +67,76 @@ class KCLMCQA:
             "위의 문제와 각 선택지를 읽고 A, B, C, D, E 중 최종 답변을 출력하세요. "
             '최종 답변은 가장 마지막에 "정답은 X입니다." 와 같이 답해 주세요.\n'
         )
-    
+
         if self.with_precedents:
             input_text += "[참고판례]:\n"
 
-            for content in example["supporting_precedents"]:
-                content_dict = json.loads(content)
-                for case_name, case_content in content_dict.items():
+            for ids in example["precedent_ids"]:
+                for case_name, case_content in self._cases(ids, cuts):
                     input_text += "\n".join([case_name, case_content])
                 input_text += "\n\n"
 
-        
-
         return {"input_text": input_text.strip()}
 
-    def load(self):
+    def _precedent_block(self, example, cuts=None):
+        # Sorted by case name so that questions citing the same cases
+        # share the same prompt prefix.
+        cases = {}
+        for ids in example["precedent_ids"]:
+            cases.update(self._cases(ids, cuts))
+
+        input_text = "[참고판례]:\n"
+        for case_name in sorted(cases):
+            input_text += "\n".join([case_name, cases[case_name]])
+            input_text += "\n\n"
+        return input_text
+
+    def _concat_columns_cache_optimized(self, example, cuts=None):
+        # Static instruction, then precedents, then the question: the
+        # part before the question is reusable by provider prompt caches.
+        prefix = "다음은 변호사 시험 선택형 문제입니다.\n"
+        prefix += (
+            "아래 문제와 각 선택지를 읽고 A, B, C, D, E 중 최종 답변을 출력하세요. "
+            '최종 답변은 가장 마지막에 "정답은 X입니다." 와 같이 답해 주세요.\n\n'
+        )
+        if self.with_precedents:
+            prefix += self._precedent_block(example, cuts)
 
-        ds = load_dataset("lbox/kcl", "kcl_mcqa", split="test")
-        ds = ds.map(self._concat_columns, load_from_cache_file=False)
+        input_text = prefix
+        input_text += f'문제: "{example["question"]}"\n\n'
 
-        return ds
+        input_text += "선택지:\n"
+        input_text += f'A. "{example["A"]}"\n'
+        input_text += f'B. "{example["B"]}"\n'
+        input_text += f'C. "{example["C"]}"\n'
+        input_text += f'D. "{example["D"]}"\n'
+        input_text += f'E. "{example["E"]}"'
+
+        return {"input_text": input_text, "prompt_prefix_len": len(prefix)}
+
+    def render(self, example, cuts=None):
+        if self.prompt_layout == "cache_optimized":
+            return self._concat_columns_cache_optimized(example, cuts)
+        return self._concat_columns(example, cuts)
+
+    def load(self):
+
+        ds = load_rendered(
+            self,
+            self.render,
+            {
+                "with_precedents": self.with_precedents,
+                "prompt_layout": self.prompt_layout,
+            },
+            revision=self.revision,
+            snapshot=self.snapshot,
+            num_proc=self.num_proc,
+            use_cache=self.use_cache,
+        )
+        # Sampled after rendering, so the cached rendering is shared.
+        return stratified_sample(
+            ds, self.sample_fraction, self.max_samples, self.sample_seed
+        )
 
     def __call__(self):
         return self.load()
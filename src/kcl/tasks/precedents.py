@@ -0,0 +1,87 @@
+import hashlib
+import json
+
+from datasets import Dataset, Sequence, Value, load_from_disk
+
+PRECEDENT_IDS = Sequence(Sequence(Value("string")))
+
+
+def precedent_id(case_name, content):
+    payload = f"{case_name}\0{content}".encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:16]
+
+
+class PrecedentStore:
+
+    # Every distinct (case name, content) pair of a dataset, stored once
+    # as Arrow and memory-mapped once saved. Rows refer to precedents by
+    # id through a precedent_ids column, which keeps the grouping of the
+    # original supporting_precedents entries.
+
+    def __init__(self, ds):
+        self._ds = ds
+        self._index = {pid: i for i, pid in enumerate(ds["precedent_id"])}
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, pid):
+        return pid in self._index
+
+    def __getitem__(self, pid):
+        # Decoded once per process; Arrow row access is slow next to a
+        # dict lookup, and rows cite the same precedents again and again.
+        if pid not in self._decoded:
+            row = self._ds[self._index[pid]]
+            self._decoded[pid] = (row["case_name"], row["content"])
+        return self._decoded[pid]
+
+    def get_many(self, ids):
+        return [self[pid] for pid in ids]
+
+    def save_to_disk(self, path):
+        self._ds.save_to_disk(str(path))
+
+    @classmethod
+    def load(cls, path):
+        return cls(load_from_disk(str(path)))
+
+    @classmethod
+    def build(cls, supporting_precedents):
+        # Returns the store and, per row, the ids of each entry's cases.
+        # Entries cited by several questions are parsed only once.
+        parsed = {}
+        records = {}
+        row_ids = []
+        for entries in supporting_precedents:
+            groups = []
+            for entry in entries:
+                if entry not in parsed:
+                    ids = []
+                    for case_name, content in json.loads(entry).items():
+                        pid = precedent_id(case_name, content)
+                        records.setdefault(pid, (case_name, content))
+                        ids.append(pid)
+                    parsed[entry] = ids
+                groups.append(parsed[entry])
+            row_ids.append(groups)
+
+        ds = Dataset.from_dict(
+            {
+                "precedent_id": list(records),
+                "case_name": [name for name, _ in records.values()],
+                "content": [content for _, content in records.values()],
+            }
+        )
+        return cls(ds), row_ids
+
+
+def attach_precedents(ds):
+    # Swaps the raw supporting_precedents JSON for precedent_ids, so that
+    # rendered rows (and the result records copied from them) stay small.
+    store, row_ids = PrecedentStore.build(ds["supporting_precedents"])
+    ds = ds.remove_columns("supporting_precedents").add_column(
+        "precedent_ids", row_ids, feature=PRECEDENT_IDS
+    )
+    return ds, store
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+from datasets import load_dataset, load_from_disk
+from loguru import logger
+
+from .precedents import PrecedentStore, attach_precedents
+
+DATASET = "lbox/kcl"
+CONFIGS = ("kcl_essay", "kcl_mcqa")
+SNAPSHOT_MANIFEST = "snapshot.json"
+# Bumped when the layout of rendered datasets changes.
+RENDER_FORMAT = 2
+
+CACHE_DIR = Path(
+    os.getenv("KCL_CACHE_DIR", Path.home() / ".cache" / "kcl" / "rendered")
+)
+# Below this many rows per process, starting workers costs more than the
+# rendering itself.
+MIN_ROWS_PER_PROC = 20_000
+
+
+def batched(render):
+    # Per-example render functions, applied to a whole batch at once.
+    def render_batch(batch):
+        rows = [dict(zip(batch, values)) for values in zip(*batch.values())]
+        outputs = [render(row) for row in rows]
+        if not outputs:
+            return {}
+        return {key: [o[key] for o in outputs] for key in outputs[0]}
+
+    return render_batch
+
+
+def default_num_proc(n_rows):
+    return max(1, min(os.cpu_count() or 1, 8, n_rows // MIN_ROWS_PER_PROC))
+
+
+def read_manifest(snapshot):
+    path = Path(snapshot) / SNAPSHOT_MANIFEST
+    if not path.exists():
+        raise FileNotFoundError(
+            f"{snapshot} is not a dataset snapshot (no {SNAPSHOT_MANIFEST}); "
+            "create one with `kcl snapshot`"
+        )
+    return json.loads(path.read_text())
+
+
+def fingerprint(revision, task, params):
+    payload = json.dumps(
+        {
+            "dataset": DATASET,
+            "format": RENDER_FORMAT,
+            "revision": revision,
+            "task": type(task).__name__,
+            "template_version": task.template_version,
+            **params,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def load_raw(config_name, revision=None, snapshot=None):
+    # Returns the test split and the revision it was rendered from.
+    if snapshot:
+        manifest = read_manifest(snapshot)
+        ds = load_from_disk(str(Path(snapshot) / config_name))
+        return ds, manifest["revision"]
+
+    ds = load_dataset(DATASET, config_name, split="test", revision=revision)
+    # Without a snapshot the resolved commit is not known here; the
+    # dataset's own fingerprint changes whenever its files do.
+    return ds, ds._fingerprint
+
+
+def _save(ds, path):
+    tmp = path.with_name(f"{path.name}.tmp{os.getpid()}")
+    ds.save_to_disk(str(tmp))
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # Another process rendered the same fingerprint first.
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _precedents_path(cache_root, dataset_revision):
+    key = hashlib.sha256(f"{DATASET}:{dataset_revision}".encode("utf-8"))
+    return cache_root / f"precedents-{key.hexdigest()[:16]}"
+
+
+def _load_cached(task, cache_root, dataset_revision, params):
+    # Rows refer to the precedent store, so without it the rendering is
+    # treated as missing and rendered again.
+    key = fingerprint(dataset_revision, task, params)
+    store_path = _precedents_path(cache_root, dataset_revision)
+    if not (cache_root / key).exists() or not store_path.exists():
+        return None
+    logger.info(f"Loading rendered {task.config_name} ({key})")
+    task.precedents = PrecedentStore.load(store_path)
+    return load_from_disk(str(cache_root / key))
+
+
+def load_rendered(
+    task,
+    render,
+    params,
+    revision=None,
+    snapshot=None,
+    num_proc=None,
+    use_cache=True,
+):
+    # Rendered prompts are stored under a fingerprint of the dataset
+    # revision, task class, rendering params and template version, and
+    # later runs memory-map them with load_from_disk. The task's
+    # precedent store is set on task.precedents for render to use.
+    cache_root = CACHE_DIR / task.config_name
+    if snapshot and use_cache:
+        # The revision is known up front, so a hit never reads the raw
+        # dataset.
+        dataset_revision = read_manifest(snapshot)["revision"]
+        ds = _load_cached(task, cache_root, dataset_revision, params)
+        if ds is not None:
+            return ds
+
+    ds, dataset_revision = load_raw(task.config_name, revision, snapshot)
+    if use_cache:
+        cached = _load_cached(task, cache_root, dataset_revision, params)
+        if cached is not None:
+            return cached
+
+    ds, task.precedents = attach_precedents(ds)
+    if use_cache:
+        store_path = _precedents_path(cache_root, dataset_revision)
+        if not store_path.exists():
+            cache_root.mkdir(parents=True, exist_ok=True)
+            _save(task.precedents, store_path)
+        task.precedents = PrecedentStore.load(store_path)
+
+    if num_proc is None:
+        num_proc = default_num_proc(len(ds))
+    ds = ds.map(
+        batched(render),
+        batched=True,
+        num_proc=num_proc if num_proc > 1 else None,
+        load_from_cache_file=False,
+        desc=f"Rendering {task.config_name}",
+    )
+    if not use_cache:
+        return ds
+
+    path = cache_root / fingerprint(dataset_revision, task, params)
+    _save(ds, path)
+    logger.info(f"Cached rendered {task.config_name} at {path}")
+    return load_from_disk(str(path))
@@ -0,0 +1,51 @@
+import math
+import random
+from collections import defaultdict
+
+from kcl.inference.results import SAMPLE_ID
+
+
+def stratum(meta):
+    # "변호사시험 08회 공법 제1문의 1" -> "변호사시험 08회 공법", i.e. the
+    # exam session and subject.
+    return " ".join(str(meta).split()[:3])
+
+
+def stratified_order(metas, seed=0):
+    # Row indices ordered so that every prefix covers the strata in
+    # proportion to their sizes. A larger sample is always a superset of
+    # a smaller one with the same seed.
+    rng = random.Random(seed)
+    groups = defaultdict(list)
+    for row, meta in enumerate(metas):
+        groups[stratum(meta)].append(row)
+
+    keyed = []
+    for name in sorted(groups):
+        rows = groups[name]
+        rng.shuffle(rows)
+        offset = rng.random()
+        keyed.extend(
+            ((rank + offset) / len(rows), row) for rank, row in enumerate(rows)
+        )
+    return [row for _, row in sorted(keyed)]
+
+
+def sample_size(n_rows, fraction=None, max_samples=None):
+    if fraction is not None and not 0 < fraction <= 1:
+        raise ValueError(f"sample_fraction must be in (0, 1], not {fraction}")
+    size = n_rows if fraction is None else math.ceil(n_rows * fraction)
+    if max_samples is not None:
+        size = min(size, max_samples)
+    return min(size, n_rows)
+
+
+def stratified_sample(ds, fraction=None, max_samples=None, seed=0):
+    # Rows keep their index in the full dataset as sample_id, so results
+    # of samples of different sizes line up.
+    if fraction is None and max_samples is None:
+        return ds
+    order = stratified_order(ds["meta"], seed)
+    size = sample_size(len(ds), fraction, max_samples)
+    ds = ds.add_column(SAMPLE_ID, list(range(len(ds))))
+    return ds.select(sorted(order[:size]))
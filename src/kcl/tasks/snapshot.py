@@ -0,0 +1,55 @@
+import argparse
+import json
+from datetime import datetime
+from pathlib import Path
+
+from datasets import load_dataset
+from loguru import logger
+
+from .rendering import CONFIGS, DATASET, SNAPSHOT_MANIFEST
+
+
+def resolve_revision(revision=None):
+    from huggingface_hub import HfApi
+
+    return HfApi().dataset_info(DATASET, revision=revision).sha
+
+
+def save_snapshot(output_dir, revision=None):
+    # Pins every task config to one commit of the hub dataset and stores
+    # it as Arrow files; runs with snapshot=<dir> never contact the hub.
+    output_dir = Path(output_dir)
+    sha = resolve_revision(revision)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for config_name in CONFIGS:
+        ds = load_dataset(DATASET, config_name, split="test", revision=sha)
+        ds.save_to_disk(str(output_dir / config_name))
+        logger.info(f"Saved {config_name} ({len(ds)} rows)")
+
+    manifest = {
+        "dataset": DATASET,
+        "revision": sha,
+        "requested_revision": revision,
+        "configs": list(CONFIGS),
+        "created": datetime.now().isoformat(timespec="seconds"),
+    }
+    (output_dir / SNAPSHOT_MANIFEST).write_text(json.dumps(manifest, indent=2))
+    logger.info(f"Snapshot of {DATASET}@{sha} saved to {output_dir}")
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="kcl snapshot",
+        description=f"Save {DATASET} locally for offline runs.",
+    )
+    parser.add_argument("output_dir", help="directory to write to")
+    parser.add_argument(
+        "--revision", default=None, help="branch, tag or commit to pin"
+    )
+    args = parser.parse_args(argv)
+    save_snapshot(args.output_dir, args.revision)
+
+
+if __name__ == "__main__":
+    main()
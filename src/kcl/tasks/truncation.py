@@ -0,0 +1,194 @@
+from datasets import Value
+from loguru import logger
+
+from kcl.inference.results import PRECEDENT_CUTS, SAMPLE_ID
+
+# The headnote (판시사항, 판결요지) comes before the case details.
+HEADNOTE_END = "\n\n사건"
+# Each round renders the prompt, counts it, and lowers the allowance by
+# whatever is still over budget.
+MAX_ROUNDS = 4
+
+PRECEDENT_CUTS_FEATURE = [
+    {
+        "precedent_id": Value("string"),
+        "kept_chars": Value("int64"),
+        "chars": Value("int64"),
+    }
+]
+
+
+def water_fill(sizes, budget):
+    # Every item keeps min(size, level), with level as high as the budget
+    # allows: small items stay whole and large ones are cut to the same
+    # length.
+    kept = [0] * len(sizes)
+    left = max(0, budget)
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    for n, i in enumerate(order):
+        share = left // (len(order) - n)
+        kept[i] = min(sizes[i], share)
+        left -= kept[i]
+    return kept
+
+
+def allot(heads, bodies, budget):
+    # Tokens kept of each headnote and of each body. Bodies are cut first;
+    # headnotes only once every body is gone.
+    if sum(heads) > budget:
+        return water_fill(heads, budget), [0] * len(bodies)
+    return heads, water_fill(bodies, budget - sum(heads))
+
+
+def _chars(text, n_tokens, kept_tokens):
+    if kept_tokens >= n_tokens:
+        return len(text)
+    return len(text) * kept_tokens // n_tokens
+
+
+class PrecedentFitter:
+
+    # Cuts the precedents of prompts over a token budget. Headnotes are
+    # kept before case details, and every precedent of a prompt is cut to
+    # the same length rather than dropping whole cases. Token counts of
+    # each precedent are cached, since questions cite the same ones.
+
+    def __init__(self, loader, counter, budget):
+        self.loader = loader
+        self.counter = counter
+        self.budget = budget
+        self._tokens = {}
+
+    def _parts(self, pid):
+        if pid not in self._tokens:
+            _, content = self.loader.precedents[pid]
+            head = content.partition(HEADNOTE_END)[0]
+            body = content[len(head) :]
+            self._tokens[pid] = (
+                head,
+                body,
+                *self.counter.count_batch([head, body]),
+            )
+        return self._tokens[pid]
+
+    def cuts(self, pids, allowance):
+        parts = [self._parts(pid) for pid in pids]
+        heads, bodies = allot(
+            [p[2] for p in parts], [p[3] for p in parts], allowance
+        )
+        cuts = {}
+        for pid, (head, body, n_head, n_body), kept_head, kept_body in zip(
+            pids, parts, heads, bodies
+        ):
+            kept = _chars(head, n_head, kept_head) + _chars(
+                body, n_body, kept_body
+            )
+            if kept < len(head) + len(body):
+                cuts[pid] = kept
+        return cuts
+
+    def fit(self, example):
+        # The rendered columns, their token count and the cuts made.
+        pids = list(
+            dict.fromkeys(
+                pid for ids in example["precedent_ids"] for pid in ids
+            )
+        )
+        bare = self.loader.render(example, dict.fromkeys(pids, 0))
+        allowance = self.budget - self.counter.count(bare["input_text"])
+
+        for _ in range(MAX_ROUNDS):
+            cuts = self.cuts(pids, allowance)
+            rendered = self.loader.render(example, cuts)
+            n_tokens = self.counter.count(rendered["input_text"])
+            if n_tokens <= self.budget or allowance <= 0:
+                break
+            allowance -= n_tokens - self.budget
+        return rendered, n_tokens, cuts
+
+
+def cut_records(loader, cuts):
+    return [
+        {
+            "precedent_id": pid,
+            "kept_chars": kept,
+            "chars": len(loader.precedents[pid][1]),
+        }
+        for pid, kept in cuts.items()
+    ]
+
+
+def _with_cuts(ds, update):
+    # update(example, row) returns the columns to replace, or None.
+    features = ds.features.copy()
+    features[PRECEDENT_CUTS] = PRECEDENT_CUTS_FEATURE
+
+    def apply(example, row):
+        return update(example, row) or {PRECEDENT_CUTS: []}
+
+    return ds.map(
+        apply,
+        with_indices=True,
+        features=features,
+        load_from_cache_file=False,
+    )
+
+
+def fit_prompts(loader, ds, counter, budget):
+    # Rows over budget (by their n_prompt_tokens) are rendered again with
+    # their precedents cut to fit. Only then is a precedent_cuts column
+    # added, recording what each row lost (empty for rows left whole).
+    over = {row for row, n in enumerate(ds["n_prompt_tokens"]) if n > budget}
+    if not over:
+        return ds
+    if not loader.with_precedents:
+        logger.warning(
+            f"{len(over)} prompts exceed {budget} tokens without precedents"
+        )
+        return ds
+
+    fitter = PrecedentFitter(loader, counter, budget)
+
+    def update(example, row):
+        if row not in over:
+            return None
+        rendered, n_tokens, cuts = fitter.fit(example)
+        if n_tokens > budget:
+            logger.warning(
+                f"{example['meta']}: {n_tokens} tokens over a budget of "
+                f"{budget} even with every precedent cut"
+            )
+        return {
+            **rendered,
+            "n_prompt_tokens": n_tokens,
+            PRECEDENT_CUTS: cut_records(loader, cuts),
+        }
+
+    ds = _with_cuts(ds, update)
+    logger.info(
+        f"Cut precedents of {len(over)}/{len(ds)} prompts to fit "
+        f"{budget} tokens"
+    )
+    return ds
+
+
+def apply_cuts(loader, ds, cuts):
+    # Renders rows again with the precedent_cuts recorded for them, keyed
+    # by sample_id, e.g. to join compact results to the prompts they were
+    # generated from.
+    rows = ds[SAMPLE_ID] if SAMPLE_ID in ds.column_names else range(len(ds))
+    cuts = {
+        row: cuts[sample_id]
+        for row, sample_id in enumerate(rows)
+        if cuts.get(sample_id)
+    }
+    if not cuts:
+        return ds
+
+    def update(example, row):
+        if row not in cuts:
+            return None
+        kept = {c["precedent_id"]: c["kept_chars"] for c in cuts[row]}
+        return {**loader.render(example, kept), PRECEDENT_CUTS: cuts[row]}
+
+    return _with_cuts(ds, update)
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from kcl.models.inprocess import InProcessModel  # noqa: E402
+from kcl.models.streaming import (  # noqa: E402
+    acollect_stream,
+    check_stream,
+    collect_stream,
+)
+
+WORDS = ["[PAD]", "[UNK]", "[EOS]", "민법", "형법", "판례", "정답", "A", "B"]
+
+
+@pytest.fixture(scope="module")
+def tiny_model(tmp_path_factory):
+    # A randomly initialised one-layer GPT-2 with a word-level tokenizer,
+    # built locally so that the test needs neither a GPU nor the network.
+    from tokenizers import Tokenizer, models, pre_tokenizers
+
+    path = tmp_path_factory.mktemp("tiny-gpt2")
+    tokenizer = Tokenizer(
+        models.WordLevel(
+            {w: i for i, w in enumerate(WORDS)}, unk_token="[UNK]"
+        )
+    )
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        unk_token="[UNK]",
+        pad_token="[PAD]",
+        eos_token="[EOS]",
+    ).save_pretrained(path)
+
+    transformers.set_seed(0)
+    config = transformers.GPT2Config(
+        vocab_size=len(WORDS),
+        n_positions=64,
+        n_embd=16,
+        n_layer=1,
+        n_head=2,
+        bos_token_id=2,
+        eos_token_id=2,
+        pad_token_id=0,
+    )
+    transformers.GPT2LMHeadModel(config).save_pretrained(path)
+
+    model = InProcessModel(
+        str(path), engine="transformers", device="cpu", max_tokens=8
+    )
+    # Greedy decoding, so streamed and whole outputs can be compared.
+    model.temperature = 0
+    return model
+
+
+def test_generate(tiny_model, monkeypatch):
+    assert isinstance(tiny_model.generate("민법 판례"), str)
+    # Several sequences per prompt need sampling.
+    monkeypatch.setattr(tiny_model, "temperature", 0.6)
+    assert len(tiny_model.generate_n("민법 판례", 2)) == 2
+    assert len(tiny_model.generate_batch(["민법", "형법 판례 정답"])) == 2
+
+
+def test_stream_matches_generate(tiny_model):
+    check_stream(tiny_model)
+    text, timings = collect_stream(tiny_model, "민법 판례")
+    assert text.strip() == tiny_model.generate("민법 판례")
+    assert 0 < timings["output_tokens"] <= tiny_model.max_tokens
+    assert timings["ttft"] <= timings["latency"]
+
+
+def test_astream(tiny_model):
+    text, _ = asyncio.run(acollect_stream(tiny_model, "형법"))
+    assert text.strip() == tiny_model.generate("형법")
+
+
+def test_stream_error_is_raised(tiny_model, monkeypatch):
+    def fail(**kwargs):
+        raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(tiny_model.model, "generate", fail)
+    with pytest.raises(RuntimeError, match="out of memory"):
+        collect_stream(tiny_model, "민법")
+
+
+def test_vllm_engine_cannot_stream(tiny_model, monkeypatch):
+    monkeypatch.setattr(tiny_model, "engine", "vllm")
+    with pytest.raises(ValueError, match="cannot stream"):
+        check_stream(tiny_model)
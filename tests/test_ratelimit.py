@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from kcl.models.ratelimit import AdaptiveLimiter, RateLimitedModel
+from kcl.models.tokenizer import token_counter
+from kcl.models.usage import UsageHistory
+
+
+class SlowModel:
+
+    provider = "fake"
+    model_name = "fake"
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def agenerate(self, prompt: str):
+        await asyncio.sleep(self.latency)
+        return prompt
+
+
+def test_cancelled_call_is_not_a_success():
+    limiter = AdaptiveLimiter(max_concurrency=8, latency_slack=2.0)
+    model = RateLimitedModel(SlowModel(0.2), limiter)
+
+    async def run():
+        await model.agenerate("민법")
+        limit = limiter.limit
+        task = asyncio.ensure_future(model.agenerate("형법"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return limit
+
+    limit = asyncio.run(run())
+    assert limiter.in_flight == 0
+    assert limiter.baseline_latency >= 0.2
+    assert limiter.limit == limit
+
+
+class MeteredModel:
+
+    provider = "fake"
+    model_name = "fake"
+
+    def __init__(self, limiter, max_tokens=None, output_tokens=30):
+        self.limiter = limiter
+        self.max_tokens = max_tokens
+        self.output_tokens = output_tokens
+        self.usage_history = UsageHistory(self.model_name)
+        self.levels = []
+
+    def generate(self, prompt: str):
+        self.levels.append(self.limiter.tokens.level)
+        self.usage_history.record(
+            input_tokens=10, output_tokens=self.output_tokens
+        )
+        return prompt
+
+    def generate_stream(self, prompt: str):
+        self.levels.append(self.limiter.tokens.level)
+        yield prompt
+        yield {"output_tokens": self.output_tokens}
+
+
+def test_output_is_reserved_then_settled():
+    limiter = AdaptiveLimiter(tpm=600)
+    inner = MeteredModel(limiter, max_tokens=100)
+    model = RateLimitedModel(inner, limiter)
+    n_input = token_counter(inner).count("민법")
+
+    model.generate("민법")
+    assert inner.levels[0] == pytest.approx(600 - n_input - 100, abs=1)
+    # Settled with the 10 input and 30 output tokens reported.
+    assert limiter.tokens.level == pytest.approx(600 - 40, abs=1)
+
+
+def test_output_reserve_follows_reported_output():
+    limiter = AdaptiveLimiter(tpm=6_000_000)
+    inner = MeteredModel(limiter, output_tokens=30)
+    model = RateLimitedModel(inner, limiter)
+    assert limiter.output_reserve() == 0
+
+    model.generate("민법")
+    assert limiter.output_reserve() == 30
+
+    inner.output_tokens = 90
+    assert list(model.generate_stream("형법"))[-1] == {"output_tokens": 90}
+    assert limiter.output_reserve() == 60
+    assert limiter.output_reserve(n=2) == 120
+    assert limiter.output_reserve(max_tokens=100) == 100
@@ -0,0 +1,61 @@
+from kcl.models import tokenizer
+from kcl.models.usage import UsageHistory
+
+
+class FakeModel:
+
+    provider = "bedrock"
+    model_name = "fake-claude"
+
+    def __init__(self):
+        self.usage_history = UsageHistory(self.model_name)
+
+
+def test_calibration(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        tokenizer, "CALIBRATION_PATH", tmp_path / "chars_per_token.json"
+    )
+    monkeypatch.setattr(tokenizer, "MIN_CALIBRATION_TOKENS", 1_000)
+    monkeypatch.setattr(tokenizer, "_chars_per_token", None)
+    model = FakeModel()
+    model.usage_history.record(
+        input_tokens=600, output_tokens=10, prompt_chars=1_500
+    )
+    # Batch outputs carry no prompt length and are left out.
+    model.usage_history.record(input_tokens=900, output_tokens=10)
+
+    # Nothing is recorded or fitted unless calibration is asked for.
+    tokenizer.update_calibration(model)
+    assert not tokenizer.CALIBRATION_PATH.exists()
+    assert tokenizer.estimated_chars_per_token(model) == 1.5
+
+    tokenizer.set_chars_per_token(tokenizer.CALIBRATED)
+    tokenizer.update_calibration(model)
+    assert tokenizer.calibrated_chars_per_token("fake-claude") is None
+
+    tokenizer.update_calibration(model)
+    assert tokenizer.calibrated_chars_per_token("fake-claude") == 2.5
+    tokenizer.get_token_counter.cache_clear()
+    counter = tokenizer.token_counter(model)
+    assert counter.chars_per_token == 2.5
+    assert counter.count("가" * 250) == 100
+
+    # A ratio recorded by an earlier run counts the same way again.
+    tokenizer.set_chars_per_token("2.5")
+    tokenizer.CALIBRATION_PATH.unlink()
+    assert tokenizer.estimated_chars_per_token(model) == 2.5
+    tokenizer.get_token_counter.cache_clear()
+
+
+def test_exact_counts_are_remembered():
+    calls = []
+
+    def count_batch(texts):
+        calls.append(list(texts))
+        return [len(t.split()) for t in texts]
+
+    counter = tokenizer.TokenCounter(count_batch)
+    assert counter.count_batch(["민법 판례", "형법"]) == [2, 1]
+    assert counter.count("민법 판례") == 2
+    assert counter.count_batch(["형법", "정답 A B"]) == [1, 3]
+    assert calls == [["민법 판례", "형법"], ["정답 A B"]]
@@ -0,0 +1,81 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from kcl.inference import workqueue
+from kcl.inference.workqueue import WorkQueue
+
+ITEM = ("kcl_mcqa", 0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000.0]
+    monkeypatch.setattr(
+        workqueue,
+        "time",
+        SimpleNamespace(time=lambda: now[0], sleep=time.sleep),
+    )
+    return now
+
+
+def make_queue(tmp_path, **kwargs):
+    queue = WorkQueue(tmp_path / "queue.sqlite", lease_seconds=10, **kwargs)
+    queue.enqueue([ITEM])
+    return queue
+
+
+def attempts(queue):
+    return queue._connect().execute("SELECT attempts FROM items").fetchone()[0]
+
+
+def test_lapsed_lease_is_requeued(tmp_path, clock):
+    queue = make_queue(tmp_path)
+    assert queue.lease("a") == [ITEM]
+    assert queue.lease("b") == []
+
+    clock[0] += 5
+    queue.renew("a")
+    clock[0] += 9
+    assert queue.lease("b") == []
+
+    clock[0] += 2
+    assert queue.lease("b") == [ITEM]
+    assert attempts(queue) == 2
+
+
+def test_failed_after_max_attempts(tmp_path, clock):
+    queue = make_queue(tmp_path, max_attempts=2)
+    for worker in ("a", "b"):
+        assert queue.lease(worker) == [ITEM]
+        clock[0] += 11
+
+    assert queue.lease("c") == []
+    assert queue.counts() == {"failed": 1}
+    assert queue.finished()
+    assert list(queue.results()) == [(*ITEM, None)]
+
+
+def test_release_is_not_an_attempt(tmp_path, clock):
+    queue = make_queue(tmp_path, max_attempts=1)
+    assert queue.lease("a") == [ITEM]
+    queue.release("a")
+    assert queue.counts() == {"pending": 1}
+    assert attempts(queue) == 0
+
+    assert queue.lease("b") == [ITEM]
+    queue.complete(*ITEM, {"model_output": "B"}, "b")
+    assert list(queue.results()) == [(*ITEM, {"model_output": "B"})]
+
+
+def test_late_complete_keeps_the_first_record(tmp_path, clock):
+    queue = make_queue(tmp_path)
+    assert queue.lease("a") == [ITEM]
+    clock[0] += 11
+    assert queue.lease("b") == [ITEM]
+
+    queue.complete(*ITEM, {"model_output": "B"}, "b")
+    queue.complete(*ITEM, {"model_output": "A"}, "a")
+    assert queue.counts() == {"done": 1}
+    assert list(queue.results()) == [(*ITEM, {"model_output": "B"})]